@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+MicroBot AI - Benchmarks (CPython, run from the install directory)
+
+Usage:
+  python3 bench.py tools [iterations] [--net]   Per-tool latency: native vs shell
+  python3 bench.py startup [iterations]         Skill loading and process start time
+  python3 bench.py load [chats] [messages] [--main] [--tools] [--provider=anthropic|openrouter]
+                        [--latency=MS] [--errors=RATE]
+                                                Offline throughput against fake LLM and
+                                                Telegram servers (--main drives main()
+                                                and its polling loop instead of the agent)
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import microbot
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = int(round((len(values) - 1) * p / 100.0))
+    return values[k]
+
+
+def time_calls(fn, n):
+    """Run fn n times, return per-call latencies in ms."""
+    out = []
+    for _ in range(n):
+        t0 = time.time()
+        fn()
+        out.append((time.time() - t0) * 1000.0)
+    return out
+
+
+def fmt_ms(values):
+    return f"{percentile(values, 50):9.2f} {percentile(values, 95):9.2f}"
+
+
+def bench_tools(n, net=False):
+    """Compare each native tool against its tools.sh implementation, both on a
+    resident worker and with one sh per call (the pre-worker path)."""
+    scratch = microbot.Path.join(microbot.DATA_DIR, "bench_scratch.txt")
+    cases = [
+        ("write_file", {"path": scratch, "content": "hello bench\nline 2"}),
+        ("read_file", {"path": scratch}),
+        ("edit_file", {"path": scratch, "old_string": "hello", "new_string": "hello"}),
+        ("list_dir", {"prefix": microbot.DATA_DIR}),
+        ("system_info", {}),
+    ]
+    if net:
+        cases += [
+            ("get_current_time", {}),
+            ("http_request", {"url": "https://example.com/"}),
+        ]
+
+    native = microbot.Agent({"tool_workers": 1})
+    resident = microbot.Agent({"tool_workers": 1, "python_tools": False})
+    oneshot = microbot.Agent({"tool_workers": 0, "python_tools": False})
+
+    print(f"Tool latency over {n} calls (ms, p50 / p95)")
+    print(f"{'tool':18} {'native':>19} {'shell worker':>19} {'sh per call':>19}")
+    for name, args in cases:
+        resident.execute_tool(name, dict(args))  # start the worker outside the timing
+        row = []
+        for agent in (native, resident, oneshot):
+            row.append(time_calls(lambda: agent.execute_tool(name, dict(args)), n))
+        print(f"{name:18} {fmt_ms(row[0])} {fmt_ms(row[1])} {fmt_ms(row[2])}")
+
+    try:
+        microbot.os.remove(scratch)
+    except OSError:
+        pass
+    resident.tools.reset()
+
+
+def bench_startup(n):
+    """Skill discovery the old way (two shells running skills.sh, plus the
+    curl probe) against the Python manifest, cold and cached, and the time
+    for a fresh interpreter to import microbot and load its skills."""
+    root = microbot.SCRIPT_DIR
+
+    def legacy():
+        for fn in ("skill_list_names", "skill_list_descriptions"):
+            subprocess.run(["sh", "-c", f"cd {root} && . ./config.sh && . ./skills.sh && {fn}"],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(["sh", "-c", "curl --version 2>&1 | head -1"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def cold():
+        try:
+            os.remove(microbot.MANIFEST_FILE)
+        except OSError:
+            pass
+        microbot._manifest[0] = None
+        microbot.Agent.load_skills()
+
+    def warm():
+        microbot._manifest[0] = None
+        microbot.Agent.load_skills()
+
+    def process():
+        subprocess.run([sys.executable, "-c",
+                        "import microbot; microbot.Agent({}); microbot.Agent.load_skills()"],
+                       cwd=root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    print(f"Startup over {n} runs (ms, p50 / p95)")
+    for label, fn in (("skills.sh + curl probe", legacy),
+                      ("manifest, cold", cold),
+                      ("manifest, cached", warm),
+                      ("python start to ready", process)):
+        print(f"{label:24} {fmt_ms(time_calls(fn, n))}")
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def body_json(self):
+        n = int(self.headers.get("Content-Length") or 0)
+        if not n:
+            return {}
+        try:
+            return json.loads(self.rfile.read(n))
+        except ValueError:
+            return {}
+
+    def reply(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(handler_cls, owner):
+    handler = type("H", (handler_cls,), {"owner": owner})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+class FakeLLM:
+    """Scripted Anthropic / OpenRouter endpoint. With tools on, a user
+    message gets a get_current_time tool call first and the final answer
+    after the tool result; the answer echoes the user's text. Every
+    1/error_rate-th request fails with HTTP 500."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, tools=False):
+        self.latency = latency
+        self.error_every = int(round(1 / error_rate)) if error_rate > 0 else 0
+        self.tools = tools
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    @staticmethod
+    def last_user_text(messages):
+        for m in reversed(messages):
+            if m.get("role") == "user" and isinstance(m.get("content"), str) \
+                    and not m["content"].startswith("[Tool Result"):
+                return m["content"]
+        return ""
+
+    @staticmethod
+    def after_tool(messages):
+        last = messages[-1] if messages else {}
+        if last.get("role") == "tool":
+            return True
+        content = last.get("content")
+        if isinstance(content, list):
+            return any(b.get("type") == "tool_result" for b in content)
+        return isinstance(content, str) and content.startswith("[Tool Result")
+
+    def respond(self, anthropic, body):
+        with self.lock:
+            self.requests += 1
+            fail = self.error_every and self.requests % self.error_every == 0
+            if fail:
+                self.errors += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            return 500, {"error": {"type": "api_error", "message": "scripted failure"}}
+        messages = body.get("messages", [])
+        usage_a = {"input_tokens": 200, "output_tokens": 20}
+        usage_o = {"prompt_tokens": 200, "completion_tokens": 20}
+        if self.tools and not self.after_tool(messages):
+            if anthropic:
+                return 200, {"content": [{"type": "tool_use", "id": f"tu{self.requests}",
+                                          "name": "get_current_time", "input": {}}], "usage": usage_a}
+            return 200, {"choices": [{"message": {"role": "assistant", "content": None, "tool_calls": [
+                {"id": f"call{self.requests}", "type": "function",
+                 "function": {"name": "get_current_time", "arguments": "{}"}}]}}], "usage": usage_o}
+        text = "reply to: " + self.last_user_text(messages)
+        if anthropic:
+            return 200, {"content": [{"type": "text", "text": text}], "usage": usage_a}
+        return 200, {"choices": [{"message": {"role": "assistant", "content": text}}], "usage": usage_o}
+
+    class Handler(_Handler):
+        def do_POST(self):
+            status, obj = self.owner.respond(self.path.endswith("/messages"), self.body_json())
+            self.reply(status, obj)
+
+
+class FakeTelegram:
+    """Bot API stand-in: queues updates for getUpdates (long poll capped at
+    1s) and timestamps replies. A sendMessage that isn't a progress note
+    answers the oldest open message of its chat."""
+    PROGRESS = ("Still working", "Just a moment", "Almost there")
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.updates = []
+        self.next_id = 1
+        self.open = {}         # chat_id -> [enqueue times]
+        self.latencies = []
+        self.calls = {}
+        self.on_reply = None   # fn(chat_id) after each answered message
+
+    def enqueue(self, chat_id, text):
+        with self.cond:
+            self.open.setdefault(chat_id, []).append(time.time())
+            self.updates.append({"update_id": self.next_id, "message": {
+                "chat": {"id": chat_id}, "from": {"username": f"user{chat_id}"}, "text": text}})
+            self.next_id += 1
+            self.cond.notify_all()
+
+    def get_updates(self, offset, timeout):
+        deadline = time.time() + min(timeout, 1.0)
+        with self.cond:
+            while True:
+                ready = [u for u in self.updates if u["update_id"] >= offset]
+                left = deadline - time.time()
+                if ready or left <= 0:
+                    self.updates = ready
+                    return ready
+                self.cond.wait(left)
+
+    def sent(self, chat_id, text):
+        if text.startswith(self.PROGRESS):
+            return
+        with self.cond:
+            pending = self.open.get(chat_id)
+            if not pending:
+                return
+            self.latencies.append(time.time() - pending.pop(0))
+        if self.on_reply:
+            self.on_reply(chat_id)
+
+    class Handler(_Handler):
+        def handle_call(self, params):
+            owner = self.owner
+            method = urlparse(self.path).path.rsplit("/", 1)[-1]
+            owner.calls[method] = owner.calls.get(method, 0) + 1
+            if method == "getUpdates":
+                result = owner.get_updates(int(params.get("offset", 0)), float(params.get("timeout", 0)))
+                return self.reply(200, {"ok": True, "result": result})
+            if method == "sendMessage":
+                owner.sent(int(params.get("chat_id")), str(params.get("text", "")))
+                return self.reply(200, {"ok": True, "result": {"message_id": 1}})
+            return self.reply(200, {"ok": True, "result": True})
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            self.handle_call({k: v[0] for k, v in query.items()})
+
+        def do_POST(self):
+            self.handle_call(self.body_json())
+
+
+def rss_kb():
+    """(VmRSS, VmHWM) in kB from /proc, or (0, 0)."""
+    vals = {}
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS:", "VmHWM:")):
+                    vals[line.split(":")[0]] = int(line.split()[1])
+    except OSError:
+        pass
+    return vals.get("VmRSS", 0), vals.get("VmHWM", 0)
+
+
+def spawns():
+    return sum(microbot.METRICS.counters.get("process_spawns_total", {}).values())
+
+
+def bench_load(chats, messages, drive_main=False, tools=False, provider="anthropic",
+               latency_ms=0.0, error_rate=0.0):
+    """N chats each send M messages closed-loop (next one after the reply)
+    through a fake LLM and a fake Telegram; everything stays on 127.0.0.1."""
+    llm = FakeLLM(latency_ms / 1000.0, error_rate, tools)
+    tg = FakeTelegram()
+    _, llm_base = serve(FakeLLM.Handler, llm)
+    _, tg_base = serve(FakeTelegram.Handler, tg)
+
+    tmp = tempfile.mkdtemp(prefix="microbot_bench_")
+    microbot.Agent._get_session_file = lambda self, chat_id: os.path.join(tmp, f"{chat_id}.json")
+    token = "BENCH"
+    config = {
+        "tg_token": token, "provider": provider, "api_key": "x", "openrouter_key": "x",
+        "anthropic_url": llm_base + "/v1/messages",
+        "openrouter_url": llm_base + "/api/v1/chat/completions",
+        "tg_api_base": tg_base + "/bot", "max_workers": str(min(chats, 8)),
+    }
+    microbot.get_sender(token, tg_base + "/bot")
+
+    sent = {c: 0 for c in range(1, chats + 1)}
+    total = chats * messages
+    done = threading.Event()
+
+    def next_message(chat_id):
+        if sent[chat_id] < messages:
+            sent[chat_id] += 1
+            text = f"message {chat_id}-{sent[chat_id]}"
+            tg.enqueue(chat_id, text)
+            if submit:
+                submit(chat_id, text)
+        if len(tg.latencies) >= total:
+            done.set()
+
+    if drive_main:
+        cfg_path = os.path.join(tmp, "config.json")
+        with open(cfg_path, "w") as f:
+            json.dump(config, f)
+        microbot.CONFIG_FILE = cfg_path
+        threading.Thread(target=microbot.main, daemon=True).start()
+        submit = None   # main() picks messages up through getUpdates
+    else:
+        agent = microbot.Agent(config)
+        dispatcher = microbot.ChatDispatcher(config["max_workers"])
+
+        def submit(chat_id, text):
+            dispatcher.submit(chat_id, microbot.handle_message, agent, token, chat_id, text, f"user{chat_id}")
+
+    spawns0 = spawns()
+    tg.on_reply = lambda chat_id: next_message(chat_id)
+    t0 = time.time()
+    for c in sent:
+        next_message(c)
+    finished = done.wait(max(60.0, total * (latency_ms / 1000.0 + 0.5)))
+    wall = time.time() - t0
+    rss, hwm = rss_kb()
+
+    lat = [x * 1000.0 for x in tg.latencies]
+    mode = "main() + polling" if drive_main else "agent + dispatcher"
+    print(f"Load: {chats} chats x {messages} messages, {mode}, provider={provider}, "
+          f"tools={'on' if tools else 'off'}, llm latency={latency_ms:g}ms, errors={error_rate:g}")
+    if not finished:
+        print(f"  TIMED OUT: {len(lat)}/{total} replies")
+    print(f"  latency ms   p50 {percentile(lat, 50):8.1f}  p95 {percentile(lat, 95):8.1f}  p99 {percentile(lat, 99):8.1f}")
+    print(f"  throughput   {len(lat) / wall:8.1f} msg/s ({len(lat)} in {wall:.2f}s)")
+    print(f"  spawns/msg   {(spawns() - spawns0) / max(1, len(lat)):8.2f}")
+    print(f"  llm requests {llm.requests} ({llm.errors} failed), telegram calls {tg.calls}")
+    print(f"  RSS          {rss / 1024.0:.1f} MB (peak {hwm / 1024.0:.1f} MB, includes fake servers)")
+    if not drive_main:
+        mem = agent.memory_report()
+        print(f"  history      {mem['chats']} chats resident, {mem['history_bytes'] / 1024.0:.1f} KB, "
+              f"{mem['evictions']} evictions, {mem['session_loads']} loads")
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    flags = [a for a in sys.argv[1:] if a.startswith("--")]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+    if args[0] == "tools":
+        bench_tools(int(args[1]) if len(args) > 1 else 20, "--net" in flags)
+    elif args[0] == "startup":
+        bench_startup(int(args[1]) if len(args) > 1 else 10)
+    elif args[0] == "load":
+        opts = dict(f[2:].split("=", 1) for f in flags if "=" in f)
+        bench_load(int(args[1]) if len(args) > 1 else 4,
+                   int(args[2]) if len(args) > 2 else 10,
+                   drive_main="--main" in flags, tools="--tools" in flags,
+                   provider=opts.get("provider", "anthropic"),
+                   latency_ms=float(opts.get("latency", 0)),
+                   error_rate=float(opts.get("errors", 0)))
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
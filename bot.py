@@ -8,7 +8,8 @@ import json
 import subprocess
 import time
 import os
-import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Try importing requests
 try:
@@ -20,6 +21,8 @@ except ImportError:
 
 BOT_TOKEN = None
 UPDATE_OFFSET = 0
+POLL_TIMEOUT = 30   # seconds Telegram holds a getUpdates call open
+MAX_WORKERS = 4     # chats processed in parallel
 
 def load_config():
     global BOT_TOKEN
@@ -31,14 +34,14 @@ def load_config():
     BOT_TOKEN = config.get('tg_token', '')
     print(f"[bot] Token loaded: {BOT_TOKEN[:10]}...")
 
-def api_request(url, data=None):
+def api_request(url, data=None, timeout=30):
     """Make HTTP request to Telegram API"""
     if HAS_REQUESTS:
         try:
             if data:
-                resp = requests.post(url, json=data, timeout=30)
+                resp = requests.post(url, json=data, timeout=timeout)
             else:
-                resp = requests.get(url, timeout=30)
+                resp = requests.get(url, timeout=timeout)
             return resp.json()
         except Exception as e:
             print(f"[bot] Request error: {e}")
@@ -54,34 +57,32 @@ def api_request(url, data=None):
             else:
                 req = urllib.request.Request(url)
 
-            with urllib.request.urlopen(req, timeout=30) as resp:
+            with urllib.request.urlopen(req, timeout=timeout) as resp:
                 return json.loads(resp.read().decode())
         except Exception as e:
             print(f"[bot] Request error: {e}")
             return None
 
 def get_updates():
-    """Poll for new messages"""
+    """Long-poll for new messages. Returns every pending update (possibly
+    an empty list), or None if the request failed."""
     global UPDATE_OFFSET
 
     url = f"https://api.telegram.org/bot{BOT_TOKEN}/getUpdates"
-    data = {"offset": UPDATE_OFFSET, "timeout": 30, "allowed_updates": ["message"]}
+    data = {"offset": UPDATE_OFFSET, "timeout": POLL_TIMEOUT, "allowed_updates": ["message"]}
 
-    result = api_request(url, data)
+    # HTTP timeout must outlast the long poll itself
+    result = api_request(url, data, timeout=POLL_TIMEOUT + 10)
 
     if not result or not result.get("ok"):
         return None
 
     updates = result.get("result", [])
 
-    if not updates:
-        return None
-
-    # Get first update
-    update = updates[0]
-    UPDATE_OFFSET = update["update_id"] + 1
+    if updates:
+        UPDATE_OFFSET = updates[-1]["update_id"] + 1
 
-    return update
+    return updates
 
 def send_message(chat_id, text):
     """Send message via Telegram"""
@@ -99,13 +100,19 @@ def send_message(chat_id, text):
     print(f"[bot] Sent: {text[:50]}...")
 
 def call_shell_process(message):
-    """Call the shell script to process message"""
+    """Call the shell script to process message.
+
+    The message goes in the MESSAGE environment variable and on stdin; it is
+    never interpolated into a shell command line.
+    """
     try:
-        # Create a simple wrapper script call
-        cmd = f'cd /root/microbot-ash && MESSAGE="{message}" sh process_wrapper.sh'
+        env = dict(os.environ)
+        env["MESSAGE"] = message
         result = subprocess.run(
-            cmd,
-            shell=True,
+            ["sh", "process_wrapper.sh"],
+            cwd="/root/microbot-ash",
+            env=env,
+            input=message,
             capture_output=True,
             text=True,
             timeout=120
@@ -121,49 +128,103 @@ def call_shell_process(message):
     except Exception as e:
         return f"Error: {str(e)}"
 
+def handle_update(update):
+    """Process one update and send the reply"""
+    if "message" not in update:
+        return
+
+    msg = update["message"]
+    chat_id = msg["chat"]["id"]
+    text = msg.get("text", "")
+
+    if not text:
+        return
+
+    user = msg.get("from", {})
+    username = user.get("username", "user")
+
+    print(f"\n[bot] From @{username}: {text}")
+
+    # Handle simple commands
+    if text == "/start":
+        send_message(chat_id, "Hello! I'm MicroBot. Send me a message!")
+        return
+
+    if text == "/help":
+        send_message(chat_id, "Commands: /start, /help\nJust send any message to chat!")
+        return
+
+    # Process with shell
+    response = call_shell_process(text)
+    send_message(chat_id, response)
+
+class ChatQueues:
+    """Per-chat update queues drained on a thread pool. submit() returns at
+    once, so polling never waits on a busy chat; messages within a chat keep
+    their order and at most one worker owns a chat at a time."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.queues = {}    # chat_id -> [pending updates]; present while a worker owns it
+
+    def submit(self, chat_id, update):
+        with self.lock:
+            queue = self.queues.get(chat_id)
+            if queue is not None:
+                queue.append(update)
+                return
+            self.queues[chat_id] = [update]
+        self.pool.submit(self._drain, chat_id)
+
+    def _drain(self, chat_id):
+        while True:
+            with self.lock:
+                queue = self.queues[chat_id]
+                if not queue:
+                    del self.queues[chat_id]
+                    return
+                update = queue.pop(0)
+            try:
+                handle_update(update)
+            except Exception as e:
+                print(f"[bot] Error: {e}")
+
+def process_batch(chats, updates):
+    """Hand every update from one poll to its chat's queue and return
+    without waiting: chats run in parallel, messages within a chat keep
+    their order."""
+    for update in updates:
+        chat_id = update.get("message", {}).get("chat", {}).get("id")
+        chats.submit(chat_id, update)
+
 def main():
     print("[bot] MicroBot Starting...")
     load_config()
 
     print("[bot] Polling for messages...")
 
-    while True:
-        try:
-            update = get_updates()
-
-            if update and "message" in update:
-                msg = update["message"]
-                chat_id = msg["chat"]["id"]
-                text = msg.get("text", "")
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        chats = ChatQueues(pool)
+        while True:
+            try:
+                updates = get_updates()
 
-                if not text:
+                if updates is None:
+                    # Request failed: back off briefly instead of spinning
+                    time.sleep(1)
                     continue
 
-                user = msg.get("from", {})
-                username = user.get("username", "user")
-
-                print(f"\n[bot] From @{username}: {text}")
-
-                # Handle simple commands
-                if text == "/start":
-                    send_message(chat_id, "Hello! I'm MicroBot. Send me a message!")
-                    continue
-
-                if text == "/help":
-                    send_message(chat_id, "Commands: /start, /help\nJust send any message to chat!")
-                    continue
-
-                # Process with shell
-                response = call_shell_process(text)
-                send_message(chat_id, response)
-
-        except KeyboardInterrupt:
-            print("\n[bot] Stopping...")
-            break
-        except Exception as e:
-            print(f"[bot] Error: {e}")
+                # An empty result just means the long poll timed out
+                if updates:
+                    process_batch(chats, updates)
 
-        time.sleep(2)
+            except KeyboardInterrupt:
+                print("\n[bot] Stopping...")
+                break
+            except Exception as e:
+                print(f"[bot] Error: {e}")
+                time.sleep(1)
 
 if __name__ == "__main__":
     main()
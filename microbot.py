@@ -29,6 +29,8 @@ try:
 except ImportError:
     import json
 
+import math
+
 # --- MicroPython Compatibility Layer ---
 # --- MicroPython Compatibility Layer ---
 class OSPath:
@@ -140,8 +142,178 @@ if not Path.exists(TEMP_DIR):
     except:
         pass
 
+# --- Concurrency ---
+# _thread exists on CPython and on MicroPython unix builds; without it
+# everything runs inline exactly as before.
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+class _NoLock:
+    def acquire(self, *args):
+        return True
+    def release(self):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+
+def new_lock():
+    if _thread is not None:
+        return _thread.allocate_lock()
+    return _NoLock()
+
+_tmp_lock = new_lock()
+_tmp_seq = [0]
+
+def temp_path(prefix, ext):
+    """Unique temp file name (timestamps alone collide between threads)."""
+    with _tmp_lock:
+        _tmp_seq[0] += 1
+        n = _tmp_seq[0]
+    return Path.join(TEMP_DIR, prefix + str(int(time.time())) + "_" + str(n) + ext)
+
+# --- Metrics ---
+class Metrics:
+    """Counters and latency histograms, exposed in Prometheus text format
+    (GET /metrics) and as JSON. Labels are small dicts, e.g. {"phase": "llm"}."""
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    HELP = {
+        "messages_total": "Messages processed by the agent",
+        "phase_seconds": "Time per ReAct phase (prompt, llm, parse, tools, history)",
+        "message_seconds": "End-to-end time per message",
+        "tool_seconds": "Time per tool call",
+        "tool_calls_total": "Tool calls by tool",
+        "llm_requests_total": "LLM requests by outcome",
+        "llm_endpoint_seconds": "LLM request time per router endpoint and outcome",
+        "llm_failovers_total": "Requests moved to another LLM endpoint",
+        "llm_hedges_total": "Hedged LLM requests by which copy answered first",
+        "llm_tier_seconds": "LLM request time by model tier (cheap/main)",
+        "llm_escalations_total": "Tiered turns handed from the cheap to the main model, by reason",
+        "policy_messages_total": "Messages handled under each model policy",
+        "policy_message_seconds": "Message latency under each model policy",
+        "policy_tokens_total": "LLM tokens under each model policy, by tier and type",
+        "policy_cost_usd_total": "LLM cost in USD under each model policy (models priced in llm_prices)",
+        "llm_tokens_total": "Tokens reported by the provider",
+        "tool_cache_total": "Tool result cache lookups and evictions by outcome (hit/miss/evict)",
+        "telegram_seconds": "Bot API call time by method",
+        "session_flush_seconds": "Session journal flush time",
+        "process_spawns_total": "Processes started (sh workers, popen, curl)",
+        "scheduled_jobs_total": "Scheduled jobs fired by type",
+        "deep_search_page_seconds": "deep_search time per page fetch",
+    }
+
+    def __init__(self):
+        self.lock = new_lock()
+        self.counters = {}     # name -> {label key: value}
+        self.histograms = {}   # name -> {label key: [bucket counts..., sum, count]}
+        self.log_path = None   # JSON-lines file for per-message traces
+
+    @staticmethod
+    def _key(labels):
+        if not labels:
+            return ()
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, labels=None):
+        key = self._key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, seconds, labels=None):
+        key = self._key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            h = series.get(key)
+            if h is None:
+                h = [0] * (len(self.BUCKETS) + 2)
+                series[key] = h
+            for i in range(len(self.BUCKETS)):
+                if seconds <= self.BUCKETS[i]:
+                    h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def since(self, name, t0, labels=None):
+        """Observe time.time() - t0; returns the duration."""
+        dt = time.time() - t0
+        self.observe(name, dt, labels)
+        return dt
+
+    def usage(self, usage, name="llm_tokens_total", labels=None):
+        """Count token usage from an Anthropic or OpenAI-style usage dict."""
+        if not usage:
+            return
+        details = usage.get("prompt_tokens_details") or {}
+        for kind, n in (("input", usage.get("input_tokens", usage.get("prompt_tokens"))),
+                        ("output", usage.get("output_tokens", usage.get("completion_tokens"))),
+                        ("cache_read", usage.get("cache_read_input_tokens", details.get("cached_tokens"))),
+                        ("cache_write", usage.get("cache_creation_input_tokens"))):
+            if n:
+                series = dict(labels) if labels else {}
+                series["type"] = kind
+                self.inc(name, n, series)
+
+    @staticmethod
+    def _labels(key, extra=""):
+        parts = [k + '="' + str(v).replace('"', "'") + '"' for k, v in key]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def prometheus(self):
+        out = []
+        with self.lock:
+            for name in sorted(self.counters):
+                full = "microbot_" + name
+                out.append("# HELP " + full + " " + self.HELP.get(name, name))
+                out.append("# TYPE " + full + " counter")
+                for key, v in self.counters[name].items():
+                    out.append(full + self._labels(key) + " " + str(v))
+            for name in sorted(self.histograms):
+                full = "microbot_" + name
+                out.append("# HELP " + full + " " + self.HELP.get(name, name))
+                out.append("# TYPE " + full + " histogram")
+                for key, h in self.histograms[name].items():
+                    for i in range(len(self.BUCKETS)):
+                        out.append(full + "_bucket" + self._labels(key, 'le="' + str(self.BUCKETS[i]) + '"') + " " + str(h[i]))
+                    out.append(full + "_bucket" + self._labels(key, 'le="+Inf"') + " " + str(h[-1]))
+                    out.append(full + "_sum" + self._labels(key) + " " + str(round(h[-2], 6)))
+                    out.append(full + "_count" + self._labels(key) + " " + str(h[-1]))
+        return "\n".join(out) + "\n"
+
+    def snapshot(self):
+        """JSON-friendly view: counters and histogram count/sum/avg."""
+        snap = {"counters": {}, "histograms": {}}
+        with self.lock:
+            for name in self.counters:
+                for key, v in self.counters[name].items():
+                    snap["counters"][name + self._labels(key)] = v
+            for name in self.histograms:
+                for key, h in self.histograms[name].items():
+                    snap["histograms"][name + self._labels(key)] = {
+                        "count": h[-1], "sum": round(h[-2], 6),
+                        "avg": round(h[-2] / h[-1], 6) if h[-1] else 0}
+        return snap
+
+    def log(self, record):
+        """Append one JSON record (a message trace) to the metrics log."""
+        if not self.log_path:
+            return
+        try:
+            with open(self.log_path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+        except Exception as e:
+            print("[metrics] Log write failed: " + str(e))
+
+METRICS = Metrics()
+
 def run_command(cmd):
     """Run shell command and return output. Uses os.popen or os.system fallback for MicroPython."""
+    METRICS.inc("process_spawns_total", 1, {"via": "popen"})
     # Try os.popen first (standard Python)
     if hasattr(os, 'popen'):
         try:
@@ -154,7 +326,7 @@ def run_command(cmd):
             
     # Fallback for MicroPython: use os.system and a temp file
     # We use a timestamped file in TEMP_DIR
-    tmp_file = Path.join(TEMP_DIR, "cmd_out_" + str(int(time.time())) + ".txt")
+    tmp_file = temp_path("cmd_out_", ".txt")
     try:
         # Redirect stdout and stderr to temp file
         os.system(cmd + " > " + tmp_file + " 2>&1")
@@ -187,6 +359,24 @@ def get_config_value(key):
 
     return None
 
+def load_config_file():
+    """Whole config.json as a dict; {} if missing, None if unreadable."""
+    if not Path.exists(CONFIG_FILE):
+        return {}
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        print("Error loading config.json")
+        return None
+
+def config_flag(config, key, default=False):
+    """Boolean config value; config.json stores most values as strings."""
+    val = config.get(key, default)
+    if isinstance(val, str):
+        return val.strip().lower() in ("1", "true", "yes", "on")
+    return bool(val)
+
 def urlencode(s):
     """Simple urlencode for MicroPython"""
     res = ""
@@ -202,6 +392,409 @@ def urlencode(s):
             res += "%" + h
     return res
 
+# --- HTTP Transport ---
+# Keep-alive HTTPS inside the process: no fork/exec, no temp file and no new
+# TLS handshake per request. http.client on CPython, raw sockets on MicroPython,
+# curl only when neither path can reach the host.
+try:
+    import http.client as httplib
+except ImportError:
+    httplib = None
+
+try:
+    import usocket as socket
+except ImportError:
+    try:
+        import socket
+    except ImportError:
+        socket = None
+
+try:
+    import ussl as ssl
+except ImportError:
+    try:
+        import ssl
+    except ImportError:
+        ssl = None
+
+def split_url(url):
+    """Split URL into (scheme, host, port, path). No urllib on MicroPython."""
+    scheme = "https"
+    rest = url
+    if "://" in url:
+        scheme, rest = url.split("://", 1)
+    if "/" in rest:
+        hostport, path = rest.split("/", 1)
+        path = "/" + path
+    else:
+        hostport, path = rest, "/"
+    port = 443 if scheme == "https" else 80
+    if ":" in hostport:
+        hostport, p = hostport.rsplit(":", 1)
+        try:
+            port = int(p)
+        except:
+            pass
+    return scheme, hostport, port, path
+
+def curl_request(method, url, body=None, headers=None, timeout=60, proxy=None):
+    """Fallback transport: one curl process per request (the original path)."""
+    header_args = ""
+    for k in (headers or {}):
+        header_args += " -H '" + k + ": " + str(headers[k]).replace("'", "'\\''") + "'"
+    proxy_arg = ""
+    if proxy:
+        proxy_arg = " -x \"http://" + proxy + "\""
+
+    # Write body to temp file in RAM (/tmp) to avoid shell limits
+    req_file = None
+    data_arg = ""
+    if body is not None:
+        req_file = temp_path("mimi_req_", ".json")
+        try:
+            with open(req_file, 'w') as f:
+                f.write(body)
+        except Exception as e:
+            print("Error writing request file: " + str(e))
+            return 0, ""
+        data_arg = " -d @" + req_file
+
+    cmd = "curl -k -s -m " + str(int(timeout)) + " -X " + method + proxy_arg + header_args + data_arg + " '" + url + "'"
+    resp_txt = run_command(cmd)
+
+    if req_file:
+        try:
+            os.remove(req_file)
+        except:
+            pass
+    # curl -s gives no status; a body means the server answered
+    return (200 if resp_txt else 0), resp_txt
+
+class _SocketResponse:
+    """Minimal HTTP/1.1 response reader over a (TLS) socket stream."""
+    def __init__(self, conn):
+        self.conn = conn
+        self.f = conn.f
+        line = self.f.readline()
+        if not line:
+            raise OSError("connection closed")
+        parts = line.decode().split(" ", 2)
+        self.status = int(parts[1])
+        self.headers = {}
+        while True:
+            line = self.f.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+            if b":" in line:
+                k, v = line.decode().split(":", 1)
+                self.headers[k.strip().lower()] = v.strip()
+        self.chunked = "chunked" in self.headers.get("transfer-encoding", "").lower()
+        self.length = None
+        if "content-length" in self.headers:
+            self.length = int(self.headers["content-length"])
+        self.will_close = self.headers.get("connection", "").lower() == "close" or (self.length is None and not self.chunked)
+
+        self.remaining = self.length
+        self.buf = b""
+        self.eof = False
+
+    def _read_exact(self, n):
+        buf = b""
+        while len(buf) < n:
+            chunk = self.f.read(n - len(buf))
+            if not chunk:
+                break
+            buf += chunk
+        return buf
+
+    def _fill(self):
+        """Pull the next piece of body into buf; False once the body ends."""
+        if self.eof:
+            return False
+        if self.chunked:
+            size_line = self.f.readline().strip()
+            size = int(size_line.split(b";")[0], 16) if size_line else 0
+            if size == 0:
+                # Trailer ends with an empty line
+                while True:
+                    line = self.f.readline()
+                    if not line or line in (b"\r\n", b"\n"):
+                        break
+                self.eof = True
+                return False
+            self.buf += self._read_exact(size)
+            self.f.readline()
+            return True
+        if self.remaining is not None:
+            if self.remaining <= 0:
+                self.eof = True
+                return False
+            # readline never blocks past the body, unlike read(n) on a stream
+            chunk = self.f.readline(self.remaining)
+            if chunk:
+                self.remaining -= len(chunk)
+        else:
+            chunk = self.f.readline()
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def read(self, amt=None):
+        while (amt is None or len(self.buf) < amt) and self._fill():
+            pass
+        if amt is None:
+            data, self.buf = self.buf, b""
+        else:
+            data, self.buf = self.buf[:amt], self.buf[amt:]
+        return data
+
+    def readline(self):
+        while b"\n" not in self.buf and self._fill():
+            pass
+        i = self.buf.find(b"\n")
+        if i == -1:
+            line, self.buf = self.buf, b""
+        else:
+            line, self.buf = self.buf[:i + 1], self.buf[i + 1:]
+        return line
+
+class _SocketConnection:
+    """Keep-alive connection used where http.client is unavailable (MicroPython)."""
+    def __init__(self, scheme, host, port, timeout=60, verify=False):
+        self.host = host
+        addr = socket.getaddrinfo(host, port)[0][-1]
+        self.sock = socket.socket()
+        try:
+            self.sock.settimeout(timeout)
+        except:
+            pass
+        self.sock.connect(addr)
+        if scheme == "https":
+            if hasattr(ssl, "create_default_context"):
+                ctx = ssl.create_default_context() if verify else ssl._create_unverified_context()
+                self.sock = ctx.wrap_socket(self.sock, server_hostname=host)
+            else:
+                self.sock = ssl.wrap_socket(self.sock, server_hostname=host)
+        self.f = self.sock.makefile("rb") if hasattr(self.sock, "makefile") else self.sock
+
+    def request(self, method, path, body=None, headers=None):
+        lines = [method + " " + path + " HTTP/1.1", "Host: " + self.host, "Connection: keep-alive"]
+        data = body.encode() if isinstance(body, str) else body
+        for k in (headers or {}):
+            lines.append(k + ": " + str(headers[k]))
+        if data is not None:
+            lines.append("Content-Length: " + str(len(data)))
+        raw = ("\r\n".join(lines) + "\r\n\r\n").encode()
+        if data:
+            raw += data
+        self.sock.write(raw) if hasattr(self.sock, "write") else self.sock.sendall(raw)
+
+    def getresponse(self):
+        return _SocketResponse(self)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except:
+            pass
+
+class ConnectError(Exception):
+    """A connection could not be opened: nothing was sent."""
+
+class HTTPClient:
+    """Pooled keep-alive HTTP(S) client. Idle connections are reused per host."""
+    MAX_IDLE = 4
+
+    def __init__(self, proxy=None, verify=False):
+        self.proxy = proxy      # "host:port" or None
+        self.verify = verify    # curl -k parity: no cert checks unless asked
+        self.pool = {}          # (scheme, host, port) -> [idle connections]
+        self.closed = False     # set by close(); in-flight connections are dropped on return
+        self.lock = new_lock()
+        self.native = httplib is not None or (socket is not None and ssl is not None)
+
+    def _connect(self, scheme, host, port, timeout):
+        if httplib is not None:
+            if self.proxy:
+                p_host, p_port = self.proxy.rsplit(":", 1)
+                p_port = int(p_port)
+            if scheme == "https":
+                ctx = None
+                if ssl is not None and hasattr(ssl, "create_default_context"):
+                    ctx = ssl.create_default_context() if self.verify else ssl._create_unverified_context()
+                if self.proxy:
+                    conn = httplib.HTTPSConnection(p_host, p_port, timeout=timeout, context=ctx)
+                    conn.set_tunnel(host, port)
+                    return conn
+                return httplib.HTTPSConnection(host, port, timeout=timeout, context=ctx)
+            if self.proxy:
+                conn = httplib.HTTPConnection(p_host, p_port, timeout=timeout)
+                conn.set_tunnel(host, port)
+                return conn
+            return httplib.HTTPConnection(host, port, timeout=timeout)
+        if self.proxy:
+            # Raw socket path has no CONNECT tunnelling; let curl handle proxies
+            raise OSError("proxy not supported by socket transport")
+        return _SocketConnection(scheme, host, port, timeout, self.verify)
+
+    @staticmethod
+    def _dropped(conn):
+        """True if the server closed an idle pooled connection (its socket
+        is readable: EOF). Unknown counts as alive."""
+        sock = getattr(conn, "sock", None)
+        if sock is None or select is None:
+            return False
+        try:
+            return bool(select.select([sock], [], [], 0)[0])
+        except:
+            return False
+
+    def _checkout(self, key, timeout):
+        conn = None
+        with self.lock:
+            idle = self.pool.get(key)
+            while idle:
+                conn = idle.pop()
+                if not self._dropped(conn):
+                    break
+                conn.close()
+                conn = None
+        if conn is not None:
+            try:
+                if hasattr(conn, "sock") and conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+            except:
+                pass
+            return conn, True
+        try:
+            conn = self._connect(key[0], key[1], key[2], timeout)
+            if hasattr(conn, "connect"):
+                conn.connect()   # http.client connects lazily; fail here, before sending
+        except Exception as e:
+            raise ConnectError(str(e))
+        return conn, False
+
+    def _checkin(self, key, conn):
+        with self.lock:
+            if not self.closed:   # nothing is pooled after close()
+                idle = self.pool.setdefault(key, [])
+                if len(idle) < self.MAX_IDLE:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def _exchange(self, method, url, body, headers, timeout, resend=True):
+        """Send a request and return (key, conn, response). resend=False
+        never repeats a request that may have reached the server."""
+        scheme, host, port, path = split_url(url)
+        key = (scheme, host, port)
+        for attempt in range(2):
+            conn = None
+            reused = False
+            try:
+                conn, reused = self._checkout(key, timeout)
+                conn.request(method, path, body=body, headers=headers or {})
+                return key, conn, conn.getresponse()
+            except Exception:
+                if conn is not None:
+                    conn.close()
+                # A stale pooled connection gets one retry on a fresh socket
+                if attempt == 0 and reused and resend:
+                    continue
+                raise
+
+    def _release(self, key, conn, resp, complete=True):
+        if complete and not getattr(resp, "will_close", False):
+            self._checkin(key, conn)
+        else:
+            conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=60, fallback=True):
+        """Returns (status, text). status 0 means no response at all. With
+        fallback=False there is no curl retry, and status -1 means the
+        request never left (no connection), so resending it is safe."""
+        if self.native:
+            try:
+                key, conn, resp = self._exchange(method, url, body, headers, timeout, fallback)
+                try:
+                    data = resp.read()
+                except Exception:
+                    conn.close()
+                    raise
+                self._release(key, conn, resp)
+                return resp.status, data.decode("utf-8", "replace") if isinstance(data, bytes) else data
+            except Exception as e:
+                if not fallback:
+                    print("[http] Native request failed (" + str(e) + ")")
+                    return (-1 if isinstance(e, ConnectError) else 0), ""
+                print("[http] Native request failed (" + str(e) + "), falling back to curl")
+        return curl_request(method, url, body, headers, timeout, self.proxy)
+
+    def stream(self, method, url, body=None, headers=None, timeout=60):
+        """Open a response for incremental reading, or None without a native
+        transport (curl cannot stream back into the process)."""
+        if not self.native:
+            return None
+        try:
+            key, conn, resp = self._exchange(method, url, body, headers, timeout)
+        except Exception as e:
+            print("[http] Stream open failed: " + str(e))
+            return None
+        return HTTPStream(self, key, conn, resp)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            pool = self.pool
+            self.pool = {}
+        for key in pool:
+            for conn in pool[key]:
+                conn.close()
+
+class HTTPStream:
+    """Incrementally read response. close() returns the connection to the
+    pool only when the body was read to the end."""
+    def __init__(self, client, key, conn, resp):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.done = False
+
+    def header(self, name):
+        """Response header value or None (http.client or socket response)."""
+        if hasattr(self.resp, "getheader"):
+            return self.resp.getheader(name)
+        return self.resp.headers.get(name.lower())
+
+    def readline(self):
+        line = self.resp.readline()
+        if not line:
+            self.done = True
+        return line
+
+    def read(self, amt=None):
+        data = self.resp.read(amt) if amt is not None else self.resp.read()
+        if amt is None or not data:
+            self.done = True
+        return data
+
+    def lines(self):
+        """Yield decoded lines without trailing newline until the body ends."""
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line.decode("utf-8", "replace").rstrip("\r\n")
+
+    def close(self):
+        if self.conn is not None:
+            self.client._release(self.key, self.conn, self.resp, self.done)
+            self.conn = None
+
 # --- LLM Client ---
 class LLMClient:
     def __init__(self, config):
@@ -211,28 +804,159 @@ class LLMClient:
         self.model = config.get("model", "claude-opus-4-5")
         self.or_key = config.get("openrouter_key", "")
         self.or_model = config.get("openrouter_model", "anthropic/claude-opus-4")
+        # Overridable for local stand-ins (bench.py load)
+        self.or_url = config.get("openrouter_url") or "https://openrouter.ai/api/v1/chat/completions"
+        self.anthropic_url = config.get("anthropic_url") or "https://api.anthropic.com/v1/messages"
         self.max_tokens = int(config.get("max_tokens", 1024))
+        self.timeout = float(config.get("llm_timeout", 60))
+        self.curl_fallback = True   # the router fails over instead
+        self.prompt_cache = config_flag(config, "prompt_cache", True)
+        # Structured tool calling; cleared if the model rejects tools, which
+        # puts the agent back on the TOOL: text protocol
+        self.native_tools = config_flag(config, "tool_calling", True)
+        self.tools = []   # Anthropic-style schemas, set by the agent
+
+        # Check proxy
+        proxy = config.get("proxy_host")
+        proxy_port = config.get("proxy_port")
+        self.http = HTTPClient(
+            proxy=(proxy + ":" + str(proxy_port)) if proxy and proxy_port else None,
+            verify=config_flag(config, "tls_verify", False)
+        )
         
-    def chat(self, messages, system_prompt=None):
-        """Send chat request and return response dict"""
+    def model_id(self):
+        return self.or_model if self.provider == "openrouter" else self.model
+
+    def supports_cache_control(self):
+        """OpenRouter passes cache_control through for Anthropic and Gemini
+        models; others (OpenAI, DeepSeek, ...) cache prefixes automatically."""
+        m = self.or_model.lower()
+        return m.startswith("anthropic/") or m.startswith("google/gemini")
+
+    def system_blocks(self, system_prompt):
+        """Text blocks for a [static, dynamic] prompt, static one marked cacheable."""
+        blocks = []
+        for i, part in enumerate(system_prompt):
+            if not part:
+                continue
+            block = {"type": "text", "text": part}
+            if i == 0 and self.prompt_cache:
+                block["cache_control"] = {"type": "ephemeral"}
+            blocks.append(block)
+        return blocks
+
+    def tool_specs(self):
+        """Tool schemas in the provider's request format."""
+        if self.provider == "openrouter":
+            return [{"type": "function", "function": {
+                "name": t["name"], "description": t["description"],
+                "parameters": t["input_schema"]}} for t in self.tools]
+        specs = list(self.tools)
+        if specs and self.prompt_cache:
+            # Tools precede the system prompt in the cached prefix
+            last = dict(specs[-1])
+            last["cache_control"] = {"type": "ephemeral"}
+            specs[-1] = last
+        return specs
+
+    def wire_messages(self, messages):
+        """Convert the agent's provider-neutral history to request messages.
+        
+        Tool turns are stored as
+          {"role": "assistant", "content": text, "tool_calls": [{"id", "name", "args"}]}
+          {"role": "tool", "content": [{"id", "name", "content"}]}
+        and become tool_use/tool_result blocks (Anthropic), tool_calls/tool
+        messages (OpenAI), or TOOL: lines and [Tool Result] text when native
+        tool calling is off.
+        """
+        out = []
+        # History is trimmed from the front: never start on a tool exchange
+        start = 0
+        while start < len(messages) and (messages[start].get("role") != "user"):
+            start += 1
+        native = self.native_tools and self.tools
+        prev_calls = False
+        for msg in messages[start:]:
+            role = msg.get("role")
+            calls = msg.get("tool_calls")
+            if role == "assistant" and calls:
+                prev_calls = True
+                text = msg.get("content") or ""
+                if not native:
+                    lines = ["TOOL:" + c["name"] + ":" + c["args"] for c in calls]
+                    out.append({"role": "assistant", "content": ((text + "\n") if text else "") + "\n".join(lines)})
+                elif self.provider == "openrouter":
+                    out.append({"role": "assistant", "content": text or None, "tool_calls": [
+                        {"id": c["id"], "type": "function",
+                         "function": {"name": c["name"], "arguments": c["args"]}} for c in calls]})
+                else:
+                    blocks = []
+                    if text:
+                        blocks.append({"type": "text", "text": text})
+                    for c in calls:
+                        try:
+                            args = json.loads(c["args"])
+                        except:
+                            args = {}
+                        blocks.append({"type": "tool_use", "id": c["id"], "name": c["name"], "input": args})
+                    out.append({"role": "assistant", "content": blocks})
+                continue
+            if role == "tool":
+                results = msg.get("content") or []
+                if not native or not prev_calls:
+                    out.append({"role": "user", "content": "\n\n".join(
+                        ["[Tool Result: " + r["name"] + "]\n" + r["content"] for r in results])})
+                elif self.provider == "openrouter":
+                    for r in results:
+                        out.append({"role": "tool", "tool_call_id": r["id"], "content": r["content"]})
+                else:
+                    out.append({"role": "user", "content": [
+                        {"type": "tool_result", "tool_use_id": r["id"], "content": r["content"]} for r in results]})
+                prev_calls = False
+                continue
+            prev_calls = False
+            out.append({"role": role, "content": msg.get("content", "")})
+        return out
+
+    def tools_unsupported(self, status, text):
+        """True (and native tools switched off) if a request failed because
+        the model does not accept tool definitions."""
+        if not (self.native_tools and self.tools) or status not in (400, 404, 422):
+            return False
+        if "tool" not in (text or "").lower():
+            return False
+        print("[llm] Model rejected tool definitions, using text tool protocol")
+        self.native_tools = False
+        return True
+
+    def build_request(self, messages, system_prompt=None, stream=False, tools=True):
+        """Return (url, headers, data) for the configured provider.
+        system_prompt is a string or a [static, dynamic] list; tools=False
+        leaves the tool schemas out (requests that must answer in text)."""
         url = ""
-        headers = []
+        headers = {}
         data = {}
         
         if self.provider == "openrouter":
-            url = "https://openrouter.ai/api/v1/chat/completions"
-            headers = [
-                "Content-Type: application/json",
-                "Authorization: Bearer " + self.or_key,
-                "HTTP-Referer: https://microbot-ai",
-                "X-Title: MicroBot AI"
-            ]
+            url = self.or_url
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + self.or_key,
+                "HTTP-Referer": "https://microbot-ai",
+                "X-Title": "MicroBot AI"
+            }
             
             # OpenRouter format: system prompt is a message
             msgs = []
-            if system_prompt:
+            if isinstance(system_prompt, list):
+                if self.prompt_cache and self.supports_cache_control():
+                    msgs.append({"role": "system", "content": self.system_blocks(system_prompt)})
+                else:
+                    # Static part first still hits automatic prefix caching
+                    msgs.append({"role": "system", "content": "\n".join([p for p in system_prompt if p])})
+            elif system_prompt:
                 msgs.append({"role": "system", "content": system_prompt})
-            msgs.extend(messages)
+            msgs.extend(self.wire_messages(messages))
             
             data = {
                 "model": self.or_model,
@@ -241,210 +965,2542 @@ class LLMClient:
             }
         else:
             # Anthropic
-            url = "https://api.anthropic.com/v1/messages"
-            headers = [
-                "Content-Type: application/json",
-                "x-api-key: " + self.api_key,
-                "anthropic-version: 2023-06-01"
-            ]
+            url = self.anthropic_url
+            headers = {
+                "Content-Type": "application/json",
+                "x-api-key": self.api_key,
+                "anthropic-version": "2023-06-01"
+            }
             
             data = {
                 "model": self.model,
-                "messages": messages,
+                "messages": self.wire_messages(messages),
                 "max_tokens": self.max_tokens
             }
-            if system_prompt:
+            if isinstance(system_prompt, list):
+                data["system"] = self.system_blocks(system_prompt)
+            elif system_prompt:
                 data["system"] = system_prompt
+        if tools and self.native_tools and self.tools:
+            data["tools"] = self.tool_specs()
+        if stream:
+            data["stream"] = True
+        return url, headers, data
+
+    def chat(self, messages, system_prompt=None, tools=True):
+        """Send chat request and return response dict"""
+        return self.send(messages, system_prompt, tools)[1]
+
+    def send(self, messages, system_prompt=None, tools=True):
+        """One buffered request: (HTTP status, response dict or None).
+        Status 0 means no response (timeout, connection failure)."""
+        url, headers, data = self.build_request(messages, system_prompt, tools=tools)
                 
         # Serialize JSON
         try:
             body = json.dumps(data)
         except Exception as e:
             print("Error serializing request: " + str(e))
-            return None
-            
-        # Write body to temp file in RAM (/tmp) to avoid shell limits
-        req_file = Path.join(TEMP_DIR, "mimi_req_" + str(int(time.time())) + ".json")
-        try:
-            with open(req_file, 'w') as f:
-                f.write(body)
-        except Exception as e:
-            print("Error writing request file: " + str(e))
-            return None
-
-        # Build curl command using the file
-        header_args = ""
-        for h in headers:
-            header_args += " -H '" + h + "'"
-            
-        # Check proxy
-        proxy = self.config.get("proxy_host")
-        proxy_port = self.config.get("proxy_port")
-        proxy_arg = ""
-        if proxy and proxy_port:
-            proxy_arg = " -x \"http://" + proxy + ":" + str(proxy_port) + "\""
+            return 0, None
             
-        cmd = "curl -k -s -m 60" + proxy_arg + header_args + " -d @" + req_file + " '" + url + "'"
-        
-        resp_txt = run_command(cmd)
-        
-        # Cleanup temp file
-        try:
-            os.remove(req_file)
-        except:
-            pass
+        status, resp_txt = self.http.request("POST", url, body, headers, timeout=self.timeout,
+                                             fallback=self.curl_fallback)
             
         if not resp_txt:
             print("Error: Empty LLM response (check connection or model status)")
-            return None
+            return 0, None
+
+        if tools and self.tools_unsupported(status, resp_txt):
+            return status, None
             
         # print("DEBUG: Raw Response Start: " + resp_txt) # Slices can fail on some MicroPython builds
             
         try:
-            return json.loads(resp_txt)
+            return status, json.loads(resp_txt)
         except Exception as e:
-            print("Error parsing LLM response: " + str(e))
+            print("Error parsing LLM response (HTTP " + str(status) + "): " + str(e))
             print("Full Raw Response: " + resp_txt) # Print full for debug
-            return None
-
-# --- Text cleanup for Telegram ---
-def html_escape(text):
-    """Simple HTML escape for Telegram"""
-    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-
-def strip_markdown(text):
-    """Remove markdown formatting so Telegram gets clean plain text"""
-    s = str(text)
-    # Remove bold/italic markers
-    while "**" in s:
-        s = s.replace("**", "")
-    while "__" in s:
-        s = s.replace("__", "")
-    # Remove heading markers
-    lines = s.split("\n")
-    cleaned = []
-    for line in lines:
-        stripped = line.lstrip()
-        if stripped.startswith("### "):
-            line = stripped[4:]
-        elif stripped.startswith("## "):
-            line = stripped[3:]
-        elif stripped.startswith("# "):
-            line = stripped[2:]
-        # Remove bullet dashes at start (keep content)
-        if stripped.startswith("- "):
-            line = "  " + stripped[2:]
-        cleaned.append(line)
-    s = "\n".join(cleaned)
-    # Remove code block markers
-    while "```" in s:
-        s = s.replace("```", "")
-    while "`" in s:
-        s = s.replace("`", "")
-    return s
+            return status, None
 
-# --- Agent Logic ---
-class Agent:
-    def __init__(self, config):
-        self.config = config
-        self.llm = LLMClient(config)
-        self.history = {} # chat_id -> [messages]
-        self.max_history = 10
-        self.token = config.get("tg_token")
-        
-    def get_history(self, chat_id):
-        return self.history.get(chat_id, [])
-        
-    def add_to_history(self, chat_id, role, content):
-        if chat_id not in self.history:
-            self.history[chat_id] = []
-        self.history[chat_id].append({"role": role, "content": content})
-        # Keep last 10 turns (20 messages)
-        while len(self.history[chat_id]) > 20:
-            self.history[chat_id].pop(0)
-            
-    def clear_history(self, chat_id):
-        self.history[chat_id] = []
-        
-    # All known tool names for detection (hardcoded defaults always present)
-    KNOWN_TOOLS = [
-        "web_search", "scrape_web", "get_current_time", "read_file", "write_file",
-        "edit_file", "list_dir", "system_info", "network_status", "run_command",
-        "list_services", "restart_service", "get_weather", "http_request",
-        "set_schedule", "list_schedules", "remove_schedule", "save_memory",
-        "get_sys_health", "get_wifi_status", "get_exchange_rate",
-        "set_probe", "deep_search"
-    ]
+    def chat_stream(self, messages, system_prompt=None, on_text=None):
+        """Streaming chat over SSE. on_text(text_so_far) is called per chunk and
+        may return True to stop reading early (e.g. a complete TOOL: line).
+        Returns a response dict shaped like chat() so callers stay unchanged."""
+        url, headers, data = self.build_request(messages, system_prompt, stream=True)
+        try:
+            body = json.dumps(data)
+        except Exception as e:
+            print("Error serializing request: " + str(e))
+            return None
 
-    # Cached tool descriptions (populated by load_skills at startup)
-    _cached_tool_desc = ""
+        resp = self.http.stream("POST", url, body, headers, timeout=self.timeout)
+        if resp is None:
+            # No in-process transport: the buffered path still works
+            return self.chat(messages, system_prompt)
 
-    @staticmethod
-    def load_skills():
-        """Try to load extra plugin tools from skills.sh.
-        This ONLY adds new tools on top of the hardcoded defaults.
-        If it fails, the bot works perfectly with the hardcoded list."""
+        text = ""
+        usage = {}
+        calls = {}   # stream index -> {"id", "name", "args"}
         try:
-            cmd = "cd " + SCRIPT_DIR + " && . ./config.sh && . ./skills.sh && skill_list_names"
-            result = run_command(cmd)
-            if result:
-                for name in result.split("\n"):
-                    name = name.strip()
-                    if name and name not in Agent.KNOWN_TOOLS:
-                        Agent.KNOWN_TOOLS.append(name)
-                print("[skills] " + str(len(Agent.KNOWN_TOOLS)) + " tools available")
-
-            # Cache descriptions for prompt
-            desc_cmd = "cd " + SCRIPT_DIR + " && . ./config.sh && . ./skills.sh && skill_list_descriptions"
-            desc_result = run_command(desc_cmd)
-            if desc_result and len(desc_result) > 20:
-                Agent._cached_tool_desc = desc_result
-                print("[skills] Tool descriptions cached")
-        except:
-            print("[skills] Dynamic loading skipped (not available on this system)")
+            if resp.status != 200:
+                err = resp.read()
+                if self.tools_unsupported(resp.status, err):
+                    return None
+                try:
+                    return json.loads(err)
+                except:
+                    print("Error: LLM stream HTTP " + str(resp.status) + ": " + str(err)[:200])
+                    return None
 
-    def build_system_prompt(self, user_name=None):
-        # Read unique "Soul" (Personality/Role)
-        soul_context = ""
-        soul_md_path = Path.join(SCRIPT_DIR, "data", "config", "SOUL.md")
-        if Path.exists(soul_md_path):
-            try:
-                with open(soul_md_path, 'r') as f:
-                    soul_context = f.read()[:1000]
-            except: pass
+            for line in resp.lines():
+                # SSE: only "data:" lines matter (skip comments and event names)
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                try:
+                    evt = json.loads(payload)
+                except:
+                    continue
+                delta = ""
+                if self.provider == "openrouter":
+                    choices = evt.get("choices") or []
+                    if choices:
+                        d = choices[0].get("delta") or {}
+                        delta = d.get("content") or ""
+                        for tc in d.get("tool_calls") or []:
+                            call = calls.setdefault(tc.get("index", 0), {"id": "", "name": "", "args": ""})
+                            fn = tc.get("function") or {}
+                            call["id"] = tc.get("id") or call["id"]
+                            call["name"] += fn.get("name") or ""
+                            call["args"] += fn.get("arguments") or ""
+                    if evt.get("usage"):
+                        usage = evt["usage"]
+                else:
+                    etype = evt.get("type")
+                    if etype == "content_block_delta":
+                        d = evt.get("delta") or {}
+                        delta = d.get("text") or ""
+                        if d.get("type") == "input_json_delta" and evt.get("index") in calls:
+                            calls[evt["index"]]["args"] += d.get("partial_json") or ""
+                    elif etype == "content_block_start":
+                        block = evt.get("content_block") or {}
+                        if block.get("type") == "tool_use":
+                            calls[evt.get("index", 0)] = {"id": block.get("id", ""), "name": block.get("name", ""), "args": ""}
+                    elif etype == "message_start":
+                        usage = (evt.get("message") or {}).get("usage") or {}
+                    elif etype == "message_delta" and evt.get("usage"):
+                        usage["output_tokens"] = evt["usage"].get("output_tokens", 0)
+                    elif etype == "message_stop":
+                        break
+                    elif etype == "error":
+                        print("Error: LLM stream: " + str(evt.get("error")))
+                        break
+                if delta:
+                    text += delta
+                    if on_text and on_text(text):
+                        print("[stream] Stopped early after " + str(len(text)) + " chars")
+                        break
+        except Exception as e:
+            print("Error reading LLM stream: " + str(e))
+        finally:
+            resp.close()
 
-        # Read User Profile/Context (compact)
-        user_context = ""
-        user_md_path = Path.join(SCRIPT_DIR, "data", "config", "USER.md")
-        if Path.exists(user_md_path):
+        if not text and not calls:
+            return None
+        order = sorted(calls)
+        if self.provider == "openrouter":
+            message = {"role": "assistant", "content": text}
+            if calls:
+                message["tool_calls"] = [{"id": calls[i]["id"], "type": "function", "function": {
+                    "name": calls[i]["name"], "arguments": calls[i]["args"] or "{}"}} for i in order]
+            return {"choices": [{"message": message}], "usage": usage}
+        content = [{"type": "text", "text": text}] if text else []
+        for i in order:
             try:
-                with open(user_md_path, 'r') as f:
-                    user_context = f.read()[:500]
-            except: pass
+                args = json.loads(calls[i]["args"] or "{}")
+            except:
+                args = {}
+            content.append({"type": "tool_use", "id": calls[i]["id"], "name": calls[i]["name"], "input": args})
+        return {"content": content, "usage": usage}
 
-        # Read long-term memory
-        memory_context = ""
-        mem_path = Path.join(SCRIPT_DIR, "data", "memory", "MEMORY.md")
-        if Path.exists(mem_path):
-            try:
-                with open(mem_path, 'r') as f:
-                    memory_context = f.read()[:800]
-            except: pass
+class EndpointStats:
+    """Rolling outcome/latency window for one endpoint, plus a backoff
+    after failures (5s doubling to 5 min, cleared by a success)."""
+    WINDOW = 50
 
-        name_part = ""
-        if user_name:
-            name_part = "User: " + user_name + "\n"
+    def __init__(self, name):
+        self.name = name
+        self.lock = new_lock()
+        self.latencies = []   # seconds of recent successes
+        self.outcomes = []    # 1 ok / 0 failed, recent first-in order
+        self.backoff = 0
+        self.down_until = 0
 
-        # Use cached descriptions if available, otherwise use simple list
-        if self._cached_tool_desc:
-            tools_section = "Available tools:\n" + self._cached_tool_desc
-        else:
-            tools_section = "Available tools: " + ", ".join(self.KNOWN_TOOLS)
+    def record(self, ok, seconds):
+        with self.lock:
+            self.outcomes.append(1 if ok else 0)
+            if len(self.outcomes) > self.WINDOW:
+                self.outcomes.pop(0)
+            if ok:
+                self.latencies.append(seconds)
+                if len(self.latencies) > self.WINDOW:
+                    self.latencies.pop(0)
+                self.backoff = 0
+                self.down_until = 0
+            else:
+                self.backoff = min(300, max(5, self.backoff * 2))
+                self.down_until = time.time() + self.backoff
 
-        prompt = """# MicroBot AI
-Personal assistant on OpenWrt. Plain text only, no markdown.
-""" + name_part + """
-## CRITICAL TOOL RULES
+    def p95(self):
+        """95th percentile latency, or None with fewer than 10 samples."""
+        with self.lock:
+            lat = sorted(self.latencies)
+        if len(lat) < 10:
+            return None
+        return lat[int(0.95 * (len(lat) - 1))]
+
+    def error_rate(self):
+        with self.lock:
+            n = len(self.outcomes)
+            return (n - sum(self.outcomes)) / float(n) if n else 0.0
+
+    def snapshot(self):
+        p95 = self.p95()
+        with self.lock:
+            lat = sorted(self.latencies)
+            p50 = lat[len(lat) // 2] if lat else None
+            down = max(0, int(self.down_until - time.time()))
+        return {"endpoint": self.name, "p50": p50, "p95": p95, "error_rate": round(self.error_rate(), 3),
+                "samples": len(self.outcomes), "backoff_left": down}
+
+def endpoint_config(config, ep):
+    """LLMClient config for one llm_endpoints entry: the top-level config
+    with the entry's provider/model/key/url on top."""
+    cfg = dict(config)
+    cfg.update(ep)
+    provider = ep.get("provider", config.get("provider", "openrouter"))
+    cfg["provider"] = provider
+    if provider == "openrouter":
+        if ep.get("model"):
+            cfg["openrouter_model"] = ep["model"]
+        if ep.get("api_key"):
+            cfg["openrouter_key"] = ep["api_key"]
+        if ep.get("url"):
+            cfg["openrouter_url"] = ep["url"]
+    elif ep.get("url"):
+        cfg["anthropic_url"] = ep["url"]
+    if ep.get("timeout"):
+        cfg["llm_timeout"] = ep["timeout"]
+    return cfg
+
+class LLMRouter:
+    """Ordered provider/model endpoints behind the LLMClient interface.
+
+    Endpoints come from config "llm_endpoints" (list of {"provider",
+    "model", "api_key", "url", "timeout"}), in order of preference. A
+    request goes to the first endpoint not in backoff; a timeout, 429 or
+    5xx (or an unparseable reply) records a failure and moves on to the
+    next one. With "llm_hedge", a buffered request still unanswered after
+    the endpoint's rolling p95 is sent again to the next endpoint (the same
+    one if there is only one) and the first good response wins. Streams
+    fail over only while no text has been shown.
+    """
+    RETRY_STATUS = (0, 408, 429)
+
+    def __init__(self, config, endpoints=None):
+        eps = endpoints or config.get("llm_endpoints") or [{}]
+        self.clients = []
+        self.stats = []
+        for ep in eps:
+            client = LLMClient(endpoint_config(config, ep))
+            client.curl_fallback = len(eps) == 1
+            self.clients.append(client)
+            self.stats.append(EndpointStats(ep.get("name") or client.provider + ":" + client.model_id()))
+        self.hedge = config_flag(config, "llm_hedge", False)
+        self.lock = new_lock()
+
+    # LLMClient attributes the agent uses, applied to every endpoint
+    @property
+    def provider(self):
+        return self.clients[0].provider
+
+    def model_id(self):
+        return self.clients[0].model_id()
+
+    @property
+    def tools(self):
+        return self.clients[0].tools
+
+    @tools.setter
+    def tools(self, value):
+        for c in self.clients:
+            c.tools = value
+
+    @property
+    def native_tools(self):
+        # One endpoint rejecting tools puts all on the text protocol, so
+        # the system prompt matches whichever endpoint answers
+        for c in self.clients:
+            if not c.native_tools:
+                return False
+        return True
+
+    @native_tools.setter
+    def native_tools(self, value):
+        for c in self.clients:
+            c.native_tools = value
+
+    def order(self):
+        """Endpoint indexes: healthy ones in configured order, then those in
+        backoff, soonest to recover first."""
+        now = time.time()
+        up = [i for i in range(len(self.clients)) if self.stats[i].down_until <= now]
+        down = [i for i in range(len(self.clients)) if self.stats[i].down_until > now]
+        down.sort(key=lambda i: self.stats[i].down_until)
+        return up + down
+
+    def _attempt(self, i, messages, system_prompt, tools=True):
+        """One request to endpoint i: ("ok" | "retry" | "fail", response)."""
+        stats = self.stats[i]
+        t0 = time.time()
+        try:
+            status, resp = self.clients[i].send(messages, system_prompt, tools)
+        except Exception as e:
+            print("[router] " + stats.name + " raised: " + str(e))
+            status, resp = 0, None
+        dt = time.time() - t0
+        if status == 200 and resp and not resp.get("error"):
+            state = "ok"
+        elif status in self.RETRY_STATUS or status >= 500 or (status == 200 and not resp):
+            state = "retry"
+        else:
+            state = "fail"   # 4xx: the request itself is wrong, another endpoint won't help
+        stats.record(state == "ok", dt)
+        METRICS.observe("llm_endpoint_seconds", dt, {"endpoint": stats.name, "outcome": state})
+        if state != "ok":
+            print("[router] " + stats.name + " -> HTTP " + str(status) + " (" + state + ")")
+        return state, resp
+
+    def send(self, messages, system_prompt=None, tools=True):
+        state, resp = self._route(messages, system_prompt, tools)
+        return (200 if state == "ok" else 0), resp
+
+    def chat(self, messages, system_prompt=None, tools=True):
+        return self._route(messages, system_prompt, tools)[1]
+
+    def _route(self, messages, system_prompt, tools=True):
+        order = self.order()
+        if self.hedge and _thread is not None:
+            return self._hedged(order, messages, system_prompt, tools)
+        state, resp = "retry", None
+        for n in range(len(order)):
+            if n:
+                METRICS.inc("llm_failovers_total", 1, {"to": self.stats[order[n]].name})
+            state, resp = self._attempt(order[n], messages, system_prompt, tools)
+            if state != "retry":
+                break
+        return state, resp
+
+    def _hedged(self, order, messages, system_prompt, tools=True):
+        lock = new_lock()
+        results = []   # (index in launch order, state, resp)
+        launched = []
+
+        def run(k, i):
+            state, resp = self._attempt(i, messages, system_prompt, tools)
+            with lock:
+                results.append((k, state, resp))
+
+        def launch(i):
+            launched.append(i)
+            _thread.start_new_thread(run, (len(launched) - 1, i))
+
+        nxt = 1
+        launch(order[0])
+        p95 = self.stats[order[0]].p95()
+        hedge_at = time.time() + p95 if p95 is not None else None
+        while True:
+            with lock:
+                done = list(results)
+            for k, state, resp in done:
+                if state == "ok":
+                    if len(launched) > 1:
+                        METRICS.inc("llm_hedges_total", 1, {"winner": "first" if k == 0 else "hedge"})
+                    return state, resp
+                if state == "fail":
+                    return state, resp
+            if len(done) == len(launched):
+                # Everything in flight failed: fail over
+                if nxt >= len(order):
+                    return (done[-1][1], done[-1][2]) if done else ("retry", None)
+                METRICS.inc("llm_failovers_total", 1, {"to": self.stats[order[nxt]].name})
+                launch(order[nxt])
+                nxt += 1
+                hedge_at = None
+            elif hedge_at is not None and time.time() >= hedge_at:
+                hedge_at = None
+                target = order[nxt] if nxt < len(order) else (order[0] if len(order) == 1 else None)
+                if target is not None:
+                    print("[router] Hedging after " + str(int(p95 * 1000)) + "ms to " + self.stats[target].name)
+                    nxt += 1
+                    launch(target)
+            time.sleep(0.01)
+
+    def chat_stream(self, messages, system_prompt=None, on_text=None):
+        """Streams go to one endpoint at a time; fail over only while
+        nothing has been passed to on_text."""
+        shown = [False]
+
+        def watch(text):
+            shown[0] = True
+            return on_text(text) if on_text else False
+
+        resp = None
+        order = self.order()
+        for n in range(len(order)):
+            i = order[n]
+            if n:
+                METRICS.inc("llm_failovers_total", 1, {"to": self.stats[i].name})
+            t0 = time.time()
+            resp = self.clients[i].chat_stream(messages, system_prompt, watch)
+            ok = bool(resp) and not resp.get("error") and resp.get("type") != "error"
+            self.stats[i].record(ok, time.time() - t0)
+            METRICS.observe("llm_endpoint_seconds", time.time() - t0,
+                            {"endpoint": self.stats[i].name, "outcome": "ok" if ok else "retry"})
+            if ok or shown[0]:
+                return resp
+        return resp
+
+    def report(self):
+        return [s.snapshot() for s in self.stats]
+
+def carry_llm_state(new, old):
+    """Config reload: hand the old LLM client's connection pools (same proxy
+    and TLS settings) and the router's per-endpoint latency/backoff stats
+    (same endpoint name) to the new client. Pools nobody took are closed."""
+    if old is None:
+        return
+    olds = old.clients if isinstance(old, LLMRouter) else [old]
+    news = new.clients if isinstance(new, LLMRouter) else [new]
+    kept = []
+    for c in news:
+        for o in olds:
+            if o.http.proxy == c.http.proxy and o.http.verify == c.http.verify and not o.http.closed:
+                c.http = o.http
+                if o.http not in kept:
+                    kept.append(o.http)
+                break
+    for o in olds:
+        if o.http not in kept:
+            o.http.close()
+    if isinstance(new, LLMRouter) and isinstance(old, LLMRouter):
+        by_name = {}
+        for st in old.stats:
+            by_name[st.name] = st
+        for i in range(len(new.stats)):
+            if new.stats[i].name in by_name:
+                new.stats[i] = by_name[new.stats[i].name]
+
+def tier_config(config, cheap):
+    """Config for the cheap tool-selection model: "cheap_model" is a model
+    name on the main provider or an endpoint dict like llm_endpoints'."""
+    cfg = endpoint_config(config, cheap if isinstance(cheap, dict) else {"model": cheap})
+    cfg.pop("llm_endpoints", None)
+    cfg["llm_hedge"] = False
+    return cfg
+
+def make_llm(config):
+    """LLMClient for a single provider; LLMRouter when llm_endpoints or
+    llm_hedge is configured."""
+    if config.get("llm_endpoints") or config_flag(config, "llm_hedge", False):
+        return LLMRouter(config)
+    return LLMClient(config)
+
+# --- Tool Workers ---
+# A resident sh that sourced config.sh + tools.sh once; a plugin's .sh is
+# sourced into it the first time one of its tools runs (MB_LAZY_PLUGINS).
+# Each call runs in a forked subshell of it: no exec, no re-parse.
+try:
+    import subprocess
+except ImportError:
+    subprocess = None
+
+try:
+    import select
+except ImportError:
+    select = None
+
+class ShellWorker:
+    """One long-lived shell speaking a line protocol over its stdin/stdout."""
+    def __init__(self, timeout=60):
+        self.timeout = float(timeout)
+        self.proc = None
+        self.seq = 0
+        self.loaded = []   # plugin scripts sourced into this shell
+        self.generation = 0   # ToolRunner reset count when started
+
+    def start(self):
+        env = dict(os.environ)
+        env["SCRIPT_DIR"] = SCRIPT_DIR  # same DATA_DIR/MEMORY.md as the Python side
+        env["MB_LAZY_PLUGINS"] = "1"
+        self.loaded = []
+        METRICS.inc("process_spawns_total", 1, {"via": "sh_worker"})
+        self.proc = subprocess.Popen(
+            ["sh"], cwd=SCRIPT_DIR, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=env, start_new_session=True
+        )
+        boot = ". ./config.sh >/dev/null 2>&1; . ./tools.sh >/dev/null 2>&1\n"
+        self.proc.stdin.write(boot.encode())
+        self.proc.stdin.flush()
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self):
+        if self.proc is None:
+            return
+        try:
+            # Kill the whole group so curl & co. started by the tool die too
+            os.killpg(self.proc.pid, 9)
+        except:
+            try:
+                self.proc.kill()
+            except:
+                pass
+        try:
+            self.proc.wait()
+        except:
+            pass
+        self.proc = None
+
+    def run(self, cmd, plugin=None):
+        """Run one tool command, sourcing `plugin` (a plugins/*.sh path) into
+        the worker first if needed. Returns output, or None if the worker died
+        before the command was written (so it is safe to run it elsewhere)."""
+        if not self.alive():
+            self.start()
+        self.seq += 1
+        marker = "__MB_END_" + str(self.seq) + "__"
+        req = ""
+        if plugin and plugin not in self.loaded:
+            req = ". ./" + plugin + " >/dev/null 2>&1\n"
+            self.loaded.append(plugin)
+        # Subshell keeps the worker clean (cd, exit, set); stdin must not be
+        # the protocol pipe or a tool could swallow the next request.
+        req += "( " + cmd + "\n) </dev/null\nprintf '\\n%s\\n' '" + marker + "'\n"
+        try:
+            self.proc.stdin.write(req.encode())
+            self.proc.stdin.flush()
+        except Exception:
+            self.stop()
+            return None
+
+        fd = self.proc.stdout.fileno()
+        end = ("\n" + marker + "\n").encode()
+        out = b""
+        deadline = time.time() + self.timeout
+        while end not in out:
+            left = deadline - time.time()
+            if left <= 0:
+                print("[tools] Worker timed out after " + str(int(self.timeout)) + "s, restarting")
+                self.stop()
+                return "Error: Tool timed out after " + str(int(self.timeout)) + "s"
+            ready = select.select([fd], [], [], left)[0]
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                # The command may have run (or be half done): don't run it again
+                print("[tools] Worker exited mid-call, restarting")
+                self.stop()
+                return "Error: Tool worker exited while running the command"
+            out += chunk
+        return out[:out.rfind(end)].decode("utf-8", "replace").strip()
+
+class ToolRunner:
+    """Small pool of ShellWorkers. Falls back to one sh per call (the old
+    path) on MicroPython or when every worker is busy."""
+    def __init__(self, workers=2, timeout=60):
+        self.max_workers = int(workers)
+        self.timeout = float(timeout)
+        self.lock = new_lock()
+        self.idle = []
+        self.count = 0
+        self.generation = 0   # bumped by reset(); older workers are retired
+        self.resident = subprocess is not None and select is not None and self.max_workers > 0
+
+    def _checkout(self):
+        with self.lock:
+            if self.idle:
+                worker = self.idle.pop()
+                worker.timeout = self.timeout
+                return worker
+            if self.count >= self.max_workers:
+                return None
+            self.count += 1
+            generation = self.generation
+        worker = ShellWorker(self.timeout)
+        worker.generation = generation
+        return worker
+
+    def _checkin(self, worker):
+        with self.lock:
+            if worker.generation == self.generation:
+                self.idle.append(worker)
+                return
+            # Sourced the old tool library: stop it, the next call starts fresh
+            self.count -= 1
+        worker.stop()
+
+    def run(self, cmd, plugin=None):
+        worker = self._checkout() if self.resident else None
+        if worker is not None:
+            try:
+                for attempt in range(2):
+                    result = worker.run(cmd, plugin)
+                    if result is not None:
+                        return result
+                    # Dead before the command was sent: restart once and retry
+                    print("[tools] Worker exited, restarting")
+            finally:
+                self._checkin(worker)
+        prefix = "cd " + SCRIPT_DIR + " && SCRIPT_DIR=" + SCRIPT_DIR + " && MB_LAZY_PLUGINS=1 && . ./config.sh && . ./tools.sh && "
+        if plugin:
+            prefix += ". ./" + plugin + " && "
+        return run_command(prefix + cmd)
+
+    def reset(self):
+        """Stop idle workers so the next call re-sources the tool library;
+        busy ones are stopped when they are checked back in."""
+        with self.lock:
+            self.generation += 1
+            idle = self.idle
+            self.idle = []
+            self.count -= len(idle)
+        for w in idle:
+            w.stop()
+
+# --- Native Tools ---
+# In-process versions of the hot shell tools. A handler returns the tool
+# output, or None to let execute_tool fall back to the tools.sh function.
+DATA_DIR = "/data" if Path.exists("/data") else Path.join(SCRIPT_DIR, "data")
+MEMORY_FILE = Path.join(SCRIPT_DIR, "data", "memory", "MEMORY.md")
+
+tool_http = HTTPClient()
+
+def _read_text(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except:
+        return None
+
+def file_mtime(path):
+    try:
+        return os.stat(path)[8]
+    except:
+        return None
+
+def _is_dir(path):
+    try:
+        return (os.stat(path)[0] & 0x4000) != 0
+    except:
+        return False
+
+def _makedirs(path):
+    if not path or Path.exists(path):
+        return
+    _makedirs(Path.dirname(path))
+    try:
+        os.mkdir(path)
+    except:
+        pass
+
+def _in_data_dir(path):
+    return str(path).startswith(DATA_DIR)
+
+def _local_time_str(fmt_seconds=True):
+    t = time.localtime()
+    s = "%04d-%02d-%02d %02d:%02d" % (t[0], t[1], t[2], t[3], t[4])
+    if fmt_seconds:
+        s += ":%02d" % t[5]
+    return s
+
+def _format_time(t):
+    lt = time.localtime(int(t))
+    return "%04d-%02d-%02d %02d:%02d" % (lt[0], lt[1], lt[2], lt[3], lt[4])
+
+def native_read_file(args, chat_id=None):
+    path = args.get("path", "")
+    if not _in_data_dir(path):
+        return "Error: Path must start with " + DATA_DIR
+    text = _read_text(path)
+    if text is None:
+        return "Error: File not found: " + path
+    return text.strip()
+
+def native_write_file(args, chat_id=None):
+    path = args.get("path", "")
+    if not _in_data_dir(path):
+        return "Error: Path must start with " + DATA_DIR
+    _makedirs(Path.dirname(path))
+    try:
+        with open(path, 'w') as f:
+            f.write(str(args.get("content", "")) + "\n")
+    except Exception as e:
+        return "Error: Could not write " + path + ": " + str(e)
+    return "File written successfully: " + path
+
+def native_edit_file(args, chat_id=None):
+    path = args.get("path", "")
+    old = str(args.get("old_string", ""))
+    new = str(args.get("new_string", ""))
+    if not _in_data_dir(path):
+        return "Error: Path must start with " + DATA_DIR
+    text = _read_text(path)
+    if text is None:
+        return "Error: File not found: " + path
+    if not old or old not in text:
+        return "Error: old_string not found in " + path
+    try:
+        with open(path, 'w') as f:
+            f.write(text.replace(old, new, 1))
+    except Exception as e:
+        return "Error: Could not write " + path + ": " + str(e)
+    return "File edited successfully: " + path
+
+def native_list_dir(args, chat_id=None):
+    prefix = args.get("prefix", "") or DATA_DIR
+    if not _in_data_dir(prefix):
+        prefix = DATA_DIR
+    found = []
+    stack = [prefix.rstrip("/") or "/"]
+    while stack and len(found) < 50:
+        d = stack.pop(0)
+        try:
+            names = sorted(os.listdir(d))
+        except:
+            continue
+        for n in names:
+            full = Path.join(d, n)
+            if _is_dir(full):
+                stack.append(full)
+            elif len(found) < 50:
+                found.append(full)
+    return "\n".join(found)
+
+def native_get_time(args, chat_id=None):
+    return "Current time: " + _local_time_str() + " (local)"
+
+def native_system_info(args, chat_id=None):
+    uptime = _read_text("/proc/uptime")
+    meminfo = _read_text("/proc/meminfo")
+    if uptime is None or meminfo is None:
+        return None  # Not Linux: let the shell version try
+    hostname = (_read_text("/proc/sys/kernel/hostname") or "").strip()
+    up = int(float(uptime.split()[0]))
+    load = ", ".join(((_read_text("/proc/loadavg") or "0 0 0").split() + ["0", "0", "0"])[:3])
+
+    mem = {}
+    for line in meminfo.split("\n"):
+        parts = line.split()
+        if len(parts) >= 2:
+            mem[parts[0].rstrip(":")] = int(parts[1])
+    mem_total = mem.get("MemTotal", 0)
+    mem_free = mem.get("MemFree", 0)
+    mem_used = mem_total - mem_free - mem.get("Buffers", 0) - mem.get("Cached", 0)
+
+    lines = ["=== System Info ===", "Hostname: " + hostname]
+    release = _read_text("/etc/openwrt_release")
+    if release:
+        for line in release.split("\n"):
+            if line.startswith("DISTRIB_RELEASE"):
+                lines.append("OpenWrt: " + line.split("=", 1)[1].strip("'\""))
+    lines.append("Uptime: " + str(up // 86400) + "d " + str(up % 86400 // 3600) + "h " + str(up % 3600 // 60) + "m")
+    lines.append("Load: " + load)
+    lines.append("Memory: " + str(mem_used) + "/" + str(mem_total) + " KB used (" + str(mem_free) + " KB free)")
+    temp = (_read_text("/sys/class/thermal/thermal_zone0/temp") or "").strip()
+    if temp.isdigit():
+        lines.append("CPU Temp: " + str(int(temp) // 1000) + "C")
+    try:
+        st = os.statvfs("/")
+        total = st[1] * st[2] // 1024
+        free = st[1] * st[4] // 1024
+        used = total - st[1] * st[3] // 1024
+        lines.append("Disk: " + str(used) + "/" + str(total) + " KB used (" + str(free) + " KB free)")
+    except:
+        pass
+    return "\n".join(lines)
+
+def native_save_memory(args, chat_id=None):
+    fact = str(args.get("fact", "")).strip()
+    if not fact:
+        return "Error: Content required"
+    try:
+        MEMORY.add(fact)
+    except Exception as e:
+        return "Error: Could not save memory: " + str(e)
+    return "Memory saved: " + fact
+
+def native_http_request(args, chat_id=None):
+    url = args.get("url", "")
+    if not url:
+        return "Error: URL required"
+    method = str(args.get("method", "") or "GET").upper()
+    body = args.get("body", "")
+    if method == "POST" and body:
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        status, text = tool_http.request("POST", url, body,
+                                         {"Content-Type": "application/x-www-form-urlencoded"}, timeout=30)
+    else:
+        status, text = tool_http.request("GET", url, None, {"User-Agent": "curl/8"}, timeout=30)
+    text = text.strip()
+    if status <= 0:
+        return "Error: No response from " + url
+    if not 200 <= status < 300:
+        return "Error: HTTP " + str(status) + (": " + text[:500] if text else "")
+    return text
+
+# --- Web Research ---
+WEB_UA = "Mozilla/5.0 (Windows NT 10.0; rv:109.0) Gecko/20100101 Firefox/115.0"
+
+HTML_ENTITIES = {"amp": "&", "lt": "<", "gt": ">", "quot": '"', "apos": "'", "nbsp": " ",
+                 "#39": "'", "mdash": "-", "ndash": "-", "hellip": "...", "copy": "(c)",
+                 "rsquo": "'", "lsquo": "'", "rdquo": '"', "ldquo": '"', "laquo": '"', "raquo": '"',
+                 "eacute": "\u00e9", "egrave": "\u00e8", "aacute": "\u00e1", "uuml": "\u00fc",
+                 "ouml": "\u00f6", "auml": "\u00e4", "szlig": "\u00df", "euro": "\u20ac"}
+
+def html_unescape(s):
+    if "&" not in s:
+        return s
+    out = []
+    i = 0
+    while True:
+        j = s.find("&", i)
+        if j == -1:
+            out.append(s[i:])
+            break
+        k = s.find(";", j + 1)
+        if k == -1 or k - j > 8:
+            out.append(s[i:j + 1])
+            i = j + 1
+            continue
+        out.append(s[i:j])
+        name = s[j + 1:k]
+        rep = HTML_ENTITIES.get(name)
+        if rep is None and name.startswith("#"):
+            try:
+                code = int(name[2:], 16) if name[1:2] in ("x", "X") else int(name[1:])
+                rep = chr(code)
+            except:
+                rep = None
+        if rep is None:
+            out.append("&")   # not an entity: rescan after the '&'
+            i = j + 1
+            continue
+        out.append(rep)
+        i = k + 1
+    return "".join(out)
+
+def url_quote(s):
+    out = []
+    for b in str(s).encode("utf-8"):
+        c = chr(b)
+        if b < 128 and (c.isalpha() or c.isdigit() or c in "-_.~"):
+            out.append(c)
+        elif c == " ":
+            out.append("+")
+        else:
+            out.append("%%%02X" % b)
+    return "".join(out)
+
+def url_unquote(s):
+    if "%" not in s:
+        return s
+    raw = bytearray()
+    i = 0
+    while i < len(s):
+        if s[i] == "%" and i + 3 <= len(s):
+            try:
+                raw.append(int(s[i + 1:i + 3], 16))
+                i += 3
+                continue
+            except ValueError:
+                pass
+        raw.extend(s[i].encode("utf-8"))
+        i += 1
+    return bytes(raw).decode("utf-8", "replace")
+
+def _attr(tag, name):
+    """Attribute value from the inside of a tag ('' if absent)."""
+    low = tag.lower()
+    i = low.find(name + "=")
+    while i > 0 and low[i - 1] not in " \t\n\"'/":
+        i = low.find(name + "=", i + 1)
+    if i == -1:
+        return ""
+    i += len(name) + 1
+    q = tag[i:i + 1]
+    if q in ("\"", "'"):
+        end = tag.find(q, i + 1)
+        return tag[i + 1:end if end != -1 else len(tag)]
+    end = i
+    while end < len(tag) and tag[end] not in " \t\n":
+        end += 1
+    return tag[i:end]
+
+class HTMLText:
+    """Incremental HTML-to-text. feed() takes chunks as they come off the
+    socket (tags and entities may be split across chunks) and returns True
+    once `limit` characters of text are collected, so the caller can stop
+    reading. Script/style/nav/footer bodies are skipped; block tags become
+    line breaks and h1-h3 get a "# " prefix. Along the way it keeps the
+    title, meta description, h1-h3 texts and up to `max_links` hrefs."""
+    SKIP = ("script", "style", "noscript", "svg", "template", "nav", "footer")
+    BLOCK = ("p", "div", "br", "li", "tr", "td", "th", "ul", "ol", "table", "section", "article",
+             "header", "aside", "main", "blockquote", "pre", "form", "dd", "dt",
+             "h4", "h5", "h6", "hr")
+    HEADINGS = ("h1", "h2", "h3")
+    MAX_HEADINGS = 15
+
+    def __init__(self, limit=2000, max_links=0):
+        self.limit = int(limit)
+        self.max_links = int(max_links)
+        self.parts = []
+        self.size = 0
+        self.pending = ""     # unfinished tag/entity carried to the next chunk
+        self.raw = b""        # incomplete UTF-8 sequence carried likewise
+        self.skip = None      # tag whose body is being skipped
+        self.in_title = None  # text of the open <title>
+        self.title = ""
+        self.meta = ""
+        self.headings = []
+        self.heading = None   # text of the open h1-h3
+        self.links = []
+        self.full = False
+
+    def feed(self, data):
+        if self.full:
+            return True
+        if isinstance(data, bytes):
+            data = self._decode(data)
+        buf = self.pending + data
+        self.pending = ""
+        i = 0
+        n = len(buf)
+        while i < n and not self.full:
+            if self.skip:
+                end = buf.lower().find("</" + self.skip, i)
+                if end == -1:
+                    # Keep a tail in case the closing tag is split
+                    self.pending = buf[max(i, n - len(self.skip) - 2):]
+                    return False
+                self.skip = None
+                i = end
+            lt = buf.find("<", i)
+            if lt == -1:
+                tail = buf[i:]
+                amp = tail.rfind("&")
+                if amp != -1 and ";" not in tail[amp:] and len(tail) - amp < 10:
+                    self.pending = tail[amp:]
+                    tail = tail[:amp]
+                self._text(tail)
+                return self.full
+            if lt > i:
+                self._text(buf[i:lt])
+            if buf.startswith("<!--", lt):
+                end = buf.find("-->", lt + 4)
+                if end == -1:
+                    self.pending = buf[lt:]
+                    return False
+                i = end + 3
+                continue
+            gt = buf.find(">", lt + 1)
+            if gt == -1:
+                if n - lt > 4096:   # not a tag after all
+                    i = lt + 1
+                    continue
+                self.pending = buf[lt:]
+                return False
+            self._tag(buf[lt + 1:gt])
+            i = gt + 1
+        return self.full
+
+    def _decode(self, data):
+        """Decode a chunk, holding back a multibyte character that the
+        chunk boundary cut in two."""
+        data = self.raw + data
+        cut = len(data)
+        for k in range(1, min(4, len(data)) + 1):
+            b = data[-k]
+            if b & 0xC0 != 0x80:   # ASCII or lead byte
+                need = 1 if b < 0xC0 else 2 if b < 0xE0 else 3 if b < 0xF0 else 4
+                if need > k:
+                    cut = len(data) - k
+                break
+        self.raw = data[cut:]
+        return data[:cut].decode("utf-8", "replace")
+
+    def _tag(self, tag):
+        closing = tag.startswith("/")
+        name = tag.lstrip("/").split(None, 1)[0].rstrip("/").lower() if tag.strip("/ ") else ""
+        if name == "title":
+            # Pieces are joined before splitting into words: a chunk
+            # boundary can fall inside a word
+            if closing:
+                if self.in_title and not self.title:
+                    self.title = " ".join(self.in_title.split())[:200]
+                self.in_title = None
+            else:
+                self.in_title = ""
+        elif name == "meta":
+            if not self.meta and _attr(tag, "name").lower() == "description":
+                self.meta = " ".join(html_unescape(_attr(tag, "content")).split())[:300]
+        elif name == "a":
+            if not closing and len(self.links) < self.max_links:
+                href = _attr(tag, "href")
+                if href:
+                    self.links.append(html_unescape(href))
+        elif name in self.SKIP:
+            if not closing and not tag.endswith("/"):
+                self.skip = name
+        elif name in self.HEADINGS:
+            if closing:
+                words = (self.heading or "").split()[:30]
+                if words and len(self.headings) < self.MAX_HEADINGS:
+                    self.headings.append(" ".join(words))
+                self.heading = None
+                self._emit("\n")
+            else:
+                self.heading = ""
+                self._emit("\n# ")
+        elif name in self.BLOCK:
+            self._emit("\n")
+
+    def _text(self, s):
+        if not s or self.skip:
+            return
+        s = html_unescape(s)
+        if self.in_title is not None:
+            if len(self.in_title) < 400:
+                self.in_title += s
+            return
+        if self.heading is not None and len(self.heading) < 400:
+            self.heading += s
+        words = s.split()
+        if not words:
+            if s:
+                self._emit(" ")
+            return
+        chunk = " ".join(words)
+        if s[0].isspace():
+            chunk = " " + chunk
+        if s[-1].isspace():
+            chunk += " "
+        self._emit(chunk)
+
+    def _emit(self, s):
+        self.parts.append(s)
+        if s.strip():
+            self.size += len(s)
+            if self.size >= self.limit:
+                self.full = True
+
+    def text(self):
+        lines = []
+        for line in "".join(self.parts).split("\n"):
+            line = " ".join(line.split())
+            if len(line) > 2 or line.startswith("#"):
+                lines.append(line)
+        text = "\n".join(lines)
+        return text[:self.limit]
+
+# Budgets for the in-process web tools (set from config.json by Agent)
+WEB_CONFIG = {"search_key": "", "scrape_chars": 6000, "max_bytes": 1048576}
+
+def _resolve_url(base, loc):
+    if "://" in loc:
+        return loc
+    scheme, host, port, path = split_url(base)
+    origin = scheme + "://" + host + ("" if port in (80, 443) else ":" + str(port))
+    if loc.startswith("//"):
+        return scheme + ":" + loc
+    if loc.startswith("/"):
+        return origin + loc
+    return origin + path.rsplit("/", 1)[0] + "/" + loc
+
+def _host(url):
+    return split_url(url)[1].lower()
+
+def fetch_html(url, doc, timeout=15, stop_at=None, enough=None, http=None):
+    """Stream a page into `doc` (an HTMLText) in small chunks, following
+    redirects. Reading stops, and the connection is dropped instead of
+    drained, once enough(doc) holds (default: text budget full), after
+    WEB_CONFIG max_bytes or at stop_at. Returns the final HTTP status, 0 if
+    unreachable; non-HTML bodies are not read."""
+    http = http or tool_http
+    headers = {"User-Agent": WEB_UA, "Accept": "text/html,*/*;q=0.5"}
+    for hop in range(4):
+        stream = http.stream("GET", url, None, headers, timeout)
+        if stream is None:
+            return 0
+        try:
+            if stream.status in (301, 302, 303, 307, 308):
+                loc = stream.header("location")
+                if not loc:
+                    return stream.status
+                url = _resolve_url(url, loc)
+                continue
+            ctype = (stream.header("content-type") or "text/html").lower()
+            if stream.status != 200 or ("html" not in ctype and "text" not in ctype):
+                return stream.status
+            got = 0
+            while got < WEB_CONFIG["max_bytes"] and (stop_at is None or time.time() < stop_at):
+                data = stream.read(2048)
+                if not data:
+                    break
+                got += len(data)
+                doc.feed(data)
+                if enough(doc) if enough else doc.full:
+                    break
+            return stream.status
+        finally:
+            stream.close()
+    return 0
+
+def ddg_result_urls(hrefs, limit=8):
+    """Result URLs from DuckDuckGo HTML result links (the uddg= param)."""
+    urls = []
+    for href in hrefs:
+        i = href.find("uddg=")
+        if i == -1:
+            continue
+        end = href.find("&", i)
+        url = url_unquote(href[i + 5:end if end != -1 else len(href)])
+        if url.startswith("http") and url not in urls:
+            urls.append(url)
+            if len(urls) >= limit:
+                break
+    return urls
+
+def ddg_search(query, timeout=15, stop_at=None, http=None):
+    """DuckDuckGo HTML results, streamed: (status, result urls, HTMLText).
+    Stops reading once 8 result links are in."""
+    doc = HTMLText(20000, 80)
+    status = fetch_html("https://html.duckduckgo.com/html/?q=" + url_quote(query), doc, timeout, stop_at,
+                        lambda d: d.full or len(ddg_result_urls(d.links)) >= 8, http)
+    return status, ddg_result_urls(doc.links), doc
+
+class DeepSearch:
+    """deep_search as a pipeline: DuckDuckGo result URLs, then pages fetched
+    concurrently (at most `workers` at once, `per_host` per host), each read
+    incrementally into an HTMLText that stops at `page_chars`. Returns as
+    soon as `max_pages` pages have text or the deadline passes; a result
+    that fails is replaced by the next URL. Unfinished fetches are abandoned
+    and stop at their next chunk."""
+    workers = 4
+    per_host = 1
+    deadline = 15.0
+    page_chars = 2000
+
+    def __init__(self, http=None):
+        self.http = http or tool_http
+        self.lock = new_lock()
+
+    def fetch(self, url, stop_at):
+        """(title, text) of one page, or None."""
+        doc = HTMLText(self.page_chars)
+        timeout = max(1.0, min(8.0, stop_at - time.time()))
+        try:
+            status = fetch_html(url, doc, timeout, stop_at, lambda d: d.full or self.cancelled, self.http)
+        except Exception as e:
+            print("[deep_search] " + url + ": " + str(e))
+            return None
+        text = doc.text()
+        return (doc.title, text) if status == 200 and text else None
+
+    def _work(self):
+        while True:
+            with self.lock:
+                url = None
+                if not self.cancelled and self.good < self.want:
+                    for u in self.queue:
+                        if self.hosts.get(_host(u), 0) < self.per_host:
+                            url = u
+                            break
+                if url is None:
+                    if not self.queue or self.cancelled or self.good >= self.want:
+                        self.running -= 1
+                        return
+                else:
+                    self.queue.remove(url)
+                    self.hosts[_host(url)] = self.hosts.get(_host(url), 0) + 1
+            if url is None:
+                time.sleep(0.02)   # every queued URL's host is busy
+                continue
+            t0 = time.time()
+            page = None
+            try:
+                page = self.fetch(url, self.stop_at)
+            except Exception as e:
+                print("[deep_search] " + url + ": " + str(e))
+            METRICS.since("deep_search_page_seconds", t0, {"ok": "yes" if page else "no"})
+            with self.lock:
+                self.hosts[_host(url)] -= 1
+                if page and not self.cancelled:
+                    self.pages[url] = page
+                    self.good += 1
+
+    def run(self, query, max_pages=3):
+        t0 = time.time()
+        self.stop_at = t0 + float(self.deadline)
+        status, urls, doc = ddg_search(query, min(10, self.deadline), self.stop_at, self.http)
+        if not urls:
+            return "=== Deep Search: " + query + " ===\n\nNo search results found. Try a different query."
+        self.want = max_pages
+        self.queue = list(urls)
+        self.pages = {}
+        self.hosts = {}
+        self.good = 0
+        self.cancelled = False
+        self.running = min(self.workers, len(urls))
+        if _thread is None:
+            self.running = 1
+            self._work()
+        else:
+            for i in range(self.running):
+                _thread.start_new_thread(self._work, ())
+            while time.time() < self.stop_at:
+                with self.lock:
+                    if self.good >= self.want or self.running == 0:
+                        break
+                time.sleep(0.02)
+        with self.lock:
+            self.cancelled = True
+            used = [u for u in urls if u in self.pages][:max_pages]
+            pages = [self.pages[u] for u in used]
+        out = ["=== Deep Search: " + query + " ===", "", "--- Sources ---"] + used + [""]
+        for i in range(len(used)):
+            title, text = pages[i]
+            out.append("--- Source " + str(i + 1) + " ---")
+            if title:
+                out.append("Title: " + title)
+            out.append(text)
+            out.append("")
+        if not used:
+            out.append("(Could not extract content from the result pages)")
+        out.append("=== End Deep Search ===")
+        print("[deep_search] " + str(len(used)) + "/" + str(len(urls)) + " pages in " +
+              str(int((time.time() - t0) * 1000)) + "ms")
+        return "\n".join(out)
+
+def native_deep_search(args, chat_id=None):
+    if not tool_http.native:
+        return None   # curl can't stream: the plugin's pipeline does it
+    query = str(args.get("query", "")).strip()
+    if not query:
+        return "Error: Search query required"
+    try:
+        max_pages = min(8, max(1, int(args.get("max_pages") or 3)))
+    except:
+        max_pages = 3
+    return DeepSearch().run(query, max_pages)
+
+def native_scrape_web(args, chat_id=None):
+    if not tool_http.native:
+        return None
+    url = str(args.get("url", "")).strip()
+    if not url:
+        return "Error: URL required"
+    if "://" not in url:
+        url = "https://" + url
+    doc = HTMLText(WEB_CONFIG["scrape_chars"], 40)
+    try:
+        fetch_html(url, doc)
+    except Exception as e:
+        print("[scrape] " + url + ": " + str(e))
+    text = doc.text()
+    if not text:
+        return "Error: Empty or unreachable page"
+    out = []
+    if doc.title:
+        out.append("Title: " + doc.title)
+    if doc.meta:
+        out.append("Description: " + doc.meta)
+    out.append("")
+    if doc.headings:
+        out.append("=== Headings ===")
+        out.extend(["  " + h for h in doc.headings])
+        out.append("")
+    out.append("=== Content ===")
+    out.append(text)
+    links = [l for l in doc.links if l.startswith("http")][:15]
+    if links:
+        out.append("")
+        out.append("=== Links ===")
+        out.extend(links)
+    return "\n".join(out)
+
+def native_web_search(args, chat_id=None):
+    if not tool_http.native:
+        return None
+    query = str(args.get("query", "")).strip()
+    if not query:
+        return "Error: Search query required"
+    key = WEB_CONFIG["search_key"]
+    if key and key != "YOUR_API_KEY":
+        status, txt = tool_http.request("GET", "https://api.search.brave.com/res/v1/web/search?q=" + url_quote(query) + "&count=5",
+                                        None, {"Accept": "application/json", "X-Subscription-Token": key}, timeout=10)
+        try:
+            results = json.loads(txt).get("web", {}).get("results", [])
+        except:
+            results = []
+        if results:
+            lines = []
+            for r in results[:5]:
+                lines += [r.get("title", ""), r.get("url", ""), (r.get("description") or "")[:200], ""]
+            return "\n".join(lines)
+    # DuckDuckGo HTML, streamed: stops once the result links are in
+    try:
+        status, urls, doc = ddg_search(query)
+    except Exception as e:
+        print("[search] DuckDuckGo failed: " + str(e))
+        return None
+    if not status:
+        return None   # unreachable in-process: let curl try
+    return ("=== Search Results for: " + query + " ===\n\n--- Top Links ---\n" + "\n".join(urls) +
+            "\n\n--- Content Preview ---\n" + " ".join(doc.text().split())[:3000])
+
+SCHEDULER = None   # in-process Scheduler, set by main(); None = crontab tools
+
+def _schedule_chat(args, chat_id):
+    c_id = chat_id if chat_id is not None else args.get("chat_id")
+    try:
+        return int(c_id)
+    except:
+        return c_id or None
+
+def _add_schedule(job):
+    try:
+        nxt = SCHEDULER.add(job)
+    except ValueError as e:
+        return "Error: " + str(e)
+    return "\nID: " + job["id"] + "\nCron: " + job["cron"] + "\nNext run: " + _format_time(nxt)
+
+def native_set_schedule(args, chat_id=None):
+    if SCHEDULER is None:
+        return None
+    cron = args.get("cron", args.get("cron_expression", args.get("schedule", "")))
+    content = args.get("content", args.get("message", args.get("command", "")))
+    c_id = _schedule_chat(args, chat_id)
+    if not cron or not content or c_id is None:
+        return "Error: Required: cron_expression, content, chat_id"
+    job = {"id": args.get("id") or SCHEDULER.new_id("mb_"), "cron": cron, "chat_id": c_id,
+           "type": args.get("type") or "msg", "content": str(content)}
+    out = _add_schedule(job)
+    if out.startswith("Error"):
+        return out
+    return "Schedule set!" + out + "\nType: " + job["type"] + "\nContent: " + job["content"]
+
+def native_set_probe(args, chat_id=None):
+    if SCHEDULER is None:
+        return None
+    cron = args.get("cron", args.get("cron_expression", ""))
+    probe = args.get("probe", "")
+    c_id = _schedule_chat(args, chat_id)
+    if not cron or not probe or c_id is None:
+        return "Error: Required: cron_expression, probe_name, chat_id\nAvailable probes: " + ", ".join(PROBES)
+    if probe not in PROBES:
+        return "Error: Unknown probe '" + probe + "'\nAvailable: " + ", ".join(PROBES)
+    job = {"id": args.get("id") or SCHEDULER.new_id("probe_"), "cron": cron, "chat_id": c_id,
+           "type": "probe", "probe": probe, "content": str(args.get("command", ""))}
+    out = _add_schedule(job)
+    if out.startswith("Error"):
+        return out
+    return ("Proactive probe set!" + out + "\nProbe: " + probe +
+            "\nI will monitor silently and only alert you if something needs attention.")
+
+def native_list_schedules(args, chat_id=None):
+    if SCHEDULER is None:
+        return None
+    jobs = SCHEDULER.list(_schedule_chat(args, chat_id))
+    if not jobs:
+        return "No MicroBot schedules found"
+    lines = ["=== MicroBot Scheduled Tasks ==="]
+    for job, nxt in jobs:
+        lines.append("")
+        lines.append("ID: " + job["id"])
+        lines.append("  Cron: " + job["cron"])
+        if job["type"] == "probe":
+            lines.append("  Probe: " + job.get("probe", ""))
+        else:
+            lines.append("  Type: " + job["type"])
+            lines.append("  Message: " + job.get("content", ""))
+        lines.append("  Next run: " + _format_time(nxt))
+    return "\n".join(lines)
+
+def native_remove_schedule(args, chat_id=None):
+    if SCHEDULER is None:
+        return None
+    sched_id = args.get("id", "")
+    if not sched_id:
+        return "Error: Schedule ID required"
+    if not SCHEDULER.remove(sched_id, _schedule_chat(args, chat_id)):
+        return "Error: Schedule ID '" + sched_id + "' not found\nUse list_schedules to see available IDs"
+    return "Schedule '" + sched_id + "' removed successfully"
+
+NATIVE_TOOLS = {
+    "read_file": native_read_file,
+    "write_file": native_write_file,
+    "edit_file": native_edit_file,
+    "list_dir": native_list_dir,
+    "get_current_time": native_get_time,
+    "system_info": native_system_info,
+    "save_memory": native_save_memory,
+    "http_request": native_http_request,
+    "set_schedule": native_set_schedule,
+    "set_probe": native_set_probe,
+    "list_schedules": native_list_schedules,
+    "remove_schedule": native_remove_schedule,
+    "deep_search": native_deep_search,
+    "scrape_web": native_scrape_web,
+    "web_search": native_web_search,
+}
+
+# --- Long-term Memory ---
+MEMORY_STOPWORDS = set((
+    "a an and are as at be but by do does for from has have i in is it its me my "
+    "of on or so that the this to was we what when where which who will with you your"
+).split())
+
+def memory_terms(text):
+    """Lowercase alphanumeric words minus stopwords (no re on every port)."""
+    terms = []
+    word = ""
+    for c in text.lower() + " ":
+        if c.isalpha() or c.isdigit():
+            word += c
+        else:
+            if len(word) > 1 and word not in MEMORY_STOPWORDS:
+                terms.append(word)
+            word = ""
+    return terms
+
+try:
+    from array import array
+except ImportError:
+    from uarray import array
+
+class MemoryStore:
+    """Facts from MEMORY.md ("- [date] fact" lines) ranked with BM25 against
+    the user's message.
+
+    MEMORY.md stays the append-only log (the shell save_memory writes it
+    too). Its inverted index is kept next to it in MEMORY.md.idx, one line
+    per fact ("start end term:tf ..."; "@ end" marks skipped prose), and
+    appended to as facts arrive, so a restart reads terms back instead of
+    re-tokenizing the whole file. In RAM only the newest `limit` facts are
+    indexed, compactly: byte offsets into MEMORY.md and postings packed
+    into integer arrays. Fact text is read from flash for the lines a
+    search returns.
+    """
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, path, limit=5000):
+        self.path = path
+        self.idx_path = path + ".idx"
+        self.limit = int(limit)   # facts indexed in RAM (memory_index_facts)
+        self.lock = new_lock()
+        self.loaded = False
+        self._reset()
+
+    def _reset(self):
+        self.starts = array("I")  # byte offset in MEMORY.md per resident fact
+        self.lens = array("H")    # terms per resident fact
+        self.postings = {}        # term -> array of fact id << 4 | min(tf, 15)
+        self.base = 0             # id of the oldest resident fact
+        self.count = 0            # facts in the index file
+        self.total_terms = 0
+        self.offset = 0           # bytes of MEMORY.md indexed
+        self.last = None          # (start, end) of the last fact indexed
+        self.mtime = None
+
+    @staticmethod
+    def _fact(line):
+        """(stamp, text) of a fact line, None for headings and prose."""
+        line = line.strip()
+        if not (line.startswith("- ") or line.startswith("* ")):
+            return None
+        text = line[2:].strip()
+        stamp = ""
+        if text.startswith("[") and "]" in text:
+            stamp = text[1:text.index("]")]
+            text = text[text.index("]") + 1:].strip()
+        return (stamp, text) if text else None
+
+    def _add(self, start, counts):
+        fid = self.count
+        self.count += 1
+        if fid < self.base:
+            return
+        n = 0
+        for t in counts:
+            n += counts[t]
+        self.starts.append(start)
+        self.lens.append(min(n, 65535))
+        self.total_terms += n
+        for t in counts:
+            plist = self.postings.get(t)
+            if plist is None:
+                plist = array("I")
+                self.postings[t] = plist
+            plist.append(fid << 4 | min(counts[t], 15))
+
+    def _load(self):
+        """Resident index from the newest `limit` facts of MEMORY.md.idx.
+        False if the file is missing, torn or doesn't match MEMORY.md."""
+        self._reset()
+        try:
+            f = open(self.idx_path)
+        except:
+            return False
+        try:
+            total = 0
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                if not line.endswith("\n"):
+                    return False   # torn append
+                if line[0] != "@":
+                    total += 1
+            self.base = max(0, total - self.limit)
+            f.seek(0)
+            while True:
+                parts = f.readline().split()
+                if not parts:
+                    break
+                end = int(parts[1])
+                if end < self.offset:
+                    return False
+                self.offset = end
+                if parts[0] == "@":
+                    continue
+                if self.count < self.base:
+                    self.count += 1
+                    self.last = (int(parts[0]), end)
+                    continue
+                counts = {}
+                for p in parts[2:]:
+                    t, tf = p.split(":")
+                    counts[t] = int(tf)
+                self._add(int(parts[0]), counts)
+                self.last = (int(parts[0]), end)
+        except:
+            return False
+        finally:
+            f.close()
+        return self._intact()
+
+    def _intact(self):
+        """Whether the last indexed fact is still where the index says:
+        tells an append from a rewrite of MEMORY.md (memory.sh does both)."""
+        if self.last is None:
+            return True
+        start, end = self.last
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(start)
+                line = f.read(end - start)
+        except:
+            return False
+        return line.endswith(b"\n") and self._fact(line.decode("utf-8", "replace")) is not None
+
+    def _scan(self, resident=True):
+        """Index MEMORY.md past self.offset in small chunks, appending the
+        entries to the index file (resident=False: only write the file)."""
+        try:
+            f = open(self.path, 'rb')
+        except:
+            return
+        try:
+            out = open(self.idx_path, 'a')
+        except:
+            f.close()
+            return
+        try:
+            f.seek(self.offset)
+            tail = b""
+            while True:
+                data = f.read(8192)
+                if not data:
+                    break
+                data = tail + data
+                end = data.rfind(b"\n") + 1   # a torn last line waits for its newline
+                tail = data[end:]
+                if not end:
+                    continue
+                lines = []
+                pos = self.offset
+                last_end = None
+                for raw in data[:end].split(b"\n")[:-1]:
+                    start = pos
+                    pos += len(raw) + 1
+                    fact = self._fact(raw.decode("utf-8", "replace"))
+                    if fact is None:
+                        continue
+                    counts = {}
+                    for t in memory_terms(fact[1]):
+                        counts[t] = counts.get(t, 0) + 1
+                    lines.append(str(start) + " " + str(pos) + "".join([" " + t + ":" + str(counts[t]) for t in counts]))
+                    last_end = pos
+                    if resident:
+                        self._add(start, counts)
+                    else:
+                        self.count += 1
+                    self.last = (start, pos)
+                if last_end != pos:
+                    lines.append("@ " + str(pos))
+                out.write("\n".join(lines) + "\n")
+                self.offset = pos
+        finally:
+            out.close()
+            f.close()
+
+    def _rebuild(self):
+        """Index MEMORY.md from scratch (first run, or the file was rewritten)."""
+        self._reset()
+        try:
+            os.remove(self.idx_path)
+        except:
+            pass
+        self._scan(False)
+        self._load()
+
+    def refresh(self):
+        """Load the index file on first use, index lines appended since the
+        last call, rebuild if MEMORY.md was rewritten."""
+        try:
+            st = os.stat(self.path)
+        except:
+            if self.count:
+                self._reset()
+                try:
+                    os.remove(self.idx_path)
+                except:
+                    pass
+            return
+        size, mtime = st[6], st[8]
+        if not self.loaded:
+            self.loaded = True
+            if not self._load() or size < self.offset:
+                print("[memory] Indexing " + self.path)
+                self._rebuild()
+            self.mtime = mtime
+        if size == self.offset and mtime == self.mtime:
+            return
+        if size < self.offset or (mtime != self.mtime and size == self.offset) or not self._intact():
+            self._rebuild()
+        self._scan()
+        self.mtime = mtime
+        if self.count - self.base > self.limit + self.limit // 4:
+            self._load()   # drop the oldest facts from RAM
+
+    def add(self, fact):
+        with self.lock:
+            self.refresh()
+            _makedirs(Path.dirname(self.path))
+            line = "- [" + _local_time_str(False) + "] " + fact + "\n"
+            with open(self.path, 'a') as f:
+                f.write(line)
+            self.refresh()
+
+    def search(self, query, k=8, max_chars=800):
+        """Top-k facts for `query` by BM25, then the newest facts, as
+        "- [date] fact" lines within max_chars. Newest first among ties."""
+        with self.lock:
+            self.refresh()
+            n = self.count - self.base
+            if not n:
+                return ""
+            avg = float(self.total_terms) / n or 1.0
+            scores = {}
+            for t in memory_terms(query):
+                plist = self.postings.get(t)
+                # Terms in most facts carry ~zero idf; skipping them keeps
+                # the work proportional to the rare terms
+                if not plist or len(plist) * 2 > n:
+                    continue
+                idf = math.log(1 + (n - len(plist) + 0.5) / (len(plist) + 0.5))
+                for p in plist:
+                    i = p >> 4
+                    tf = p & 15
+                    norm = tf + self.K1 * (1 - self.B + self.B * self.lens[i - self.base] / avg)
+                    scores[i] = scores.get(i, 0) + idf * tf * (self.K1 + 1) / norm
+            picked = sorted(scores, key=lambda i: (scores[i], i), reverse=True)[:k]
+            # Fill what's left with the most recent facts
+            i = self.count - 1
+            while i >= self.base and len(picked) < k * 2:
+                if i not in picked:
+                    picked.append(i)
+                i -= 1
+            lines = []
+            used = 0
+            try:
+                f = open(self.path, 'rb')
+            except:
+                return ""
+            try:
+                for i in picked:
+                    f.seek(self.starts[i - self.base])
+                    raw = f.read(max_chars + 64)
+                    nl = raw.find(b"\n")
+                    if nl == -1:
+                        continue   # longer than the whole budget
+                    fact = self._fact(raw[:nl].decode("utf-8", "replace"))
+                    if fact is None:
+                        continue
+                    line = "- " + ("[" + fact[0] + "] " if fact[0] else "") + fact[1]
+                    if used + len(line) + 1 > max_chars:
+                        continue
+                    lines.append(line)
+                    used += len(line) + 1
+            finally:
+                f.close()
+            return "\n".join(lines)
+
+MEMORY = MemoryStore(MEMORY_FILE)
+
+# --- Session Persistence ---
+class SessionStore:
+    """Write-behind chat history store.
+
+    Each chat has a snapshot (<chat_id>.json, the original format) plus an
+    append-only journal (<chat_id>.log, one JSON message per line). New
+    messages are buffered in RAM and appended in batches: on a timer, after
+    `flush_records` messages, or on shutdown. Once a journal holds
+    `compact_records` lines the snapshot is rewritten and the journal dropped.
+    A crash loses at most the last flush window.
+
+    A {"role": "digest", "drop": n} record (written when the context window
+    evicts old turns) replaces the chat's digest and drops its n oldest
+    messages on replay; in a snapshot the digest is the first element.
+    """
+
+    def __init__(self, path_fn, snapshot_fn, flush_interval=5, flush_records=20, compact_records=100):
+        self.path_fn = path_fn            # chat_id -> snapshot path
+        self.snapshot_fn = snapshot_fn    # chat_id -> current message list
+        self.flush_interval = float(flush_interval)
+        self.flush_records = int(flush_records)
+        self.compact_records = int(compact_records)
+        self.lock = new_lock()
+        self.io_lock = new_lock()
+        self.pending = {}        # chat_id -> [messages not yet on flash]
+        self.pending_count = 0
+        self.journal_lines = {}  # chat_id -> lines in journal since last snapshot
+        self.last_flush = time.time()
+        self.writes = 0          # flash write operations, for diagnostics
+
+    def _journal(self, chat_id):
+        return self.path_fn(chat_id)[:-5] + ".log"
+
+    @staticmethod
+    def _replay(msgs, rec):
+        if rec.get("role") != "digest":
+            msgs.append(rec)
+            return msgs
+        if msgs and msgs[0].get("role") == "digest":
+            msgs = msgs[1:]
+        drop = int(rec.get("drop", 0))
+        return [{"role": "digest", "content": rec.get("content", "")}] + msgs[drop:]
+
+    def load(self, chat_id):
+        msgs = []
+        snap = _read_text(self.path_fn(chat_id))
+        if snap:
+            try:
+                msgs = json.loads(snap)
+            except:
+                msgs = []
+        lines = 0
+        journal = _read_text(self._journal(chat_id))
+        if journal:
+            for line in journal.split("\n"):
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except:
+                    continue  # torn last line after a crash
+                msgs = self._replay(msgs, rec)
+                lines += 1
+        with self.lock:
+            self.journal_lines[chat_id] = lines
+            for rec in self.pending.get(chat_id, []):
+                msgs = self._replay(msgs, rec)
+        return msgs
+
+    def append(self, chat_id, msg):
+        self.record(chat_id, lambda: [msg])
+
+    def record(self, chat_id, change):
+        """Run change() (which updates the in-memory chat and returns its
+        journal records) and queue the records as one step. Both happen
+        under the store lock, which compaction also holds while it takes
+        its snapshot, so a snapshot never sees half of a turn."""
+        with self.lock:
+            recs = change()
+            if recs:
+                self.pending.setdefault(chat_id, []).extend(recs)
+                self.pending_count += len(recs)
+            due = self.pending_count >= self.flush_records
+        if due:
+            self.flush()
+
+    def clear(self, chat_id):
+        with self.lock:
+            self.pending_count -= len(self.pending.pop(chat_id, []))
+            self.journal_lines[chat_id] = 0
+        with self.io_lock:
+            for f in (self.path_fn(chat_id), self._journal(chat_id)):
+                try:
+                    os.remove(f)
+                except:
+                    pass
+
+    def maybe_flush(self):
+        if self.pending_count and time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        # The batch is taken under io_lock too, so two flushes (timer thread
+        # and a worker) can't write their batches in the wrong order
+        with self.io_lock:
+            with self.lock:
+                batch = self.pending
+                self.pending = {}
+                self.pending_count = 0
+                self.last_flush = time.time()
+            if not batch:
+                return
+            t0 = time.time()
+            for chat_id in batch:
+                recs = batch[chat_id]
+                with self.lock:
+                    lines = self.journal_lines.get(chat_id, 0) + len(recs)
+                    self.journal_lines[chat_id] = lines
+                if lines >= self.compact_records and self._compact(chat_id):
+                    continue
+                self._write_journal(chat_id, recs)
+        METRICS.since("session_flush_seconds", t0)
+
+    def _write_journal(self, chat_id, recs):
+        try:
+            with open(self._journal(chat_id), 'a') as f:
+                f.write("".join([json.dumps(r) + "\n" for r in recs]))
+            self.writes += 1
+        except Exception as e:
+            print("[session] Journal write failed: " + str(e))
+
+    def release(self, chat_id):
+        """Write one chat's pending records now and forget its counters:
+        the chat is leaving RAM and load() will recount its journal."""
+        with self.lock:
+            recs = self.pending.pop(chat_id, [])
+            self.pending_count -= len(recs)
+            self.journal_lines.pop(chat_id, None)
+        if recs:
+            with self.io_lock:
+                self._write_journal(chat_id, recs)
+
+    def _compact(self, chat_id):
+        """Rewrite the snapshot from memory and drop the journal. Returns
+        False (nothing done, the caller journals the batch instead) if the
+        chat is no longer resident or the snapshot could not be written."""
+        path = self.path_fn(chat_id)
+        with self.lock:
+            # Messages queued since the batch was taken are in the snapshot too
+            snap = self.snapshot_fn(chat_id)
+            if snap is None:
+                return False
+            queued = self.pending.pop(chat_id, [])
+            self.pending_count -= len(queued)
+        try:
+            with open(path + ".tmp", 'w') as f:
+                json.dump(snap, f)
+            os.rename(path + ".tmp", path)
+            try:
+                os.remove(self._journal(chat_id))
+            except:
+                pass
+            with self.lock:
+                self.journal_lines[chat_id] = 0
+            self.writes += 1
+        except Exception as e:
+            print("[session] Compaction failed: " + str(e))
+            with self.lock:
+                # Not on flash after all: queue them again, ahead of newer ones
+                self.pending[chat_id] = queued + self.pending.get(chat_id, [])
+                self.pending_count += len(queued)
+            return False
+        return True
+
+    def run_flusher(self):
+        """Background flush timer (started on its own thread by main)."""
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.maybe_flush()
+            except Exception as e:
+                print("[session] Flush error: " + str(e))
+
+# --- Context Window ---
+try:
+    from collections import deque
+except ImportError:
+    deque = None  # ucollections.deque can't be iterated or indexed
+
+class _Ring:
+    """List-backed stand-in for deque: O(1) amortized popleft."""
+    def __init__(self):
+        self.items = []
+        self.head = 0
+
+    def append(self, x):
+        self.items.append(x)
+
+    def popleft(self):
+        x = self.items[self.head]
+        self.items[self.head] = None
+        self.head += 1
+        if self.head > 16 and self.head * 2 > len(self.items):
+            self.items = self.items[self.head:]
+            self.head = 0
+        return x
+
+    def _index(self, i):
+        return self.head + (i + len(self) if i < 0 else i)
+
+    def __getitem__(self, i):
+        return self.items[self._index(i)]
+
+    def __setitem__(self, i, x):
+        self.items[self._index(i)] = x
+
+    def __len__(self):
+        return len(self.items) - self.head
+
+    def __iter__(self):
+        return iter(self.items[self.head:])
+
+# One shared string object per role instead of one per message
+ROLES = {"user": "user", "assistant": "assistant", "tool": "tool", "system": "system"}
+
+class Msg:
+    """Compact history record (no per-message dict). get() keeps the
+    dict-style access the context code uses; to_dict() is the wire and
+    journal form."""
+    __slots__ = ("role", "content", "tool_calls")
+
+    def __init__(self, role, content, tool_calls=None):
+        self.role = ROLES.get(role, role)
+        self.content = content
+        self.tool_calls = tool_calls or None
+
+    def get(self, key, default=None):
+        v = getattr(self, key, None)
+        return default if v is None else v
+
+    def to_dict(self):
+        d = {"role": self.role, "content": self.content}
+        if self.tool_calls:
+            d["tool_calls"] = self.tool_calls
+        return d
+
+def estimate_tokens(msg):
+    """Rough input-token cost of a history message (~4 chars per token)."""
+    content = msg.get("content") or ""
+    if isinstance(content, list):
+        n = 0
+        for r in content:
+            n += len(r.get("content", "")) + len(r.get("name", "")) + 8
+    else:
+        n = len(content)
+    for c in msg.get("tool_calls") or []:
+        n += len(c.get("name", "")) + len(c.get("args", "")) + 8
+    return n // 4 + 4
+
+def _clip(text, limit):
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit] + "..."
+
+class ChatContext:
+    """One chat's history kept under an input-token budget.
+
+    Messages sit in a ring buffer with a running token estimate. When the
+    budget (or the message cap) is exceeded, tool results of finished turns
+    are shrunk first, then whole turns are evicted from the front and folded
+    into a short extractive digest that rides in the system prompt. The
+    current turn is never touched.
+    """
+    def __init__(self, budget=4000, max_messages=40, digest_chars=800, old_result_chars=300):
+        self.budget = int(budget)
+        self.max_messages = int(max_messages)
+        self.digest_chars = int(digest_chars)
+        self.old_result_chars = int(old_result_chars)
+        self.msgs = deque() if deque else _Ring()
+        self.sizes = deque() if deque else _Ring()
+        self.tokens = 0
+        self.digest = ""
+
+    def load(self, records):
+        for msg in records:
+            if msg.get("role") == "digest":
+                self.digest = msg.get("content", "")
+            else:
+                msg = Msg(msg.get("role"), msg.get("content"), msg.get("tool_calls"))
+                self.msgs.append(msg)
+                size = estimate_tokens(msg)
+                self.sizes.append(size)
+                self.tokens += size
+        self.enforce()
+
+    def add(self, msg):
+        """Append a message dict; returns how many old messages were evicted."""
+        msg = Msg(msg.get("role"), msg.get("content"), msg.get("tool_calls"))
+        self.msgs.append(msg)
+        size = estimate_tokens(msg)
+        self.sizes.append(size)
+        self.tokens += size
+        return self.enforce()
+
+    def messages(self):
+        return [m.to_dict() for m in self.msgs]
+
+    def to_list(self):
+        """Snapshot form: digest (if any) first, then the messages."""
+        head = [{"role": "digest", "content": self.digest}] if self.digest else []
+        return head + self.messages()
+
+    def nbytes(self):
+        """Approximate resident size (the token estimate is ~4 chars each)."""
+        return self.tokens * 4 + len(self.digest)
+
+    def _over(self):
+        return self.tokens > self.budget or len(self.msgs) > self.max_messages
+
+    def _last_turn(self):
+        for i in range(len(self.msgs) - 1, -1, -1):
+            if self.msgs[i].get("role") == "user":
+                return i
+        return 0
+
+    def _shrink(self, i):
+        msg = self.msgs[i]
+        results = msg.get("content")
+        limit = self.old_result_chars
+        if msg.get("role") != "tool" or not isinstance(results, list):
+            return
+        if not [r for r in results if len(r.get("content", "")) > limit]:
+            return
+        msg.content = [{"id": r.get("id"), "name": r.get("name"),
+                           "content": r.get("content", "")[:limit] + "... (trimmed)"}
+                          if len(r.get("content", "")) > limit else r for r in results]
+        size = estimate_tokens(msg)
+        self.tokens += size - self.sizes[i]
+        self.sizes[i] = size
+
+    def _summarize(self, turn):
+        user = ""
+        answer = ""
+        tools = []
+        for msg in turn:
+            role = msg.get("role")
+            if role == "user" and not user:
+                user = msg.get("content", "")
+            elif role == "assistant":
+                for c in msg.get("tool_calls") or []:
+                    if c.get("name") not in tools:
+                        tools.append(c.get("name"))
+                if not msg.get("tool_calls"):
+                    answer = msg.get("content", "")
+        line = "- User: " + _clip(user, 120)
+        if tools:
+            line += " | Tools: " + ", ".join(tools)
+        if answer:
+            line += " | Reply: " + _clip(answer, 160)
+        lines = (self.digest.split("\n") if self.digest else []) + [line]
+        while len(lines) > 1 and len("\n".join(lines)) > self.digest_chars:
+            lines.pop(0)
+        self.digest = "\n".join(lines)
+
+    def enforce(self):
+        """Bring the window back under budget; returns messages evicted."""
+        if not self._over():
+            return 0
+        last = self._last_turn()
+        for i in range(last):
+            self._shrink(i)
+            if not self._over():
+                return 0
+        dropped = 0
+        while self._over() and last > 0:
+            turn = [self.msgs.popleft()]
+            self.tokens -= self.sizes.popleft()
+            while len(self.msgs) > 1 and self.msgs[0].get("role") != "user":
+                turn.append(self.msgs.popleft())
+                self.tokens -= self.sizes.popleft()
+            dropped += len(turn)
+            last -= len(turn)
+            self._summarize(turn)
+        return dropped
+
+# --- Tool Result Cache ---
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ucollections import OrderedDict
+
+# TTL (seconds) for idempotent core tools; plugins declare "cache_ttl" in
+# their JSON. Anything without a TTL is never cached.
+CORE_CACHE_TTL = {
+    "get_weather": 600,
+    "web_search": 300,
+    "scrape_web": 300,
+}
+
+def load_cache_policy():
+    policy = dict(CORE_CACHE_TTL)
+    for meta in load_manifest()["plugins"]:
+        try:
+            if meta.get("name") and meta.get("cache_ttl"):
+                policy[meta["name"]] = int(meta["cache_ttl"])
+        except:
+            pass
+    return policy
+
+class ToolCache:
+    """LRU of tool results bounded by bytes, with per-entry expiry."""
+    def __init__(self, max_bytes=262144, policy=None):
+        self.max_bytes = int(max_bytes)
+        self.policy = policy if policy is not None else load_cache_policy()
+        self.entries = OrderedDict()   # key -> (expires_at, result)
+        self.size = 0
+        self.lock = new_lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def ttl(self, name):
+        return self.policy.get(name, 0)
+
+    @staticmethod
+    def make_key(name, args):
+        """Tool name plus normalized args: sorted keys, collapsed whitespace,
+        case-folded (except URLs, whose paths can be case-sensitive)."""
+        parts = []
+        for k in sorted(args):
+            v = args[k]
+            if isinstance(v, str):
+                v = " ".join(v.split())
+                if k != "url":
+                    v = v.lower()
+            else:
+                v = json.dumps(v)
+            parts.append(k + "=" + v)
+        return name + "|" + "&".join(parts)
+
+    def get(self, key):
+        with self.lock:
+            hit = self.entries.pop(key, None)
+            if hit is None or hit[0] < time.time():
+                if hit is not None:
+                    self.size -= len(key) + len(hit[1])
+                self.misses += 1
+                outcome = "miss"
+            else:
+                self.entries[key] = hit  # re-insert = most recently used
+                self.hits += 1
+                outcome = "hit"
+        METRICS.inc("tool_cache_total", 1, {"outcome": outcome})
+        return hit[1] if outcome == "hit" else None
+
+    def put(self, key, result, ttl):
+        # Errors are transient; don't pin them for the TTL
+        if not result or result.startswith("Error"):
+            return
+        cost = len(key) + len(result)
+        if cost > self.max_bytes:
+            return
+        evicted = 0
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(key) + len(old[1])
+            while self.entries and self.size + cost > self.max_bytes:
+                k = next(iter(self.entries))
+                v = self.entries.pop(k)
+                self.size -= len(k) + len(v[1])
+                evicted += 1
+            self.evictions += evicted
+            self.entries[key] = (time.time() + ttl, result)
+            self.size += cost
+        if evicted:
+            METRICS.inc("tool_cache_total", evicted, {"outcome": "evict"})
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "bytes": self.size}
+
+# --- Plugin Manifest ---
+MANIFEST_FILE = Path.join(TEMP_DIR, "plugin_manifest.json")
+
+def _plugin_signature(p_dir, names):
+    sig = []
+    for fn in names:
+        try:
+            st = os.stat(Path.join(p_dir, fn))
+            sig.append([fn, st[8], st[6]])
+        except:
+            pass
+    return sig
+
+def _scan_plugins(p_dir, names):
+    """Parse plugins/*.json metadata and find which .sh defines each tool."""
+    plugins = []
+    tool_files = {}
+    for fn in names:
+        path = Path.join(p_dir, fn)
+        if fn.endswith(".json"):
+            try:
+                meta = json.loads(_read_text(path) or "{}")
+            except:
+                continue
+            if meta.get("name"):
+                plugins.append(meta)
+        elif fn.endswith(".sh"):
+            for line in (_read_text(path) or "").split("\n"):
+                line = line.strip()
+                if line.startswith("tool_") and "()" in line:
+                    tool_files[line[5:line.index("(")].strip()] = "plugins/" + fn
+    return {"plugins": plugins, "tool_files": tool_files}
+
+_manifest = [None, None]   # (signature, manifest) for this process
+
+def _plugin_names(p_dir):
+    try:
+        return sorted([fn for fn in os.listdir(p_dir) if fn.endswith(".json") or fn.endswith(".sh")])
+    except:
+        return None
+
+def plugin_signature():
+    """[[file, mtime, size]] for plugins/*.json and *.sh."""
+    p_dir = Path.join(SCRIPT_DIR, "plugins")
+    return _plugin_signature(p_dir, _plugin_names(p_dir) or [])
+
+def load_manifest():
+    """Plugin manifest: {"plugins": [json metadata], "tool_files": {tool:
+    "plugins/x.sh"}}. Validated against the mtimes and sizes of plugins/*
+    and cached in TEMP_DIR, so a restart reads one file instead of every
+    plugin."""
+    p_dir = Path.join(SCRIPT_DIR, "plugins")
+    names = _plugin_names(p_dir)
+    if names is None:
+        return {"plugins": [], "tool_files": {}}
+    sig = _plugin_signature(p_dir, names)
+    if _manifest[0] == sig:
+        return _manifest[1]
+    manifest = None
+    try:
+        cached = json.loads(_read_text(MANIFEST_FILE) or "{}")
+        if cached.get("sig") == sig:
+            manifest = cached["manifest"]
+    except:
+        pass
+    if manifest is None:
+        manifest = _scan_plugins(p_dir, names)
+        try:
+            with open(MANIFEST_FILE, 'w') as f:
+                json.dump({"sig": sig, "manifest": manifest}, f)
+        except Exception as e:
+            print("[skills] Could not cache manifest: " + str(e))
+    _manifest[0] = sig
+    _manifest[1] = manifest
+    return manifest
+
+# --- Tool Schemas ---
+# Core tools (built into tools.sh / NATIVE_TOOLS): name, description,
+# {arg: description}, required args. Plugins add theirs via plugins/*.json.
+CORE_TOOLS = [
+    ("web_search", "Search the web for current information", {"query": "Search query"}, ["query"]),
+    ("scrape_web", "Fetch user-readable text from a URL", {"url": "URL to fetch"}, ["url"]),
+    ("get_current_time", "Get current date and time", {}, []),
+    ("read_file", "Read a file from the data directory", {"path": "File path"}, ["path"]),
+    ("write_file", "Write a file in the data directory", {"path": "File path", "content": "File content"}, ["path", "content"]),
+    ("edit_file", "Edit a file with find/replace", {"path": "File path", "old_string": "Text to find", "new_string": "Replacement"}, ["path", "old_string", "new_string"]),
+    ("list_dir", "List files in the data directory", {"prefix": "Optional path prefix"}, []),
+    ("system_info", "Get system info: hostname, uptime, CPU, memory, disk", {}, []),
+    ("network_status", "Get network status: WAN IP, WiFi, connected devices", {}, []),
+    ("run_command", "Execute a shell command (with safety restrictions)", {"command": "Shell command"}, ["command"]),
+    ("list_services", "List running OpenWrt services", {}, []),
+    ("restart_service", "Restart an OpenWrt service", {"service": "Service name"}, ["service"]),
+    ("get_weather", "Get current weather", {"location": "City or place"}, []),
+    ("http_request", "Make an HTTP request", {"url": "URL", "method": "GET or POST", "body": "Request body"}, ["url"]),
+    ("set_schedule", "Schedule a reminder or task", {"cron": "Cron expression (e.g. 0 9 * * *)", "content": "Message, shell command or URL", "type": "msg, cmd, url, once_msg or once_cmd", "id": "Optional schedule ID"}, ["cron", "content"]),
+    ("list_schedules", "List active schedules", {}, []),
+    ("remove_schedule", "Remove a schedule", {"id": "Schedule ID"}, ["id"]),
+    ("save_memory", "Save a fact about the user to long-term memory", {"fact": "Fact to remember"}, ["fact"]),
+]
+
+def _tool_schema(name, desc, args, required):
+    props = {}
+    for k in args:
+        props[k] = {"type": "string", "description": args[k]}
+    schema = {"type": "object", "properties": props}
+    if required:
+        schema["required"] = required
+    return {"name": name, "description": desc, "input_schema": schema}
+
+def load_tool_schemas():
+    """Schemas for the core tools plus plugins/*.json (name, description,
+    args). Arguments the agent fills in itself (chat_id) are left out."""
+    schemas = [_tool_schema(t[0], t[1], t[2], t[3]) for t in CORE_TOOLS]
+    seen = [t[0] for t in CORE_TOOLS]
+    for meta in load_manifest()["plugins"]:
+        name = meta.get("name")
+        if not name or name in seen:
+            continue
+        args = {}
+        for k, v in (meta.get("args") or {}).items():
+            if k != "chat_id":
+                args[k] = str(v)
+        schemas.append(_tool_schema(name, meta.get("description", name), args, []))
+        seen.append(name)
+    return schemas
+
+# --- Text cleanup for Telegram ---
+def html_escape(text):
+    """Simple HTML escape for Telegram"""
+    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def strip_markdown(text):
+    """Remove markdown formatting so Telegram gets clean plain text"""
+    s = str(text)
+    # Remove bold/italic markers
+    while "**" in s:
+        s = s.replace("**", "")
+    while "__" in s:
+        s = s.replace("__", "")
+    # Remove heading markers
+    lines = s.split("\n")
+    cleaned = []
+    for line in lines:
+        stripped = line.lstrip()
+        if stripped.startswith("### "):
+            line = stripped[4:]
+        elif stripped.startswith("## "):
+            line = stripped[3:]
+        elif stripped.startswith("# "):
+            line = stripped[2:]
+        # Remove bullet dashes at start (keep content)
+        if stripped.startswith("- "):
+            line = "  " + stripped[2:]
+        cleaned.append(line)
+    s = "\n".join(cleaned)
+    # Remove code block markers
+    while "```" in s:
+        s = s.replace("```", "")
+    while "`" in s:
+        s = s.replace("`", "")
+    return s
+
+# --- Agent Logic ---
+class Agent:
+    def __init__(self, config):
+        self.history = OrderedDict() # chat_id -> ChatContext, least recently used first
+        self.history_lock = new_lock()
+        self.evictions = 0
+        self.session_loads = 0
+        self.max_history = 10
+        self.tools = ToolRunner(config.get("tool_workers", 2), config.get("tool_timeout", 60))
+        self.cache = ToolCache(config.get("tool_cache_bytes", 262144))
+        self.sessions = SessionStore(
+            self._get_session_file, self._session_snapshot,
+            config.get("session_flush_interval", 5), config.get("session_flush_records", 20)
+        )
+        self._file_cache = {}              # path -> (mtime, text)
+        self._static_prompt = (None, "")   # (inputs, assembled static prompt)
+        self.tier_seq = 0                  # messages seen, for the tier_share split
+        self.llm = None                    # set by apply_config
+        self.cheap_llm = None
+        self.tool_files = load_manifest()["tool_files"]
+        self.apply_config(config)
+        self.reload_interval = float(config.get("reload_interval", 10))
+        self._reload_check = time.time()
+        self._watch_sig = self._watch_signature()
+
+    def apply_config(self, config):
+        """Settings derived from config.json (at startup and on reload)."""
+        llm = make_llm(config)
+        llm.tools = load_tool_schemas()
+        carry_llm_state(llm, self.llm)
+        self.config = config
+        self.llm = llm   # swapped as one reference: a turn sees old or new
+        # Tiered policy: a cheap model picks tools, the main model answers
+        cheap = config.get("cheap_model")
+        cheap_llm = None
+        if cheap:
+            cheap_llm = LLMClient(tier_config(config, cheap))
+            cheap_llm.tools = llm.tools
+            carry_llm_state(cheap_llm, self.cheap_llm)
+        elif self.cheap_llm is not None:
+            self.cheap_llm.http.close()
+        self.cheap_llm = cheap_llm
+        self.tier_share = float(config.get("tier_share", 1))
+        self.llm_prices = config.get("llm_prices") or {}
+        self.token = config.get("tg_token")
+        self.tools.max_workers = int(config.get("tool_workers", 2))
+        self.tools.timeout = float(config.get("tool_timeout", 60))
+        self.tools.resident = subprocess is not None and select is not None and self.tools.max_workers > 0
+        self.python_tools = config_flag(config, "python_tools", True)
+        self.tool_parallel = int(config.get("tool_parallel", 4))
+        self.memory_k = int(config.get("memory_k", 8))
+        self.memory_chars = int(config.get("memory_chars", 800))
+        MEMORY.limit = max(1, int(config.get("memory_index_facts", 5000)))
+        # Per-result cap; the context window shrinks results of older turns
+        self.tool_result_chars = int(config.get("tool_result_chars", 6000))
+        self.tool_call_timeout = float(config.get("tool_call_timeout", config.get("tool_timeout", 60)))
+        DeepSearch.deadline = float(config.get("deep_search_deadline", 15))
+        DeepSearch.workers = int(config.get("deep_search_workers", 4))
+        DeepSearch.per_host = int(config.get("deep_search_per_host", 1))
+        WEB_CONFIG["search_key"] = config.get("search_key") or ""
+        WEB_CONFIG["scrape_chars"] = int(config.get("scrape_chars", 6000))
+        WEB_CONFIG["max_bytes"] = int(config.get("scrape_max_bytes", 1048576))
+        # Resident chat histories; idle ones beyond this go back to flash
+        self.max_chats = max(1, int(config.get("session_cache_chats", 32)))
+        self.max_history_bytes = int(config.get("session_cache_bytes", 262144))
+
+    def _watch_signature(self):
+        sig = [file_mtime(CONFIG_FILE), plugin_signature()]
+        for fn in ("config.sh", "tools.sh"):
+            sig.append(file_mtime(Path.join(SCRIPT_DIR, fn)))
+        return sig
+
+    def maybe_reload(self):
+        """Hot reload, called from the main loop between updates: at most
+        every reload_interval seconds, stat config.json, plugins/* and the
+        shell libraries and swap in whatever changed. Chat history, caches
+        and in-flight work are kept. Returns True if anything was reloaded."""
+        now = time.time()
+        if now - self._reload_check < self.reload_interval:
+            return False
+        self._reload_check = now
+        sig = self._watch_signature()
+        old = self._watch_sig
+        if sig == old:
+            return False
+        self._watch_sig = sig
+
+        if sig[1] != old[1]:
+            manifest = load_manifest()
+            Agent.load_skills()
+            self.tool_files = manifest["tool_files"]
+            self.cache.policy = load_cache_policy()
+            print("[reload] Plugins changed: " + str(len(manifest["plugins"])) + " plugins")
+        if sig[0] != old[0] or sig[1] != old[1]:
+            config = load_config_file()
+            if config is None:
+                print("[reload] config.json unreadable, keeping current settings")
+                config = self.config
+            elif sig[0] != old[0]:
+                print("[reload] config.json changed")
+            self.apply_config(config)   # new LLMClient picks up new tool schemas
+            self.reload_interval = float(config.get("reload_interval", 10))
+        # Workers re-source tools.sh/config.sh/plugins on their next call
+        self.tools.reset()
+        return True
+        
+    # All known tool names for detection (hardcoded defaults always present)
+    KNOWN_TOOLS = [
+        "web_search", "scrape_web", "get_current_time", "read_file", "write_file",
+        "edit_file", "list_dir", "system_info", "network_status", "run_command",
+        "list_services", "restart_service", "get_weather", "http_request",
+        "set_schedule", "list_schedules", "remove_schedule", "save_memory",
+        "get_sys_health", "get_wifi_status", "get_exchange_rate",
+        "set_probe", "deep_search"
+    ]
+    BASE_TOOLS = list(KNOWN_TOOLS)
+
+    # Cached tool descriptions (populated by load_skills at startup)
+    _cached_tool_desc = ""
+
+    @staticmethod
+    def load_skills():
+        """Add plugin tools (plugins/*.json via the cached manifest) on top of
+        the hardcoded defaults and cache their prompt descriptions.
+        If it fails, the bot works perfectly with the hardcoded list."""
+        try:
+            manifest = load_manifest()
+            known = list(Agent.BASE_TOOLS)
+            lines = []
+            for t in CORE_TOOLS:
+                lines.append(t[0] + " - " + t[1] + (" (args: " + ", ".join(t[2]) + ")" if t[2] else ""))
+            for meta in manifest["plugins"]:
+                name = meta["name"]
+                if name not in known:
+                    known.append(name)
+                lines.append(name + " - " + meta.get("description", "No description"))
+            # Rebinding (not appending) swaps the registry in one step
+            Agent.KNOWN_TOOLS = known
+            Agent._cached_tool_desc = "\n".join(lines)
+            print("[skills] " + str(len(Agent.KNOWN_TOOLS)) + " tools available")
+        except Exception as e:
+            print("[skills] Dynamic loading skipped (" + str(e) + ")")
+
+    def _read_cached(self, path, limit):
+        """File contents cached by mtime: one stat instead of a flash read."""
+        mtime = file_mtime(path)
+        if mtime is None:
+            return ""
+        hit = self._file_cache.get(path)
+        if hit and hit[0] == mtime:
+            return hit[1]
+        text = (_read_text(path) or "")[:limit]
+        self._file_cache[path] = (mtime, text)
+        return text
+
+    def build_system_prompt(self, user_name=None, digest="", query="", llm=None):
+        """Returns [static, dynamic]. The static part (rules, tools, SOUL, USER)
+        is identical across messages so providers can cache it; per-chat and
+        fast-changing context goes in the dynamic tail. `llm` is the client
+        the prompt is for (default: the main one)."""
+        llm = llm or self.llm
+        # Read unique "Soul" (Personality/Role)
+        soul_context = self._read_cached(Path.join(SCRIPT_DIR, "data", "config", "SOUL.md"), 1000)
+
+        # Read User Profile/Context (compact)
+        user_context = self._read_cached(Path.join(SCRIPT_DIR, "data", "config", "USER.md"), 500)
+
+        # Long-term memory: the facts most relevant to this message
+        memory_context = MEMORY.search(query, self.memory_k, self.memory_chars)
+
+        # Use cached descriptions if available, otherwise use simple list
+        if self._cached_tool_desc:
+            tools_section = "Available tools:\n" + self._cached_tool_desc
+        else:
+            tools_section = "Available tools: " + ", ".join(self.KNOWN_TOOLS)
+
+        native = llm.native_tools and bool(llm.tools)
+        key = (soul_context, user_context, tools_section, native)
+        if self._static_prompt[0] != key:
+            # With native tool calling the schemas travel in the request, so
+            # the text protocol rules and tool list are left out
+            rules = "" if native else """## CRITICAL TOOL RULES
 When you need to use a tool, your ENTIRE response must be ONLY the tool call line, nothing else.
 Format: TOOL:tool_name:{"arg": "value"}
 
@@ -455,17 +3511,30 @@ TOOL:save_memory:{"fact": "user likes coffee"}
 TOOL:run_command:{"command": "uptime"}
 
 RULES:
-1. When using a tool, output ONLY the TOOL: line. Nothing before, nothing after.
+1. When using tools, output ONLY TOOL: lines. Nothing before, nothing after.
 2. NEVER make up or guess tool results. You MUST wait for the system to return the real output.
 3. After you receive a [Tool Result], use that real data to respond to the user.
-4. One tool per message.
+4. Independent tools can be called together: one TOOL: line each, they run in parallel.
 
 """ + tools_section + """
 
-## Memory
+"""
+            static = """# MicroBot AI
+Personal assistant on OpenWrt. Plain text only, no markdown.
+
+""" + rules + """## Memory
 Proactively save important user info using save_memory.
-""" + ("\n## Personality (SOUL)\n" + soul_context if soul_context else "") + ("\n## User Profile\n" + user_context if user_context else "") + ("\n## Memory\n" + memory_context if memory_context else "")
-        return prompt
+""" + ("\n## Personality (SOUL)\n" + soul_context if soul_context else "") + ("\n## User Profile\n" + user_context if user_context else "")
+            self._static_prompt = (key, static)
+
+        dynamic = ""
+        if memory_context:
+            dynamic += "## Memory\n" + memory_context + "\n"
+        if user_name:
+            dynamic += "User: " + user_name + "\n"
+        if digest:
+            dynamic += "## Earlier in this chat\n" + digest + "\n"
+        return [self._static_prompt[1], dynamic]
 
     def _get_session_file(self, chat_id):
         s_dir = Path.join(SCRIPT_DIR, "data", "sessions")
@@ -475,45 +3544,121 @@ Proactively save important user info using save_memory.
             except: pass
         return Path.join(s_dir, str(chat_id) + ".json")
 
-    def get_history(self, chat_id):
-        if chat_id in self.history:
-             return self.history[chat_id]
-        
-        # Try load from disk
-        s_file = self._get_session_file(chat_id)
-        if Path.exists(s_file):
-            try:
-                with open(s_file, 'r') as f:
-                    data = json.load(f)
-                    self.history[chat_id] = data
-                    return data
-            except: pass
-        return []
+    def new_context(self):
+        c = self.config
+        return ChatContext(
+            budget=c.get("context_tokens", 4000),
+            max_messages=c.get("context_messages", 40),
+            digest_chars=c.get("digest_chars", 800),
+            old_result_chars=c.get("old_result_chars", 300)
+        )
+
+    def get_context(self, chat_id):
+        with self.history_lock:
+            ctx = self.history.pop(chat_id, None)
+            if ctx is not None:
+                self.history[chat_id] = ctx   # most recently used
+                return ctx
         
-    def add_to_history(self, chat_id, role, content):
-        if chat_id not in self.history:
-            self.history[chat_id] = self.get_history(chat_id)
-            
-        self.history[chat_id].append({"role": role, "content": content})
-        # Keep last 10 turns (20 messages)
-        while len(self.history[chat_id]) > 20:
-            self.history[chat_id].pop(0)
-            
-        # Save to disk
-        s_file = self._get_session_file(chat_id)
+        # Try load from disk (snapshot + journal replay)
+        ctx = self.new_context()
+        ctx.load(self.sessions.load(chat_id))
+        with self.history_lock:
+            if chat_id in self.history:
+                return self.history[chat_id]
+            self.history[chat_id] = ctx
+            self.session_loads += 1
+        self._evict_idle()
+        return ctx
+
+    def _evict_idle(self):
+        """Drop least recently used chats until the resident set fits
+        max_chats / max_history_bytes. Pending journal records are written
+        first, while the chat is still resident, so a reload from flash
+        sees everything. The most recent chat always stays."""
+        while True:
+            with self.history_lock:
+                if len(self.history) <= 1:
+                    return
+                if len(self.history) <= self.max_chats:
+                    total = 0
+                    for ctx in self.history.values():
+                        total += ctx.nbytes()
+                    if total <= self.max_history_bytes:
+                        return
+                chat_id = next(iter(self.history))
+            # Not under history_lock: compaction takes the locks the other way round
+            self.sessions.release(chat_id)
+            with self.history_lock:
+                if self.history and next(iter(self.history)) == chat_id:
+                    del self.history[chat_id]
+                    self.evictions += 1
+
+    def memory_report(self):
+        """Resident history size, eviction counters and process memory."""
+        with self.history_lock:
+            chats = len(self.history)
+            msgs = 0
+            size = 0
+            for ctx in self.history.values():
+                msgs += len(ctx.msgs)
+                size += ctx.nbytes()
+        report = {
+            "chats": chats, "messages": msgs, "history_bytes": size,
+            "max_chats": self.max_chats, "max_history_bytes": self.max_history_bytes,
+            "evictions": self.evictions, "session_loads": self.session_loads,
+            "pending_records": self.sessions.pending_count,
+            "tool_cache": self.cache.stats(),
+            "memory_facts": MEMORY.count - MEMORY.base,
+        }
         try:
-            with open(s_file, 'w') as f:
-                json.dump(self.history[chat_id], f)
-        except: pass
+            import gc
+            report["heap_free"] = gc.mem_free()
+            report["heap_alloc"] = gc.mem_alloc()
+        except:
+            pass
+        for line in (_read_text("/proc/self/status") or "").split("\n"):
+            if line.startswith("VmRSS:") or line.startswith("VmHWM:"):
+                report[line[:5].lower() + "_kb"] = int(line.split()[1])
+        return report
+
+    def get_history(self, chat_id):
+        ctx = self.get_context(chat_id)
+        with self.history_lock:
+            return ctx.messages()
+        
+    def add_to_history(self, chat_id, role, content, tool_calls=None):
+        ctx = self.get_context(chat_id)
+        msg = {"role": role, "content": content}
+        if tool_calls:
+            msg["tool_calls"] = tool_calls
+        def change():
+            # history_lock keeps snapshots from racing the ring buffer; the
+            # store lock around this makes message + digest one journal step
+            with self.history_lock:
+                dropped = ctx.add(msg)
+                digest = ctx.digest
+            if dropped:
+                return [msg, {"role": "digest", "content": digest, "drop": dropped}]
+            return [msg]
+
+        # Journal it; the store writes to flash in batches
+        self.sessions.record(chat_id, change)
+        self._evict_idle()
 
     def clear_history(self, chat_id):
-        self.history[chat_id] = []
-        s_file = self._get_session_file(chat_id)
-        try:
-            os.remove(s_file)
-        except: pass
+        with self.history_lock:
+            self.history.pop(chat_id, None)
+            self.history[chat_id] = self.new_context()
+        self.sessions.clear(chat_id)
+        self._evict_idle()
+
+    def _session_snapshot(self, chat_id):
+        with self.history_lock:
+            ctx = self.history.get(chat_id)
+            return ctx.to_list() if ctx else None
 
-    def execute_tool(self, name, args_json):
+    def execute_tool(self, name, args_json, chat_id=None):
         # Parse JSON
         args = {}
         try:
@@ -532,91 +3677,112 @@ Proactively save important user info using save_memory.
              except:
                  print("WARNING: Tool args are not valid JSON: " + args_json)
                  return "Error: Invalid JSON arguments"
+
+        ttl = self.cache.ttl(name)
+        if ttl <= 0:
+            return self._run_tool(name, args, chat_id)
+        key = ToolCache.make_key(name, args)
+        result = self.cache.get(key)
+        if result is not None:
+            print("[cache] Hit " + name)
+            return result
+        result = self._run_tool(name, args, chat_id)
+        self.cache.put(key, result, ttl)
+        return result
+
+    def _run_tool(self, name, args, chat_id=None):
+        # Python-native handler first; shell implementation is the fallback
+        handler = NATIVE_TOOLS.get(name)
+        if handler and self.python_tools:
+            try:
+                result = handler(args, chat_id)
+                if result is not None:
+                    return result
+            except Exception as e:
+                print("[tools] Native " + name + " failed (" + str(e) + "), using shell")
              
         # Helper: Shell Escape
         def sh_quote(s):
             return "'" + s.replace("'", "'\\''") + "'"
             
-        cmd_base = "cd " + SCRIPT_DIR + " && . ./config.sh && . ./tools.sh && "
-        
         # Dispatch to specific shell functions with positional args
         if name == "web_search":
             query = args.get("query", "")
-            cmd = cmd_base + "tool_web_search " + sh_quote(query)
+            cmd = "tool_web_search " + sh_quote(query)
             
         elif name == "scrape_web":
             url = args.get("url", "")
-            cmd = cmd_base + "tool_scrape_web " + sh_quote(url)
+            cmd = "tool_scrape_web " + sh_quote(url)
             
         elif name == "read_file":
             path = args.get("path", "")
-            cmd = cmd_base + "tool_read_file " + sh_quote(path)
+            cmd = "tool_read_file " + sh_quote(path)
             
         elif name == "write_file":
             path = args.get("path", "")
             content = args.get("content", "")
-            cmd = cmd_base + "tool_write_file " + sh_quote(path) + " " + sh_quote(content)
+            cmd = "tool_write_file " + sh_quote(path) + " " + sh_quote(content)
             
         elif name == "edit_file":
             path = args.get("path", "")
             old = args.get("old_string", "")
             new = args.get("new_string", "")
-            cmd = cmd_base + "tool_edit_file " + sh_quote(path) + " " + sh_quote(old) + " " + sh_quote(new)
+            cmd = "tool_edit_file " + sh_quote(path) + " " + sh_quote(old) + " " + sh_quote(new)
             
         elif name == "list_dir":
             prefix = args.get("prefix", "")
-            cmd = cmd_base + "tool_list_dir " + sh_quote(prefix)
+            cmd = "tool_list_dir " + sh_quote(prefix)
             
         elif name == "system_info":
-            cmd = cmd_base + "tool_system_info"
+            cmd = "tool_system_info"
             
         elif name == "network_status":
-            cmd = cmd_base + "tool_network_status"
+            cmd = "tool_network_status"
             
         elif name == "run_command":
             c = args.get("command", "")
-            cmd = cmd_base + "tool_run_command " + sh_quote(c)
+            cmd = "tool_run_command " + sh_quote(c)
             
         elif name == "get_current_time":
-             cmd = cmd_base + "tool_get_time"
+             cmd = "tool_get_time"
              
         elif name == "get_weather":
              loc = args.get("location", "")
-             cmd = cmd_base + "tool_get_weather " + sh_quote(loc)
+             cmd = "tool_get_weather " + sh_quote(loc)
              
         elif name == "set_schedule":
              cron_expr = args.get("cron", args.get("cron_expression", args.get("schedule", "")))
              content = args.get("content", args.get("message", args.get("command", "")))
-             c_id = str(self._current_chat_id) if hasattr(self, '_current_chat_id') else ""
+             c_id = str(chat_id) if chat_id is not None else ""
              sched_id = args.get("id", "")
              task_type = args.get("type", "msg")
-             cmd = cmd_base + "tool_set_schedule " + sh_quote(cron_expr) + " " + sh_quote(content) + " " + sh_quote(c_id) + " " + sh_quote(sched_id) + " " + sh_quote(task_type)
+             cmd = "tool_set_schedule " + sh_quote(cron_expr) + " " + sh_quote(content) + " " + sh_quote(c_id) + " " + sh_quote(sched_id) + " " + sh_quote(task_type)
              
         elif name == "list_schedules":
-             cmd = cmd_base + "tool_list_schedules"
+             cmd = "tool_list_schedules"
              
         elif name == "remove_schedule":
              sched_id = args.get("id", "")
-             cmd = cmd_base + "tool_remove_schedule " + sh_quote(sched_id)
+             cmd = "tool_remove_schedule " + sh_quote(sched_id)
 
         elif name == "set_probe":
              cron_expr = args.get("cron", args.get("cron_expression", ""))
              probe_name = args.get("probe", "")
-             c_id = str(self._current_chat_id) if hasattr(self, '_current_chat_id') else ""
+             c_id = str(chat_id) if chat_id is not None else ""
              sched_id = args.get("id", "")
-             cmd = cmd_base + "tool_set_probe " + sh_quote(cron_expr) + " " + sh_quote(probe_name) + " " + sh_quote(c_id) + " " + sh_quote(sched_id)
+             cmd = "tool_set_probe " + sh_quote(cron_expr) + " " + sh_quote(probe_name) + " " + sh_quote(c_id) + " " + sh_quote(sched_id)
              
         elif name == "save_memory":
              fact = args.get("fact", "")
-             cmd = cmd_base + "tool_save_memory " + sh_quote(fact)
+             cmd = "tool_save_memory " + sh_quote(fact)
              
         else:
              # Generic Fallback for Plugins: call tool_{name} with JSON args
              # This allows plugins to define their own shell functions
-             cmd = cmd_base + "tool_" + name + " " + sh_quote(json.dumps(args))
+             cmd = "tool_" + name + " " + sh_quote(json.dumps(args))
             
         # print("DEBUG: Executing Tool Command: " + cmd)
-        return run_command(cmd)
+        return self.tools.run(cmd, self.tool_files.get(name))
 
 
 
@@ -624,7 +3790,8 @@ Proactively save important user info using save_memory.
         """Extract text content from LLM response (OpenRouter or Anthropic)."""
         if not resp:
             return ""
-        if self.llm.provider == "openrouter":
+        # By shape, not config: the router may have answered from either API
+        if "choices" in resp:
             choices = resp.get("choices", [])
             if choices:
                 return choices[0].get("message", {}).get("content", "")
@@ -636,23 +3803,52 @@ Proactively save important user info using save_memory.
             return text
         return ""
 
-    def detect_tool(self, content):
-        """Detect tool call in LLM output. Returns (name, args) or (None, None).
+    def extract_tool_calls(self, resp):
+        """Native tool calls in a provider response, as [(name, args_json, id)]:
+        OpenAI-style message.tool_calls or Anthropic tool_use blocks."""
+        calls = []
+        if not resp:
+            return calls
+        if "choices" in resp:
+            choices = resp.get("choices", [])
+            if choices:
+                for tc in choices[0].get("message", {}).get("tool_calls") or []:
+                    fn = tc.get("function", {})
+                    if fn.get("name"):
+                        calls.append((fn["name"], fn.get("arguments") or "{}", tc.get("id", "")))
+        else:
+            for block in resp.get("content", []):
+                if block.get("type") == "tool_use" and block.get("name"):
+                    calls.append((block["name"], json.dumps(block.get("input") or {}), block.get("id", "")))
+        return calls
+
+    def parse_tool_line(self, line):
+        """(name, args) for a TOOL:name:{args} line, else None."""
+        line = line.strip()
+        idx = line.upper().find("TOOL:")
+        if idx == -1:
+            return None
+        payload = line[idx + 5:]
+        parts = payload.split(":", 1)
+        name = parts[0].strip()
+        args = parts[1].strip() if len(parts) > 1 else "{}"
+        return name, args
+
+    def detect_tools(self, content):
+        """Detect tool calls in LLM output. Returns [(name, args)], possibly empty.
         
         Supports two formats:
-          1. TOOL:name:{args}  (preferred)
-          2. name {args}       (bare fallback)
+          1. TOOL:name:{args}  (preferred, one per line, several allowed)
+          2. name {args}       (bare fallback, first line only)
         """
         # Method 1: Explicit TOOL: prefix (anywhere in line)
+        calls = []
         for line in content.split("\n"):
-            line = line.strip()
-            idx = line.upper().find("TOOL:")
-            if idx != -1:
-                payload = line[idx + 5:]
-                parts = payload.split(":", 1)
-                name = parts[0].strip()
-                args = parts[1].strip() if len(parts) > 1 else "{}"
-                return name, args
+            call = self.parse_tool_line(line)
+            if call and call[0]:
+                calls.append(call)
+        if calls:
+            return calls
         
         # Method 2: Bare tool call (e.g. "get_sys_health {}" or "web_search({"query":"x"})")
         first_line = content.strip().split("\n")[0].strip()
@@ -663,14 +3859,117 @@ Proactively save important user info using save_memory.
                 if rest.startswith("(") and rest.endswith(")"):
                     rest = rest[1:-1]
                 if not rest or rest == "()":
-                    return known, "{}"
+                    return [(known, "{}")]
                 if rest.startswith("{"):
-                    return known, rest
-                return known, "{}"
+                    return [(known, rest)]
+                return [(known, "{}")]
         
+        return []
+
+    def detect_tool(self, content):
+        """First detected tool call as (name, args), or (None, None)."""
+        calls = self.detect_tools(content)
+        if calls:
+            return calls[0]
         return None, None
 
-    def process_message(self, chat_id, user_text, user_name=None):
+    def visible_text(self, content):
+        """Streamed text that is safe to show: no TOOL: lines, and a trailing
+        partial line is held back while it could still become one."""
+        lines = content.split("\n")
+        tail = lines[-1].strip().upper()
+        if "TOOL:".startswith(tail[:5]) or "TOOL:" in tail:
+            lines = lines[:-1]
+        return "\n".join([l for l in lines if "TOOL:" not in l.upper()])
+
+    def complete_tool_calls(self, content):
+        """TOOL: calls in a partial stream that can already be dispatched: the
+        line has ended, or its JSON args have closed."""
+        calls = []
+        lines = content.split("\n")
+        for i, line in enumerate(lines):
+            call = self.parse_tool_line(line)
+            if not call or not call[0]:
+                continue
+            if i < len(lines) - 1:
+                calls.append(call)
+                continue
+            args = call[1]
+            if ":" not in line[line.upper().find("TOOL:") + 5:] or not args.startswith("{"):
+                continue
+            depth = 0
+            in_str = False
+            esc = False
+            for c in args:
+                if esc:
+                    esc = False
+                elif c == "\\":
+                    esc = in_str
+                elif c == '"':
+                    in_str = not in_str
+                elif not in_str and c == "{":
+                    depth += 1
+                elif not in_str and c == "}":
+                    depth -= 1
+                    if depth == 0:
+                        calls.append(call)
+                        break
+        return calls
+
+    def use_tiered(self):
+        """Whether this message runs under the tiered policy: tier_share of
+        messages do when a cheap_model is configured, spread evenly so the
+        policy_* metrics compare like with like."""
+        if self.cheap_llm is None:
+            return False
+        with self.history_lock:
+            n = self.tier_seq
+            self.tier_seq = n + 1
+        return int((n + 1) * self.tier_share) > int(n * self.tier_share)
+
+    def invalid_call(self, calls, llm):
+        """Name of the first tool call that can't run as given (unknown tool,
+        args that aren't a JSON object, missing required args), else None."""
+        schemas = {}
+        for t in llm.tools or []:
+            schemas[t["name"]] = t
+        for name, args in calls:
+            if name not in self.KNOWN_TOOLS:
+                return name
+            try:
+                parsed = json.loads(args or "{}")
+            except:
+                return name
+            if not isinstance(parsed, dict):
+                return name
+            schema = schemas.get(name)
+            for key in (schema["input_schema"].get("required") or []) if schema else []:
+                if key not in parsed:
+                    return name
+        return None
+
+    def llm_cost(self, llm, resp):
+        """USD cost of one response from llm_prices ({model: [input, output]}
+        per million tokens), 0 if the model isn't priced."""
+        usage = resp.get("usage") or {}
+        for model in (resp.get("model"), llm.model_id()):
+            price = self.llm_prices.get(model) if model else None
+            if price:
+                n_in = usage.get("input_tokens", usage.get("prompt_tokens")) or 0
+                n_out = usage.get("output_tokens", usage.get("completion_tokens")) or 0
+                return (n_in * float(price[0]) + n_out * float(price[1])) / 1000000.0
+        return 0.0
+
+    def run_tool_call(self, name, args, chat_id):
+        """One tool call with the security gate and result size cap."""
+        if "config.json" in args or "microbot.py" in args:
+            return "Error: Access to system files is forbidden."
+        result = self.execute_tool(name, args, chat_id)
+        if len(result) > self.tool_result_chars:
+            result = result[:self.tool_result_chars] + "... (truncated)"
+        return result
+
+    def process_message(self, chat_id, user_text, user_name=None, stream=None):
         """ReAct Agent Loop (modeled on MimiClaw's agent_loop.c).
         
         The loop follows the Think -> Act -> Observe cycle:
@@ -678,31 +3977,132 @@ Proactively save important user info using save_memory.
           2. ACT:   If response contains a tool call, execute it
           3. OBSERVE: Feed tool result back into history, loop
           4. RESPOND: If no tool call, the response is final text
+        
+        With a cheap_model configured, tiered messages send the THINK steps
+        to the cheap model while it is picking tools. When it is ready to
+        answer, or its tool call is invalid or repeats an earlier one, the
+        turn escalates: the main model redoes that step and keeps the rest
+        of the message.
+
+        Each message leaves a trace (per-iteration phase times, tool times,
+        token usage, policy and cost) in METRICS and, if metrics_log is set,
+        the JSON log.
         """
-        def pick(lst):
-            """Pick from list without random module (MicroPython safe)."""
-            return lst[int(time.time()) % len(lst)]
+        t_msg = time.time()
+        policy = "tiered" if self.use_tiered() else "single"
+        trace = {"ts": int(t_msg), "chat_id": chat_id, "policy": policy, "cost": 0.0, "iterations": []}
+        try:
+            return self._react(chat_id, user_text, user_name, stream, trace)
+        finally:
+            METRICS.inc("messages_total")
+            total = METRICS.since("message_seconds", t_msg)
+            trace["total"] = round(total, 4)
+            trace["cost"] = round(trace["cost"], 6)
+            METRICS.inc("policy_messages_total", 1, {"policy": policy})
+            METRICS.observe("policy_message_seconds", total, {"policy": policy})
+            if trace["cost"]:
+                METRICS.inc("policy_cost_usd_total", trace["cost"], {"policy": policy})
+            METRICS.log(trace)
+
+    def _react(self, chat_id, user_text, user_name, stream, trace):
+        def phase(it, name, t0):
+            dt = METRICS.since("phase_seconds", t0, {"phase": name})
+            it[name] = round(it.get(name, 0) + dt, 4)
         
-        self._current_chat_id = chat_id
         self.add_to_history(chat_id, "user", user_text)
+
+        batch = [None]
+        def on_text(text):
+            stream.update(self.visible_text(text))
+            # Start each tool as soon as its line is complete, while the
+            # rest of the completion is still streaming in
+            for call in self.complete_tool_calls(text):
+                if batch[0] is None:
+                    batch[0] = ToolBatch(self, chat_id, self.tool_parallel, self.tool_call_timeout)
+                batch[0].start(call[0], call[1])
+            return False
         
-        system_prompt = self.build_system_prompt(user_name)
+        def think(it, tier):
+            """One LLM step on the given tier; the cheap model never streams
+            (its text may be thrown away)."""
+            llm = self.cheap_llm if tier == "cheap" else self.llm
+            t0 = time.time()
+            # Digest of evicted turns rides in the prompt's dynamic tail
+            system_prompt = self.build_system_prompt(user_name, self.get_context(chat_id).digest, user_text, llm)
+            phase(it, "prompt", t0)
+            native = llm.native_tools
+            t0 = time.time()
+            if stream and tier == "main":
+                resp = llm.chat_stream(messages, system_prompt, on_text)
+            else:
+                resp = llm.chat(messages, system_prompt)
+            if not resp and native and not llm.native_tools:
+                # Model has no tool support: retry on the text protocol
+                system_prompt = self.build_system_prompt(user_name, self.get_context(chat_id).digest, user_text, llm)
+                if stream and tier == "main":
+                    resp = llm.chat_stream(messages, system_prompt, on_text)
+                else:
+                    resp = llm.chat(messages, system_prompt)
+            phase(it, "llm", t0)
+            METRICS.since("llm_tier_seconds", t0, {"tier": tier})
+            METRICS.inc("llm_requests_total", 1, {"outcome": "ok" if resp else "error"})
+            if resp:
+                it["usage"] = resp.get("usage") or {}
+                METRICS.usage(it["usage"])
+                METRICS.usage(it["usage"], "policy_tokens_total", {"policy": trace["policy"], "tier": tier})
+                trace["cost"] += self.llm_cost(llm, resp)
+            return resp
+
+        def tool_calls_of(resp):
+            """[(name, args)], [ids] of a response: native calls first, then
+            the TOOL: text protocol."""
+            native_calls = self.extract_tool_calls(resp)
+            if native_calls:
+                return [(c[0], c[1]) for c in native_calls], [c[2] for c in native_calls]
+            return self.detect_tools(self.extract_text(resp) or ""), []
+
         messages = self.get_history(chat_id)
         
         max_iterations = 10
         final_text = ""
+        tier = "cheap" if trace["policy"] == "tiered" else "main"
+        seen = []   # tool call sets already run for this message
         
         # --- ReAct Loop ---
         for iteration in range(max_iterations):
             
-            # Only send status on tool iterations (iter > 0)
-            if iteration > 0:
-                phrases = ["Still working on it... \ud83d\udd27", "Just a moment more... \u2699\ufe0f", "Almost there... \ud83d\udcaa"]
-                send_telegram_msg(chat_id, pick(phrases), self.token)
+            # Typing indicator on tool iterations (iter > 0): a status
+            # message would spend the chat's sendMessage budget
+            if iteration > 0 and not stream:
+                send_typing(chat_id, self.token)
             
             # 1. THINK: Call LLM
-            print("[react] Iter " + str(iteration + 1) + " | Think...")
-            resp = self.llm.chat(messages, system_prompt)
+            print("[react] Iter " + str(iteration + 1) + " | Think (" + tier + ")...")
+            it = {"tier": tier}
+            trace["iterations"].append(it)
+            batch[0] = None
+            resp = think(it, tier)
+            if tier == "cheap":
+                # The cheap model only picks tools: anything else goes to
+                # the main model, which then finishes the message
+                reason = None
+                if not resp:
+                    reason = "error"
+                else:
+                    calls = tool_calls_of(resp)[0]
+                    if not calls:
+                        reason = "final"
+                    elif self.invalid_call(calls, self.cheap_llm):
+                        reason = "invalid"
+                    elif sorted(calls) in seen:
+                        reason = "loop"
+                if reason:
+                    print("[react] Escalating to main model (" + reason + ")")
+                    METRICS.inc("llm_escalations_total", 1, {"reason": reason})
+                    tier = "main"
+                    it["tier"] = tier
+                    it["escalated"] = reason
+                    resp = think(it, tier)
             
             if not resp:
                 print("[react] ERROR: Empty LLM response")
@@ -710,8 +4110,10 @@ Proactively save important user info using save_memory.
                     return "Error contacting AI. Please try again."
                 break
             
-            content = self.extract_text(resp)
-            if not content:
+            t0 = time.time()
+            content = self.extract_text(resp) or ""
+            native_calls = self.extract_tool_calls(resp)
+            if not content and not native_calls:
                 print("[react] ERROR: No text in response")
                 print("[react] Raw: " + str(resp)[:200])
                 if iteration == 0:
@@ -720,36 +4122,58 @@ Proactively save important user info using save_memory.
             
             print("[react] Response: " + content[:120] + ("..." if len(content) > 120 else ""))
             
-            # 2. ACT: Check for tool call
-            t_name, t_args = self.detect_tool(content)
+            # 2. ACT: Check for tool calls (native first, then text protocol)
+            calls, ids = tool_calls_of(resp)
+            seen.append(sorted(calls))
+            stamp = str(int(time.time() * 1000) % 1000000000)
+            for i in range(len(ids), len(calls)):
+                ids.append("mb" + stamp + "_" + str(i))
+            phase(it, "parse", t0)
             
-            if not t_name:
+            if not calls:
                 # No tool -> this is the final answer
                 print("[react] Final answer (no tool detected)")
                 final_text = content
+                t0 = time.time()
                 self.add_to_history(chat_id, "assistant", final_text)
+                phase(it, "history", t0)
                 break
             
-            # Tool detected -> execute it
-            print("[react] Act: " + t_name + " | " + t_args[:80])
+            # Tools detected -> execute them concurrently
+            names = [c[0] for c in calls]
+            for c in calls:
+                print("[react] Act: " + c[0] + " | " + c[1][:80])
+            if stream:
+                stream.update("\u2699\ufe0f " + ", ".join(names) + "...", force=True)
             
-            # Add assistant's tool-calling message to history
-            self.add_to_history(chat_id, "assistant", "TOOL:" + t_name + ":" + t_args)
-            
-            # Security gate
-            if "config.json" in t_args or "microbot.py" in t_args:
-                t_result = "Error: Access to system files is forbidden."
-            else:
-                t_result = self.execute_tool(t_name, t_args)
+            # Add assistant's tool-calling message to history (provider-neutral;
+            # LLMClient renders it as tool_use blocks or TOOL: lines)
+            tool_calls = [{"id": ids[i], "name": calls[i][0], "args": calls[i][1]} for i in range(len(calls))]
+            t0 = time.time()
+            self.add_to_history(chat_id, "assistant", content if native_calls else "", tool_calls)
+            phase(it, "history", t0)
             
-            # 3. OBSERVE: Feed result back
-            if len(t_result) > 2000:
-                t_result = t_result[:2000] + "... (truncated)"
+            t0 = time.time()
+            if batch[0] is None:
+                batch[0] = ToolBatch(self, chat_id, self.tool_parallel, self.tool_call_timeout)
+            for c in calls:
+                batch[0].start(c[0], c[1])
+            results = dict(batch[0].wait())
+            phase(it, "tools", t0)
+            it["tool_calls"] = batch[0].timings()
             
-            print("[react] Observe: " + str(len(t_result)) + " bytes from " + t_name)
+            # 3. OBSERVE: Feed all results back in one observation
+            observation = []
+            for i in range(len(calls)):
+                c = calls[i]
+                t_result = results.get(c, "")
+                print("[react] Observe: " + str(len(t_result)) + " bytes from " + c[0])
+                observation.append({"id": ids[i], "name": c[0], "content": t_result})
             
-            # Add tool result as user message (the "observation")
-            self.add_to_history(chat_id, "user", "[Tool Result: " + t_name + "]\n" + t_result)
+            # Add tool results as one message (the "observation")
+            t0 = time.time()
+            self.add_to_history(chat_id, "tool", observation)
+            phase(it, "history", t0)
             
             # Refresh messages for next iteration
             messages = self.get_history(chat_id)
@@ -759,54 +4183,1191 @@ Proactively save important user info using save_memory.
         
         return final_text
 
+class ToolBatch:
+    """Tool calls of one ReAct turn, run concurrently on at most `workers`
+    threads. start() may be called while the LLM is still streaming; wait()
+    returns [(call, result)] in call order. A call that is still running at
+    its per-call deadline is reported as timed out (its shell worker enforces
+    its own kill timeout)."""
+    def __init__(self, agent, chat_id, workers=4, timeout=60):
+        self.agent = agent
+        self.chat_id = chat_id
+        self.workers = max(1, int(workers))
+        self.timeout = float(timeout)
+        self.lock = new_lock()
+        self.calls = []      # [(name, args)]
+        self.results = []    # result string or None while running
+        self.started = []    # start time per call, None while queued
+        self.durations = []  # seconds per finished call
+        self.next = 0        # index of the next queued call
+        self.running = 0
+
+    def start(self, name, args):
+        with self.lock:
+            if (name, args) in self.calls:
+                return  # already dispatched from the stream
+            self.calls.append((name, args))
+            self.results.append(None)
+            self.started.append(None)
+            self.durations.append(None)
+            spawn = _thread is not None and self.running < self.workers
+            if spawn:
+                self.running += 1
+        if _thread is None:
+            self._work()
+        elif spawn:
+            try:
+                _thread.start_new_thread(self._work, ())
+            except Exception:
+                with self.lock:
+                    self.running -= 1
+                self._work()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                if self.next >= len(self.calls):
+                    if _thread is not None:
+                        self.running -= 1
+                    return
+                i = self.next
+                self.next += 1
+                self.started[i] = time.time()
+            name, args = self.calls[i]
+            try:
+                result = self.agent.run_tool_call(name, args, self.chat_id)
+            except Exception as e:
+                result = "Error: " + str(e)
+            METRICS.inc("tool_calls_total", 1, {"tool": name})
+            dt = METRICS.since("tool_seconds", self.started[i], {"tool": name})
+            with self.lock:
+                self.durations[i] = round(dt, 4)
+                if self.results[i] is not None:
+                    return  # timed out: wait() already released this slot
+                self.results[i] = result or ""
+
+    def timings(self):
+        """[{"tool", "seconds"}] for the trace (None while still running)."""
+        with self.lock:
+            return [{"tool": self.calls[i][0], "seconds": self.durations[i]} for i in range(len(self.calls))]
+
+    def wait(self):
+        while True:
+            spawn = 0
+            with self.lock:
+                now = time.time()
+                pending = False
+                for i in range(len(self.calls)):
+                    if self.results[i] is not None:
+                        continue
+                    t0 = self.started[i]
+                    if t0 is not None and now - t0 > self.timeout:
+                        self.results[i] = "Error: Tool timed out after " + str(int(self.timeout)) + "s"
+                        # Let a fresh thread take queued calls off the stuck one
+                        self.running -= 1
+                        if self.next < len(self.calls):
+                            self.running += 1
+                            spawn += 1
+                    else:
+                        pending = True
+                if not pending:
+                    return [(self.calls[i], self.results[i]) for i in range(len(self.calls))]
+            for _ in range(spawn):
+                _thread.start_new_thread(self._work, ())
+            time.sleep(0.02)
+
+# --- Telegram Output ---
+TG_API = "https://api.telegram.org/bot"
+TG_MAX_TEXT = 4096
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`."""
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def wait_time(self, now):
+        """Seconds until a token is available (0 if one is)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+def split_message(text, limit=TG_MAX_TEXT):
+    """Split text into chunks of at most `limit` chars, preferring paragraph,
+    then line, then word boundaries."""
+    text = text.strip()
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit + 1)
+        if cut < limit // 2:
+            cut = text.rfind("\n", 0, limit + 1)
+        if cut < limit // 2:
+            cut = text.rfind(" ", 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text:
+        chunks.append(text)
+    return chunks
+
+class TelegramSender:
+    """Bot API output over one keep-alive connection pool.
+
+    send() and typing() only queue work; a sender thread (started on demand,
+    like ChatDispatcher workers) drains the queue in order per chat while
+    token buckets keep it under Telegram's limits (~1 msg/s per chat, 30/s
+    overall). A 429 puts the job back at the head of its chat's queue and
+    holds that chat until retry_after; other chats keep flowing. call() is
+    the synchronous path for requests whose result is needed (stream edits).
+
+    A request is only resent when it never reached Telegram: a connection
+    dropped after sending may already have delivered the message.
+    """
+    MAX_TRIES = 5       # 429 requeues before a queued job is dropped
+    CHAT_RATE = 1.0
+    CHAT_BURST = 3
+    GLOBAL_RATE = 30.0
+    TYPING_TTL = 4.5    # Telegram shows "typing" for ~5s per action
+
+    def __init__(self, token, api=TG_API, http=None):
+        self.token = token
+        self.api = api
+        self.http = http or HTTPClient()
+        self.lock = new_lock()
+        self.queue = []          # [(chat_id, method, payload, tries)]
+        self.global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self.chat_buckets = {}   # chat_id -> TokenBucket
+        self.typing_at = {}      # chat_id -> time of last typing action
+        self.hold = {}           # chat_id -> not-before time after a 429
+        self.running = False
+        self.sent = 0
+        self.retries = 0
+
+    def _post(self, method, payload):
+        """One Bot API call: (parsed JSON or None, seconds to back off after
+        a 429 or 0). Never sleeps; the caller decides how to wait."""
+        url = self.api + self.token + "/" + method
+        body = json.dumps(payload)
+        headers = {"Content-Type": "application/json"}
+        t0 = time.time()
+        status, txt = self.http.request("POST", url, body, headers, timeout=15, fallback=False)
+        if status == -1:
+            # No connection, so nothing was sent: safe to try again, through
+            # curl if the native transport can't connect at all
+            self.retries += 1
+            status, txt = self.http.request("POST", url, body, headers, timeout=15, fallback=False)
+            if status == -1:
+                status, txt = curl_request("POST", url, body, headers, 15, self.http.proxy)
+        METRICS.since("telegram_seconds", t0, {"method": method})
+        try:
+            r = json.loads(txt)
+        except:
+            r = None
+        if status == 429:
+            wait = ((r or {}).get("parameters") or {}).get("retry_after", 1)
+            print("[telegram] Rate limited for " + str(wait) + "s")
+            return r, max(1.0, min(float(wait), 60))
+        return r, 0
+
+    def _bucket(self, chat_id):
+        b = self.chat_buckets.get(chat_id)
+        if b is None:
+            b = TokenBucket(self.CHAT_RATE, self.CHAT_BURST)
+            self.chat_buckets[chat_id] = b
+        return b
+
+    def call(self, method, payload):
+        """Rate-limited synchronous call (blocks for a token)."""
+        chat_id = payload.get("chat_id")
+        while True:
+            with self.lock:
+                now = time.time()
+                wait = self.global_bucket.wait_time(now)
+                if chat_id is not None:
+                    wait = max(wait, self._bucket(chat_id).wait_time(now))
+                if chat_id is not None:
+                    wait = max(wait, self.hold.get(chat_id, 0) - now)
+                if wait <= 0:
+                    self.global_bucket.take()
+                    if chat_id is not None:
+                        self._bucket(chat_id).take()
+                    break
+            time.sleep(min(wait, 1))
+        for attempt in range(3):
+            r, backoff = self._post(method, payload)
+            if not backoff:
+                return r
+            # Only the calling chat's thread waits here
+            self.retries += 1
+            if chat_id is not None:
+                with self.lock:
+                    self.hold[chat_id] = time.time() + backoff
+            time.sleep(backoff)
+        return r
+
+    def send(self, chat_id, text):
+        """Queue a plain-text reply, split at 4096 chars; returns at once."""
+        if not text:
+            return
+        chunks = split_message(strip_markdown(text))
+        with self.lock:
+            # A message ends the typing indicator, so a queued one is moot
+            self.queue = [j for j in self.queue if not (j[0] == chat_id and j[1] == "sendChatAction")]
+            self.typing_at.pop(chat_id, None)
+            for chunk in chunks:
+                self.queue.append((chat_id, "sendMessage", {"chat_id": chat_id, "text": chunk}, 0))
+        self._kick()
+
+    def typing(self, chat_id):
+        """Show "typing"; repeated requests within the indicator's lifetime
+        are coalesced into the one already sent."""
+        now = time.time()
+        with self.lock:
+            if now - self.typing_at.get(chat_id, 0) < self.TYPING_TTL:
+                return
+            self.typing_at[chat_id] = now
+            self.queue.append((chat_id, "sendChatAction", {"chat_id": chat_id, "action": "typing"}, 0))
+        self._kick()
+
+    def _next(self):
+        """Pop the first job that may go now, keeping per-chat order.
+        Returns (job, 0) or (None, seconds to wait). Caller holds the lock."""
+        now = time.time()
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+        wait = 1.0
+        seen = []
+        for i in range(len(self.queue)):
+            job = self.queue[i]
+            if job[0] in seen:
+                continue
+            seen.append(job[0])
+            if job[0] in self.hold:
+                held = self.hold[job[0]] - now
+                if held > 0:
+                    wait = min(wait, held)
+                    continue
+                del self.hold[job[0]]
+            if job[1] != "sendChatAction":
+                # Chat actions don't count against the per-chat message limit
+                b = self._bucket(job[0])
+                w = b.wait_time(now)
+                if w > 0:
+                    wait = min(wait, w)
+                    continue
+                b.take()
+            self.global_bucket.take()
+            return self.queue.pop(i), 0
+        return None, wait
+
+    def _kick(self):
+        if _thread is None:
+            self._drain()
+            return
+        with self.lock:
+            if self.running:
+                return
+            self.running = True
+        try:
+            _thread.start_new_thread(self._drain, ())
+        except Exception as e:
+            print("[telegram] No sender thread (" + str(e) + "), sending inline")
+            self._drain()
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.running = False
+                    return
+                job, wait = self._next()
+            if job is None:
+                time.sleep(min(wait, 1))
+                continue
+            r, backoff = self._post(job[1], job[2])
+            if backoff:
+                self.retries += 1
+                with self.lock:
+                    self.hold[job[0]] = time.time() + backoff
+                    if job[1] == "sendMessage" and job[3] + 1 < self.MAX_TRIES:
+                        # Head of the queue = first in line for its chat
+                        self.queue.insert(0, (job[0], job[1], job[2], job[3] + 1))
+                        continue
+            if job[1] == "sendMessage":
+                if r and r.get("ok"):
+                    self.sent += 1
+                else:
+                    print("[telegram] Send failed: " + str(r)[:200])
+
+    def flush(self, timeout=5):
+        """Wait (bounded) for queued output, e.g. before shutdown."""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if not self.queue and not self.running:
+                    return True
+            time.sleep(0.05)
+        return False
+
+_senders = {}
+_senders_lock = new_lock()
+
+def get_sender(token, api=None):
+    """Shared TelegramSender per bot token (api is used on first creation)."""
+    with _senders_lock:
+        sender = _senders.get(token)
+        if sender is None:
+            sender = TelegramSender(token, api or TG_API)
+            _senders[token] = sender
+        return sender
+
+def tg_call(token, method, payload):
+    """Call a Bot API method with a JSON body; returns parsed JSON or None."""
+    return get_sender(token).call(method, payload)
+
+class TelegramStream:
+    """Progressive reply: one message that is edited in place while the answer
+    streams in. Edits are rate limited (Telegram allows ~1/s per chat)."""
+    def __init__(self, chat_id, token, interval=1.5):
+        self.chat_id = chat_id
+        self.token = token
+        self.interval = float(interval)
+        self.message_id = None
+        self.shown = ""
+        self.last_edit = 0
+
+    def update(self, text, force=False):
+        text = strip_markdown(text).strip()[:TG_MAX_TEXT]
+        if not text or text == self.shown:
+            return
+        now = time.time()
+        if not force and self.message_id is not None and now - self.last_edit < self.interval:
+            return
+        if self.message_id is None:
+            r = tg_call(self.token, "sendMessage", {"chat_id": self.chat_id, "text": text})
+            if not r or not r.get("ok"):
+                return
+            self.message_id = r["result"]["message_id"]
+        else:
+            tg_call(self.token, "editMessageText",
+                    {"chat_id": self.chat_id, "message_id": self.message_id, "text": text})
+        self.shown = text
+        self.last_edit = now
+
+    def finish(self, text):
+        """Put the final answer in the streamed message. Returns False when
+        nothing was streamed, so the caller sends a normal message instead."""
+        if self.message_id is None:
+            return False
+        chunks = split_message(strip_markdown(text))
+        if chunks:
+            self.update(chunks[0], force=True)
+        for chunk in chunks[1:]:
+            send_telegram_msg(self.chat_id, chunk, self.token)
+        return True
+
 def send_telegram_msg(chat_id, text, token):
-    """Refactored helper to send Telegram messages via curl (no temp files)"""
+    """Queue a plain-text Telegram message; returns without waiting on the network."""
     if not text or not token:
         return
-        
-    # Strip markdown and send as plain text
-    clean_text = strip_markdown(text)
-    
-    # Build JSON inline for curl -d (no temp file)
-    # Escape quotes and backslashes for JSON
-    json_text = clean_text.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
-    json_body = '{"chat_id":' + str(chat_id) + ',"text":"' + json_text + '"}'
-    
-    send_url = "https://api.telegram.org/bot" + token + "/sendMessage"
-    cmd = "curl -k -s -H 'Content-Type: application/json' -d '" + json_body.replace("'", "'\\''") + "' '" + send_url + "'"
-    
-    s_res = run_command(cmd)
+    get_sender(token).send(chat_id, text)
+
+def send_typing(chat_id, token):
+    if token:
+        get_sender(token).typing(chat_id)
+
+# --- Webhook ---
+class UpdateDeduper:
+    """Remembers the last `size` update_ids: Telegram redelivers an update
+    when its webhook call times out."""
+    def __init__(self, size=512):
+        self.size = size
+        self.seen = {}
+        self.order = []
+        self.lock = new_lock()
+
+    def first_time(self, update_id):
+        with self.lock:
+            if update_id in self.seen:
+                return False
+            self.seen[update_id] = True
+            self.order.append(update_id)
+            if len(self.order) > self.size:
+                del self.seen[self.order.pop(0)]
+            return True
+
+def _random_token():
+    try:
+        return "".join(["%02x" % b for b in os.urandom(16)])
+    except:
+        return str(int(time.time() * 1000000))
+
+class WebhookServer:
+    """Minimal HTTP listener for Telegram webhook pushes, on plain sockets
+    so it also runs on MicroPython. TLS is expected to be terminated in
+    front of it (uhttpd/nginx proxy or a tunnel).
+
+    POSTs must carry the secret token given to setWebhook. Each update is
+    acknowledged before on_update runs, so Telegram never waits on the agent.
+    GET paths in `pages` return the text of their callable (health checks).
+    Connections are read on their own threads (up to MAX_HANDLERS), so a
+    slow client doesn't hold up accept(); without _thread, or when all are
+    busy, one is handled inline with a short read timeout.
+    """
+    MAX_BODY = 1048576
+    MAX_HANDLERS = 4
+    READ_TIMEOUT = 10       # on a handler thread
+    INLINE_TIMEOUT = 0.5    # inline, where it blocks the accept loop
+
+    def __init__(self, port, secret, on_update, host="0.0.0.0"):
+        self.port = int(port)
+        self.host = host
+        self.secret = secret
+        self.on_update = on_update   # None: GET pages only (metrics listener)
+        self.pages = {"/health": lambda: "ok\n"}
+        self.sock = None
+        self.received = 0
+        self.rejected = 0
+        self.lock = new_lock()
+        self.update_lock = new_lock()   # on_update calls stay one at a time
+        self.handlers = 0
+
+    def start(self):
+        addr = socket.getaddrinfo(self.host, self.port)[0][-1]
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(addr)
+        self.sock.listen(8)
+        # Wake up regularly so the caller's loop can do housekeeping
+        self.sock.settimeout(1)
+        print("[webhook] Listening on " + self.host + ":" + str(self.port))
+
+    def _read_request(self, conn):
+        buf = b""
+        while b"\r\n\r\n" not in buf:
+            chunk = conn.recv(2048)
+            if not chunk:
+                return None
+            buf += chunk
+            if len(buf) > 65536:
+                return None
+        head, body = buf.split(b"\r\n\r\n", 1)
+        lines = head.decode("utf-8", "replace").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) < 2:
+            return None
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                k, v = line.split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+        length = int(headers.get("content-length", "0") or 0)
+        if length > self.MAX_BODY:
+            return None
+        while len(body) < length:
+            chunk = conn.recv(min(4096, length - len(body)))
+            if not chunk:
+                break
+            body += chunk
+        return parts[0], parts[1].split("?")[0], headers, body
+
+    def _respond(self, conn, status, text, ctype="text/plain"):
+        data = text.encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed"}.get(status, "OK")
+        head = "HTTP/1.1 " + str(status) + " " + reason + "\r\nContent-Type: " + ctype + \
+               "\r\nContent-Length: " + str(len(data)) + "\r\nConnection: close\r\n\r\n"
+        conn.send(head.encode("utf-8") + data)
+
+    def handle(self, conn, timeout=None):
+        update = None
+        try:
+            conn.settimeout(self.READ_TIMEOUT if timeout is None else timeout)
+            req = self._read_request(conn)
+            if req is None:
+                self._respond(conn, 400, "bad request\n")
+                return
+            method, path, headers, body = req
+            if method == "GET":
+                page = self.pages.get(path)
+                if page is None:
+                    self._respond(conn, 404, "not found\n")
+                else:
+                    self._respond(conn, 200, page())
+                return
+            if method != "POST" or self.on_update is None:
+                self._respond(conn, 405, "method not allowed\n")
+                return
+            if headers.get("x-telegram-bot-api-secret-token") != self.secret:
+                self.rejected += 1
+                self._respond(conn, 403, "forbidden\n")
+                return
+            try:
+                update = json.loads(body)
+            except:
+                self._respond(conn, 400, "bad json\n")
+                return
+            self._respond(conn, 200, "ok\n")
+        except Exception as e:
+            print("[webhook] Request error: " + str(e))
+        finally:
+            try:
+                conn.close()
+            except:
+                pass
+        if update is not None:
+            with self.update_lock:
+                self.received += 1
+                self.on_update(update)
+
+    def _handle_thread(self, conn):
+        try:
+            self.handle(conn)
+        except Exception as e:
+            print("[webhook] Handler error: " + str(e))
+        finally:
+            with self.lock:
+                self.handlers -= 1
+
+    def serve_once(self):
+        """Accept one connection and hand it off; False if the accept timed out."""
+        try:
+            conn, addr = self.sock.accept()
+        except OSError:
+            return False
+        if _thread is not None:
+            with self.lock:
+                spawn = self.handlers < self.MAX_HANDLERS
+                if spawn:
+                    self.handlers += 1
+            if spawn:
+                try:
+                    _thread.start_new_thread(self._handle_thread, (conn,))
+                    return True
+                except Exception as e:
+                    print("[webhook] No handler thread (" + str(e) + ")")
+                    with self.lock:
+                        self.handlers -= 1
+        self.handle(conn, self.INLINE_TIMEOUT)
+        return True
+
+    def close(self):
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+def add_metrics_pages(server, agent=None):
+    server.pages["/metrics"] = METRICS.prometheus
+    server.pages["/metrics.json"] = lambda: json.dumps(METRICS.snapshot())
+    if agent is not None:
+        server.pages["/memory.json"] = lambda: json.dumps(agent.memory_report())
+
+def start_metrics_server(port, host="127.0.0.1", agent=None):
+    """GET-only listener for /metrics on its own thread (polling mode, or a
+    port other than the webhook's)."""
+    if socket is None or _thread is None:
+        print("[metrics] No socket/_thread support, /metrics disabled")
+        return None
+    server = WebhookServer(port, None, None, host)
+    add_metrics_pages(server, agent)
+    try:
+        server.start()
+    except Exception as e:
+        print("[metrics] Cannot listen: " + str(e))
+        return None
+
+    def serve():
+        while True:
+            try:
+                server.serve_once()
+            except Exception as e:
+                print("[metrics] Error: " + str(e))
+    _thread.start_new_thread(serve, ())
+    return server
+
+def dump_metrics():
+    """Final counters and histogram totals into the JSON log."""
+    METRICS.log({"ts": int(time.time()), "snapshot": METRICS.snapshot()})
+
+# --- Scheduler ---
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
+
+SCHEDULE_FILE = Path.join(SCRIPT_DIR, "data", "schedules.json")
+
+CRON_MACROS = {
+    "@hourly": "0 * * * *", "@daily": "0 0 * * *", "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0", "@monthly": "0 0 1 * *", "@yearly": "0 0 1 1 *", "@annually": "0 0 1 1 *",
+}
+CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+def parse_cron(expr):
+    """Five-field cron expression (or @daily etc.) -> [minutes, hours,
+    days, months, weekdays, dom_star, dow_star]. Fields are sets; Sunday
+    is 0 (7 accepted). Raises ValueError."""
+    expr = str(expr).strip()
+    fields = CRON_MACROS.get(expr, expr).split()
+    if len(fields) != 5:
+        raise ValueError("cron expression needs 5 fields: " + expr)
+    out = []
+    for i in range(5):
+        lo, hi = CRON_RANGES[i]
+        vals = set()
+        for part in fields[i].split(","):
+            step = 1
+            try:
+                if "/" in part:
+                    part, step = part.split("/", 1)
+                    step = int(step)
+                if part == "*":
+                    a, b = lo, hi
+                elif "-" in part:
+                    a, b = part.split("-", 1)
+                    a, b = int(a), int(b)
+                else:
+                    a = int(part)
+                    b = hi if step > 1 else a
+            except ValueError:
+                raise ValueError("bad cron field: " + fields[i])
+            if step < 1 or a < lo or b > hi or a > b:
+                raise ValueError("cron field out of range: " + fields[i])
+            for v in range(a, b + 1, step):
+                vals.add(v)
+        out.append(vals)
+    if 7 in out[4]:
+        out[4].discard(7)
+        out[4].add(0)
+    out.append(fields[2].startswith("*"))
+    out.append(fields[4].startswith("*"))
+    return out
+
+def _cron_day(c, lt):
+    dom = lt[2] in c[2]
+    dow = (lt[6] + 1) % 7 in c[4]   # localtime: Monday is 0
+    if c[5] or c[6]:
+        return dom and dow
+    return dom or dow   # both restricted: either matches, as in cron
+
+def cron_next(c, after):
+    """First minute strictly after `after` (epoch seconds) matching the
+    parsed expression, or None. Skips whole days and hours that can't match."""
+    t = int(after) // 60 * 60 + 60
+    limit = t + 5 * 366 * 86400   # Feb 29 only comes every 4 years
+    while t < limit:
+        lt = time.localtime(t)
+        if lt[1] not in c[3] or not _cron_day(c, lt):
+            t += ((23 - lt[3]) * 60 + 60 - lt[4]) * 60
+        elif lt[3] not in c[1]:
+            t += (60 - lt[4]) * 60
+        elif lt[4] not in c[0]:
+            t += 60
+        else:
+            return t
+    return None
+
+class Scheduler:
+    """Cron-style jobs inside the bot process, replacing crontab lines and
+    cron_task.sh / cron_probe.sh runs.
+
+    Jobs ({"id", "cron", "chat_id", "type", "content"[, "probe"]}) are
+    persisted to data/schedules.json; due times live in a heap of
+    (next_run, id) with lazy deletion. run_forever() sleeps until the
+    earliest job (at most `tick` seconds, so new jobs are picked up) and
+    hands due jobs to `fire`, which queues them on the chat dispatcher.
+    Firings missed while the bot was down are skipped, as cron does.
+    """
+    TYPES = ("msg", "cmd", "url", "once_msg", "once_cmd", "probe")
+
+    def __init__(self, path, fire=None, tick=5):
+        self.path = path
+        self.fire = fire          # fn(job)
+        self.tick = float(tick)
+        self.lock = new_lock()
+        self.jobs = {}            # id -> job dict (persisted form)
+        self.fields = {}          # id -> parsed cron
+        self.due_at = {}          # id -> next run (epoch seconds)
+        self.heap = []            # [(next run, id)], stale entries skipped
+        self.fired = 0
+
+    def load(self):
+        try:
+            jobs = json.loads(_read_text(self.path) or "[]")
+        except:
+            print("[sched] " + self.path + " unreadable, starting empty")
+            jobs = []
+        now = time.time()
+        with self.lock:
+            for job in jobs:
+                try:
+                    self._push(job, parse_cron(job["cron"]), now)
+                except Exception as e:
+                    print("[sched] Skipping job " + str(job.get("id")) + ": " + str(e))
+        print("[sched] " + str(len(self.jobs)) + " schedules loaded")
+
+    def _push(self, job, fields, now):
+        nxt = cron_next(fields, now)
+        if nxt is None:
+            raise ValueError("cron expression never matches: " + job["cron"])
+        self.jobs[job["id"]] = job
+        self.fields[job["id"]] = fields
+        self.due_at[job["id"]] = nxt
+        heapq.heappush(self.heap, (nxt, job["id"]))
+        return nxt
+
+    def _save(self):
+        try:
+            _makedirs(Path.dirname(self.path))
+            with open(self.path + ".tmp", 'w') as f:
+                json.dump(list(self.jobs.values()), f)
+            os.rename(self.path + ".tmp", self.path)
+        except Exception as e:
+            print("[sched] Could not save schedules: " + str(e))
+
+    def new_id(self, prefix):
+        n = int(time.time())
+        with self.lock:
+            while prefix + str(n) in self.jobs:
+                n += 1
+        return prefix + str(n)
+
+    def add(self, job):
+        """Add or replace a job; returns its next run time. Raises ValueError."""
+        if job.get("type") not in self.TYPES:
+            raise ValueError("type must be one of " + ", ".join(self.TYPES))
+        fields = parse_cron(job["cron"])
+        with self.lock:
+            nxt = self._push(job, fields, time.time())
+            self._save()
+        return nxt
+
+    def remove(self, sched_id, chat_id=None):
+        """Drop a job (only the chat's own if chat_id is given)."""
+        with self.lock:
+            job = self.jobs.get(sched_id)
+            if job is None or (chat_id is not None and job.get("chat_id") != chat_id):
+                return False
+            self._drop(sched_id)
+            self._save()
+        return True
+
+    def _drop(self, sched_id):
+        self.jobs.pop(sched_id, None)
+        self.fields.pop(sched_id, None)
+        self.due_at.pop(sched_id, None)
+
+    def list(self, chat_id=None):
+        """[(job, next run)] soonest first, optionally for one chat."""
+        with self.lock:
+            out = [(job, self.due_at[i]) for i, job in self.jobs.items()
+                   if chat_id is None or job.get("chat_id") == chat_id]
+        out.sort(key=lambda x: x[1])
+        return out
+
+    def due(self, now):
+        """Pop jobs due at `now` and reschedule them (one-shots are removed)."""
+        jobs = []
+        removed = False
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                t, sched_id = heapq.heappop(self.heap)
+                if self.due_at.get(sched_id) != t:
+                    continue   # removed or rescheduled since
+                job = self.jobs[sched_id]
+                jobs.append(job)
+                if job["type"].startswith("once_"):
+                    self._drop(sched_id)
+                    removed = True
+                else:
+                    self._push(job, self.fields[sched_id], now)
+            if removed:
+                self._save()
+        return jobs
+
+    def next_run(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def run_forever(self):
+        """Timer loop (started on its own thread by main)."""
+        while True:
+            nxt = self.next_run()
+            wait = self.tick if nxt is None else nxt - time.time()
+            if wait > 0:
+                time.sleep(min(wait, self.tick))
+                continue
+            for job in self.due(time.time()):
+                self.fired += 1
+                METRICS.inc("scheduled_jobs_total", 1, {"type": job["type"]})
+                try:
+                    self.fire(job)
+                except Exception as e:
+                    print("[sched] Job " + str(job.get("id")) + " failed to start: " + str(e))
+
+def _cron_line_job(line):
+    """A '#MICROBOT_ID=' crontab line written by tools.sh -> job dict, or None."""
+    body, sched_id = line.split("#MICROBOT_ID=", 1)
+    parts = body.split()
+    n = 1 if parts and parts[0].startswith("@") else 5
+    if len(parts) < n + 3:
+        return None
+    script, chat_id, kind, rest = parts[n], parts[n + 1], parts[n + 2], parts[n + 3:]
+    try:
+        chat_id = int(chat_id)
+    except:
+        return None
+    job = {"id": sched_id.strip(), "cron": " ".join(parts[:n]), "chat_id": chat_id}
+    if script.endswith("/cron_probe.sh"):
+        job.update({"type": "probe", "probe": kind, "content": " ".join(rest)})
+    elif script.endswith("/cron_task.sh") and kind in Scheduler.TYPES:
+        if kind.startswith("once_"):
+            rest = rest[1:]   # their own ID, for self-removal
+        job.update({"type": kind, "content": " ".join(rest)})
+    else:
+        return None
+    return job
+
+def _job_cron_line(job):
+    """Job dict -> the crontab line tools.sh would have written."""
+    kind = job["type"]
+    if kind == "probe":
+        parts = [SCRIPT_DIR + "/cron_probe.sh", str(job["chat_id"]), job.get("probe", "")]
+    else:
+        parts = [SCRIPT_DIR + "/cron_task.sh", str(job["chat_id"]), kind]
+        if kind.startswith("once_"):
+            parts.append(job["id"])
+    content = job.get("content", "").replace("'", "")
+    if content:
+        parts.append(content)
+    return job["cron"] + " " + " ".join(parts) + " #MICROBOT_ID=" + job["id"]
+
+def _write_crontab(lines):
+    ct = temp_path("mb_cron_", ".txt")
+    try:
+        with open(ct, 'w') as f:
+            f.write("\n".join(lines).strip() + "\n")
+        if [l for l in lines if l.strip()]:
+            run_command("crontab " + ct)
+        else:
+            run_command("crontab -r 2>/dev/null")
+    finally:
+        try:
+            os.remove(ct)
+        except:
+            pass
+
+def import_crontab(scheduler):
+    """Move MicroBot lines from the system crontab into the scheduler (the
+    crontab is rewritten without them). Only run when the operator sets
+    scheduler_import_crontab. Returns how many moved."""
+    text = run_command("crontab -l 2>/dev/null")
+    if "#MICROBOT_ID=" not in text:
+        return 0
+    keep = []
+    moved = 0
+    for line in text.split("\n"):
+        job = _cron_line_job(line) if "#MICROBOT_ID=" in line else None
+        if job:
+            try:
+                scheduler.add(job)
+                moved += 1
+                continue
+            except Exception as e:
+                print("[sched] Keeping crontab line " + job["id"] + ": " + str(e))
+        keep.append(line)
+    _write_crontab(keep)
+    print("[sched] Imported " + str(moved) + " schedules from crontab")
+    return moved
+
+def export_crontab(path):
+    """Scheduler disabled: hand jobs left in schedules.json back to crontab
+    (cron_task.sh / cron_probe.sh lines) so they keep firing, and empty the
+    file so they don't run twice if the scheduler is switched back on.
+    Returns how many moved."""
+    try:
+        jobs = json.loads(_read_text(path) or "[]")
+    except:
+        return 0
+    if not jobs:
+        return 0
+    text = run_command("crontab -l 2>/dev/null")
+    lines = [l for l in text.split("\n") if l.strip() and not l.startswith("Error")]
+    have = set()
+    for line in lines:
+        if "#MICROBOT_ID=" in line:
+            have.add(line.split("#MICROBOT_ID=", 1)[1].strip())
+    moved = 0
+    for job in jobs:
+        try:
+            if job["id"] not in have:
+                lines.append(_job_cron_line(job))
+            moved += 1
+        except Exception as e:
+            print("[sched] Could not export job " + str(job.get("id")) + ": " + str(e))
+    _write_crontab(lines)
+    try:
+        with open(path + ".tmp", 'w') as f:
+            json.dump([], f)
+        os.rename(path + ".tmp", path)
+    except Exception as e:
+        print("[sched] Could not clear " + path + ": " + str(e))
+    print("[sched] Moved " + str(moved) + " schedules back to crontab")
+    return moved
+
+PROBES = ("disk_check", "mem_check", "net_check", "load_check", "service_check", "custom")
+
+# Shell versions (cron_probe.sh) for when /proc or statvfs aren't there
+PROBE_COMMANDS = {
+    "disk_check": "df / | tail -1 | awk '{print \"Root disk: \"$3\"/\"$2\" KB used (\"$5\" full), \"$4\" KB free\"}'",
+    "mem_check": "free | grep Mem | awk '{printf \"RAM: %dKB used / %dKB total (%dKB free)\", $3, $2, $4}'",
+    "net_check": "ping -c 2 -W 3 8.8.8.8 2>&1 | tail -2",
+    "load_check": "echo \"Load: $(cut -d' ' -f1-3 /proc/loadavg) | Uptime: $(cut -d. -f1 /proc/uptime)s\"",
+}
+PROBE_SERVICES = ("dnsmasq", "uhttpd", "dropbear")
+
+PROBE_PROMPT = ("You are a system monitor. Given this data, respond with ONLY one of:\n"
+                "- ALERT: <short message for user> (if something needs attention)\n"
+                "- OK (if everything is normal)\n\nData: ")
+
+def _probe_native(name):
+    """Probe data read in-process, or None to fall back to the shell."""
+    if name == "disk_check":
+        try:
+            st = os.statvfs("/")
+        except:
+            return None
+        total = st[1] * st[2] // 1024
+        free = st[1] * st[4] // 1024
+        used = total - st[1] * st[3] // 1024
+        pct = (used * 100 + total - 1) // total if total else 0
+        return "Root disk: " + str(used) + "/" + str(total) + " KB used (" + str(pct) + "% full), " + str(free) + " KB free"
+    if name == "mem_check":
+        meminfo = _read_text("/proc/meminfo")
+        if meminfo is None:
+            return None
+        mem = {}
+        for line in meminfo.split("\n"):
+            parts = line.split()
+            if len(parts) >= 2:
+                mem[parts[0].rstrip(":")] = int(parts[1])
+        total = mem.get("MemTotal", 0)
+        free = mem.get("MemFree", 0)
+        used = total - free - mem.get("Buffers", 0) - mem.get("Cached", 0)
+        return "RAM: " + str(used) + "KB used / " + str(total) + "KB total (" + str(free) + "KB free)"
+    if name == "load_check":
+        load = _read_text("/proc/loadavg")
+        uptime = _read_text("/proc/uptime")
+        if load is None or uptime is None:
+            return None
+        return "Load: " + ", ".join(load.split()[:3]) + " | Uptime: " + uptime.split(".")[0] + "s"
+    if name == "service_check":
+        try:
+            pids = [p for p in os.listdir("/proc") if p.isdigit()]
+        except:
+            return None
+        running = set()
+        for pid in pids:
+            running.add((_read_text("/proc/" + pid + "/comm") or "").strip())
+        down = [s for s in PROBE_SERVICES if s not in running]
+        if not down:
+            return "All key services running (" + ", ".join(PROBE_SERVICES) + ")"
+        return " ".join([s + ": DOWN!" for s in down])
+    return None
+
+def run_probe(agent, job):
+    """Collect probe data and ask the LLM whether it is worth an alert.
+    Returns the alert text, or "" to stay silent."""
+    name = job.get("probe", "")
+    data = _probe_native(name)
+    if data is None:
+        if name == "custom":
+            cmd = job.get("content", "")
+        elif name == "service_check":
+            cmd = "for s in " + " ".join(PROBE_SERVICES) + "; do pidof $s >/dev/null || printf '%s: DOWN! ' $s; done"
+        else:
+            cmd = PROBE_COMMANDS.get(name, "")
+        data = agent.tools.run(cmd)[:2000].strip() if cmd else ""
+        if name == "service_check" and not data:
+            data = "All key services running (" + ", ".join(PROBE_SERVICES) + ")"
+    if not data:
+        return ""
+    reply = agent.extract_text(agent.llm.chat([{"role": "user", "content": PROBE_PROMPT + data}], tools=False)).strip()
+    if reply[:6].lower() == "alert:":
+        return "⚠️ Proactive Alert: " + reply[6:].strip()
+    return ""
+
+def run_scheduled_job(agent, token, job):
+    """One firing, on a dispatcher worker, so it queues behind the chat's
+    messages and shares the agent's shell workers and Telegram sender."""
+    kind = job.get("type")
+    content = job.get("content", "")
+    text = ""
+    if kind in ("msg", "once_msg"):
+        text = content
+    elif kind in ("cmd", "once_cmd"):
+        text = agent.tools.run(content)[:3000]
+    elif kind == "url":
+        # Straight to the tool: a scheduled fetch wants fresh content, not ToolCache's
+        result = agent._run_tool("scrape_web", {"url": content}, job["chat_id"])
+        if result and not result.startswith("Error"):
+            text = "Content from " + content + ": " + result[:3000]
+        else:
+            text = "Error: Could not fetch " + content
+    elif kind == "probe":
+        text = run_probe(agent, job)
+    if text:
+        send_telegram_msg(job["chat_id"], text, token)
+
+class ChatDispatcher:
+    """Per-chat scheduler: different chats run concurrently on at most
+    `workers` threads, messages within one chat stay strictly in order.
+
+    Threads are started on demand and exit when no chat has pending work,
+    so only _thread locks are needed (no condition variables on MicroPython).
+    """
+    def __init__(self, workers=3):
+        self.workers = max(1, int(workers))
+        self.lock = new_lock()
+        self.queues = {}    # chat_id -> [(fn, args)] pending for that chat
+        self.ready = []     # chats with pending work waiting for a free worker
+        self.active = {}    # chat_id -> True while a worker owns the chat
+        self.running = 0
+
+    def submit(self, chat_id, fn, *args):
+        if _thread is None or self.workers <= 1:
+            self._call(fn, args)
+            return
+        start = False
+        with self.lock:
+            self.queues.setdefault(chat_id, []).append((fn, args))
+            if chat_id in self.active or chat_id in self.ready:
+                return
+            if self.running < self.workers:
+                self.running += 1
+                self.active[chat_id] = True
+                start = True
+            else:
+                self.ready.append(chat_id)
+        if start:
+            try:
+                _thread.start_new_thread(self._run, (chat_id,))
+            except Exception as e:
+                print("[dispatch] Could not start worker: " + str(e))
+                with self.lock:
+                    self.running -= 1
+                    del self.active[chat_id]
+                    jobs = self.queues.pop(chat_id, [])
+                for fn, args in jobs:
+                    self._call(fn, args)
+
+    def _call(self, fn, args):
+        try:
+            fn(*args)
+        except Exception as e:
+            print("[dispatch] Job error: " + str(e))
+
+    def _run(self, chat_id):
+        while chat_id is not None:
+            with self.lock:
+                jobs = self.queues.get(chat_id)
+                job = jobs.pop(0) if jobs else None
+                if job is None:
+                    # Chat drained: hand this worker to the next waiting chat
+                    self.queues.pop(chat_id, None)
+                    del self.active[chat_id]
+                    chat_id = self.ready.pop(0) if self.ready else None
+                    if chat_id is None:
+                        self.running -= 1
+                    else:
+                        self.active[chat_id] = True
+                    continue
+            self._call(job[0], job[1])
+            with self.lock:
+                # Round-robin: a busy chat yields its worker to waiting chats
+                if self.ready and self.queues.get(chat_id):
+                    del self.active[chat_id]
+                    self.ready.append(chat_id)
+                    chat_id = self.ready.pop(0)
+                    self.active[chat_id] = True
+
+    def pending(self):
+        with self.lock:
+            return sum([len(q) for q in self.queues.values()])
+
+def handle_message(agent, token, chat_id, text, display_name):
+    """Process one incoming Telegram message and send the reply."""
+    send_typing(chat_id, token)
     
-    if not s_res or '"ok":true' not in s_res:
-        # Fallback: URL-encoded form post (most compatible)
-        # Simple manual encoding for minimal environments
-        encoded = clean_text.replace(" ", "%20").replace("\n", "%0A").replace("&", "%26")
-        cmd2 = "curl -k -s '" + send_url + "?chat_id=" + str(chat_id) + "&text=" + encoded + "'"
-        run_command(cmd2)
+    response = ""
+    # Commands
+    if text == "/start":
+        response = "Hello! I'm MicroBot AI (Python). How can I help?"
+        agent.clear_history(chat_id)
+    elif text == "/clear":
+        agent.clear_history(chat_id)
+        response = "Memory cleared."
+    else:
+        # Process with Agent
+        stream = None
+        if config_flag(agent.config, "stream"):
+            stream = TelegramStream(chat_id, token, agent.config.get("stream_edit_interval", 1.5))
+        response = agent.process_message(chat_id, text, display_name, stream)
+        if stream and stream.finish(response):
+            return
+        
+    # Send final response
+    send_telegram_msg(chat_id, response, token)
+
+def start_scheduler(agent, dispatcher, token):
+    """In-process cron on its own thread; jobs run on the dispatcher."""
+    global SCHEDULER
+    if _thread is None or not config_flag(agent.config, "scheduler", True):
+        export_crontab(SCHEDULE_FILE)
+        return None
+    sched = Scheduler(SCHEDULE_FILE, lambda job: dispatcher.submit(
+        job["chat_id"], run_scheduled_job, agent, token, job))
+    sched.load()
+    try:
+        _thread.start_new_thread(sched.run_forever, ())
+    except Exception as e:
+        print("[sched] No scheduler thread (" + str(e) + "), using crontab")
+        export_crontab(SCHEDULE_FILE)
+        return None
+    SCHEDULER = sched
+    if config_flag(agent.config, "scheduler_import_crontab", False):
+        import_crontab(sched)
+    return sched
 
 def main():
     print("=" * 40)
     print("   MicroBot AI - MicroPython Version")
     print("=" * 40)
     
-    # Check curl (required now)
-    curl_ver = run_command("curl --version 2>&1 | head -1")
-    if not curl_ver:
-        # Check if we can run curl anyway (fallback)
-        test_curl = run_command("curl --version")
-        if not test_curl:
-            print("ERROR: curl is required. Please install with 'opkg install curl'")
-            sys.exit(1)
-        
-    config_data = {}
-    if Path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                config_data = json.load(f)
-        except:
-            print("Error loading config.json")
+    # No curl probe: HTTP is in-process, curl is only a lazy fallback
+    config_data = load_config_file() or {}
             
     agent = Agent(config_data)
+    dispatcher = ChatDispatcher(config_data.get("max_workers", 3))
+    METRICS.log_path = config_data.get("metrics_log") or None
+    metrics_port = config_data.get("metrics_port")
+    if metrics_port and not (config_data.get("webhook_url") and str(metrics_port) == str(config_data.get("http_port", 8080))):
+        start_metrics_server(metrics_port, config_data.get("metrics_host", "127.0.0.1"), agent)
+    flusher = False
+    if _thread is not None:
+        try:
+            _thread.start_new_thread(agent.sessions.run_flusher, ())
+            flusher = True
+        except Exception as e:
+            print("[session] No flush thread (" + str(e) + "), flushing from the poll loop")
 
     # Try dynamic skill loading (safe - if it fails, hardcoded tools still work)
     Agent.load_skills()
@@ -818,20 +5379,73 @@ def main():
         sys.exit(1)
         
     print("Bot Token: " + (token[:10] if token else "None") + "...")
+
+    api = config_data.get("tg_api_base") or TG_API
+    sender = get_sender(token, api)
+    start_scheduler(agent, dispatcher, token)
+    dedupe = UpdateDeduper()
+
+    def on_update(update):
+        """Shared by polling and webhook: dedupe, then hand to the dispatcher."""
+        if not dedupe.first_time(update.get("update_id")):
+            return
+        if "message" not in update:
+            return
+            
+        msg = update["message"]
+        chat_id = msg["chat"]["id"]
+        text = msg.get("text", "")
+        
+        if not text:
+            return
+            
+        # DEBUG: Print raw message structure to debug username issue
+        # print("DEBUG: MSG: " + json.dumps(msg))
+        
+        user = msg.get("from", {})
+        username = user.get("username", "")
+        first_name = user.get("first_name", "")
+        
+        display_name = username or first_name or "unknown"
+        print("\n[telegram] @" + display_name + ": " + text)
+        
+        # Chats run concurrently; one chat's messages stay in order
+        dispatcher.submit(chat_id, handle_message, agent, token, chat_id, text, display_name)
+
+    # procd stops services with SIGTERM: treat it like Ctrl-C so the
+    # session journal gets flushed (no signal module on MicroPython)
+    try:
+        import signal
+        def on_term(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, on_term)
+    except:
+        pass
+
+    webhook_url = config_data.get("webhook_url")
+    if webhook_url:
+        if serve_webhook(config_data, token, sender, agent, flusher, on_update):
+            return
+        print("[webhook] Falling back to long polling")
+
     print("Starting polling loop...")
     
     offset = 0
-    
+
     while True:
         try:
+            if not flusher:
+                agent.sessions.maybe_flush()
+            agent.maybe_reload()
+
             # Polling URL
-            url = "https://api.telegram.org/bot" + token + "/getUpdates?timeout=30&allowed_updates=%5B%22message%22%5D"
+            url = api + token + "/getUpdates?timeout=30&allowed_updates=%5B%22message%22%5D"
             if offset > 0:
                 url += "&offset=" + str(offset)
                 
-            # Poll with curl
-            cmd = "curl -k -s -m 40 \"" + url + "\""
-            resp_str = run_command(cmd)
+            # Long poll on the sender's keep-alive pool; curl only if the
+            # native transport fails (getUpdates is safe to repeat)
+            status, resp_str = sender.http.request("GET", url, None, None, timeout=40)
             
             if not resp_str or not resp_str.startswith("{"):
                 time.sleep(0.5)
@@ -842,60 +5456,70 @@ def main():
             if not data.get("ok"):
                 # Conflict error check
                 if data.get("error_code") == 409:
-                     print("Conflict error: Sleeping...")
+                     # A webhook left behind by webhook mode blocks getUpdates
+                     print("Conflict error: removing webhook, sleeping...")
+                     sender.call("deleteWebhook", {})
                      time.sleep(5)
                 continue
                 
             updates = data.get("result", [])
             for update in updates:
-                update_id = update.get("update_id")
-                offset = update_id + 1
-                
-                if "message" not in update:
-                    continue
-                    
-                msg = update["message"]
-                chat_id = msg["chat"]["id"]
-                text = msg.get("text", "")
-                
-                if not text:
-                    continue
-                    
-                # DEBUG: Print raw message structure to debug username issue
-                # print("DEBUG: MSG: " + json.dumps(msg))
-                
-                user = msg.get("from", {})
-                username = user.get("username", "")
-                first_name = user.get("first_name", "")
-                
-                display_name = username or first_name or "unknown"
-                print("\n[telegram] @" + display_name + ": " + text)
-                
-                # Send typing
-                run_command("curl -k -s \"https://api.telegram.org/bot" + token + "/sendChatAction?chat_id=" + str(chat_id) + "&action=typing\"")
-                
-                response = ""
-                # Commands
-                if text == "/start":
-                    response = "Hello! I'm MicroBot AI (Python). How can I help?"
-                    agent.clear_history(chat_id)
-                elif text == "/clear":
-                    agent.clear_history(chat_id)
-                    response = "Memory cleared."
-                else:
-                    # Process with Agent
-                    response = agent.process_message(chat_id, text, display_name)
-                    
-                # Send final response
-                send_telegram_msg(chat_id, response, token)
+                offset = update.get("update_id") + 1
+                on_update(update)
 
         except KeyboardInterrupt:
             print("\nStopping...")
+            agent.sessions.flush()
+            sender.flush()
+            dump_metrics()
             break
         except Exception as e:
             print("Loop Error: " + str(e))
             # sys.print_exception(e)
             time.sleep(1)
 
+def serve_webhook(config_data, token, sender, agent, flusher, on_update):
+    """Webhook mode: register webhook_url with Telegram and serve pushes on
+    http_port. Returns False if it could not start (caller polls instead)."""
+    if socket is None:
+        print("[webhook] No socket module")
+        return False
+    secret = config_data.get("webhook_secret") or _random_token()
+    server = WebhookServer(config_data.get("http_port", 8080), secret, on_update)
+    if str(config_data.get("metrics_port", "")) == str(config_data.get("http_port", 8080)):
+        add_metrics_pages(server, agent)
+    try:
+        server.start()
+    except Exception as e:
+        print("[webhook] Cannot listen: " + str(e))
+        return False
+    r = sender.call("setWebhook", {
+        "url": config_data["webhook_url"],
+        "secret_token": secret,
+        "allowed_updates": ["message"]
+    })
+    if not r or not r.get("ok"):
+        print("[webhook] setWebhook failed: " + str(r)[:200])
+        server.close()
+        return False
+    print("[webhook] Registered " + config_data["webhook_url"])
+
+    while True:
+        try:
+            server.serve_once()
+            if not flusher:
+                agent.sessions.maybe_flush()
+            agent.maybe_reload()
+        except KeyboardInterrupt:
+            print("\nStopping...")
+            server.close()
+            agent.sessions.flush()
+            sender.flush()
+            dump_metrics()
+            return True
+        except Exception as e:
+            print("Webhook Loop Error: " + str(e))
+            time.sleep(1)
+
 if __name__ == "__main__":
     main()
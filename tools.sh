@@ -875,8 +875,9 @@ tool_list_all_tools() {
 }
 
 # Load Plugins from ./plugins/*.sh
+# (microbot.py sets MB_LAZY_PLUGINS and sources each plugin on first use)
 PLUGIN_DIR="${SCRIPT_DIR:-.}/plugins"
-if [ -d "$PLUGIN_DIR" ]; then
+if [ -d "$PLUGIN_DIR" ] && [ -z "$MB_LAZY_PLUGINS" ]; then
     for plugin in "$PLUGIN_DIR"/*.sh; do
         if [ -f "$plugin" ]; then
             . "$plugin"